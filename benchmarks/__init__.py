@@ -0,0 +1 @@
+"""Initialization of the benchmarks package."""
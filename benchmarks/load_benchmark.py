@@ -0,0 +1,441 @@
+"""An end-to-end load test of the chat servers.
+
+Starts a DataServer and a BroadcastServer on localhost, seeds them with a
+synthetic chat database, then drives simulated users against them. Every user
+keeps a message stream open while messages are sent, and chats are read, at a
+target rate. Reports the throughput and latency percentiles of each RPC as well
+as the end-to-end latency from sending a message until it is delivered to each
+receiver. Results, along with the servers' own metrics, are written to a JSON
+file so runs can be compared across commits.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.load_benchmark --duration_secs=30 --output=results.json
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+from talko import client as client_lib
+from talko import constants
+from talko import database_client
+from talko import server
+from talko import tracing
+
+# The latency percentiles reported by summarize().
+PERCENTILES = (50, 95, 99)
+# Prefix of the benchmark messages' text, followed by the message sequence
+# number, so receivers can look up when each message was sent.
+_MESSAGE_PREFIX = 'load-test'
+_SERVER_START_TIMEOUT_SECS = 10
+
+
+def seed_database(db_path, num_users, num_chats, group_size, history_length):
+    """Creates a synthetic chat database at db_path.
+
+    Each chat has 'group_size' randomly chosen participants and
+    'history_length' messages. Chats of size 2 are marked as private.
+
+    Returns:
+        A map from the chat_id of each chat to the user_ids in the chat.
+    """
+    database_client.create_database(db_path, overwrite=True)
+    rng = random.Random(0)
+    user_ids = range(1, num_users + 1)
+    chats = {
+            chat_id: rng.sample(user_ids, group_size)
+            for chat_id in range(1, num_chats + 1)
+    }
+    now = time.time() * constants.MILLIS_PER_SEC
+    messages = [
+            (chat_id, rng.choice(participants), f'History message {i}',
+             now - history_length + i)
+            for chat_id, participants in chats.items()
+            for i in range(history_length)
+    ]
+    with sqlite3.connect(db_path) as connection:
+        connection.executemany(
+                'INSERT INTO Users (user_name) VALUES (?)',
+                [(f'User {user_id}',) for user_id in user_ids])
+        connection.executemany(
+                'INSERT INTO Chats (chat_name, is_private) VALUES (?, ?)',
+                [(f'Chat {chat_id}', group_size == 2) for chat_id in chats])
+        connection.executemany(
+                'INSERT INTO Participants (chat_id, user_id) VALUES (?, ?)',
+                [(chat_id, user_id)
+                 for chat_id, participants in chats.items()
+                 for user_id in participants])
+        connection.executemany(
+                'INSERT INTO Messages (chat_id, user_id, message_text, '
+                'message_ts) VALUES (?, ?, ?, ?)',
+                messages)
+    return chats
+
+
+def _free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _is_listening(address):
+    if isinstance(address, str):
+        # The socket file is created when the server binds, right before it
+        # starts listening.
+        return os.path.exists(address)
+    # Binding fails (even with SO_REUSEADDR) once the server is listening.
+    # Unlike connecting, this does not make the server fork a worker.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    try:
+        sock.bind(address)
+        return False
+    except OSError:
+        return True
+    finally:
+        sock.close()
+
+
+def _serve(server_cls, *args):
+    # Move the server into its own process group, so it can be stopped along
+    # with all the worker processes it forks.
+    os.setpgid(0, 0)
+    server_cls(*args).serve_forever()
+
+
+@contextlib.contextmanager
+def run_servers(db_path, host, socket_dir=None):
+    """Runs a DataServer and BroadcastServer on free ports of the host.
+
+    If a 'socket_dir' is given, the servers instead listen on Unix domain
+    sockets in that directory.
+
+    Yields:
+        The (data_address, broadcast_address) of the running servers.
+    """
+    if socket_dir:
+        data_address = os.path.join(socket_dir, 'data.sock')
+        broadcast_address = os.path.join(socket_dir, 'broadcast.sock')
+    else:
+        data_address = (host, _free_port(host))
+        broadcast_address = (host, _free_port(host))
+    processes = [
+            multiprocessing.Process(
+                target=_serve,
+                args=(server.DataServer, data_address, broadcast_address,
+                      db_path)),
+            multiprocessing.Process(
+                target=_serve,
+                args=(server.BroadcastServer, broadcast_address,
+                      data_address)),
+    ]
+    for process in processes:
+        process.start()
+    try:
+        deadline = time.time() + _SERVER_START_TIMEOUT_SECS
+        for address in (data_address, broadcast_address):
+            while not _is_listening(address):
+                if time.time() > deadline:
+                    raise TimeoutError(f'Server at {address} did not start')
+                time.sleep(.01)
+        yield data_address, broadcast_address
+    finally:
+        for process in processes:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGTERM)
+            process.join()
+
+
+def percentile(sorted_values, p):
+    """Returns the p-th percentile of the sorted values (nearest rank)."""
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(latencies_ms, n_errors, duration_secs):
+    """Summarizes the latencies of a single operation."""
+    latencies_ms = sorted(latencies_ms)
+    summary = {
+            'count': len(latencies_ms),
+            'errors': n_errors,
+            'throughput_per_sec': len(latencies_ms) / duration_secs,
+            'mean_ms': (sum(latencies_ms) / len(latencies_ms)
+                        if latencies_ms else None),
+            'max_ms': latencies_ms[-1] if latencies_ms else None,
+    }
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = percentile(latencies_ms, p)
+    return summary
+
+
+def git_commit():
+    """Returns the commit the benchmark runs at, to compare results by."""
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadTest:
+    """Drives simulated users against running servers."""
+
+    def __init__(self, data_address, broadcast_address, chats,
+                 max_connections=None, trace_rate=1):
+        """Initializes a new LoadTest instance.
+
+        Args:
+            data_address: The (host, port) address of the DataServer.
+            broadcast_address: The (host, port) address of the BroadcastServer.
+            chats: A map from chat_id to the user_ids in the chat, as returned
+                by seed_database().
+            max_connections: The maximum number of concurrent connections to
+                the DataServer.
+            trace_rate: The fraction of messages to trace through the servers.
+        """
+        self._client = client_lib.AsyncClient(
+                data_address, broadcast_address, max_connections)
+        self._chats = chats
+        self._chat_ids = list(chats)
+        self._user_ids = sorted({u for users in chats.values() for u in users})
+        self._rng = random.Random(1)
+        self._latencies_ms = collections.defaultdict(list)
+        self._errors = collections.Counter()
+        # The send time of each benchmark message, by sequence number.
+        self._sent_at = {}
+        self._n_expected_deliveries = 0
+        self._trace_rate = trace_rate
+        # The durations of each hop of the traced messages.
+        self._spans_ms = collections.defaultdict(list)
+        self._slowest_trace = None
+        self._slowest_latency = 0
+
+    async def _timed(self, method, coroutine):
+        start = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            self._errors[method] += 1
+            return
+        self._latencies_ms[method].append(
+                (time.perf_counter() - start) * constants.MILLIS_PER_SEC)
+
+    async def _receive(self, user_id):
+        async for message in self._client.open_stream(user_id):
+            received_at = time.perf_counter()
+            text = message['message']['message_text']
+            prefix, _, seq = text.partition(' ')
+            if prefix != _MESSAGE_PREFIX:
+                continue
+            latency = received_at - self._sent_at[int(seq)]
+            self._latencies_ms['EndToEnd'].append(
+                    latency * constants.MILLIS_PER_SEC)
+            trace = message.get('trace')
+            if trace:
+                for name, duration_ms in tracing.spans(trace):
+                    self._spans_ms[name].append(duration_ms)
+                if latency > self._slowest_latency:
+                    self._slowest_latency = latency
+                    self._slowest_trace = trace
+
+    async def _send_message(self):
+        chat_id = self._rng.choice(self._chat_ids)
+        participants = self._chats[chat_id]
+        user_id = self._rng.choice(participants)
+        seq = len(self._sent_at)
+        self._sent_at[seq] = time.perf_counter()
+        self._n_expected_deliveries += len(participants) - 1
+        trace = self._rng.random() < self._trace_rate
+        await self._timed(
+                'InsertMessage',
+                self._client.insert_message(
+                    chat_id, user_id, f'{_MESSAGE_PREFIX} {seq}', trace))
+
+    async def _read(self):
+        if self._rng.random() < .5:
+            user_id = self._rng.choice(self._user_ids)
+            await self._timed(
+                    'GetChats',
+                    self._client.get_chats(user_id, messages_limit=1))
+        else:
+            chat_id = self._rng.choice(self._chat_ids)
+            await self._timed(
+                    'GetMessages',
+                    self._client.get_messages(chat_id, limit=50))
+
+    async def _run_at_rate(self, rate, duration_secs, make_request):
+        """Starts requests at a fixed rate, regardless of their latency.
+
+        Requests are not throttled by slow responses, otherwise the load would
+        drop exactly when the servers struggle and hide the slowdown.
+        """
+        if not rate:
+            return
+        start = time.perf_counter()
+        tasks = []
+        for i in range(int(rate * duration_secs)):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(make_request()))
+        await asyncio.gather(*tasks)
+
+    async def run(self, duration_secs, message_rate, read_rate,
+                  warmup_secs=1, drain_secs=1):
+        """Runs the load test and returns its results.
+
+        Args:
+            duration_secs: How long to send messages and read chats for.
+            message_rate: The number of messages sent per second.
+            read_rate: The number of GetChats or GetMessages per second.
+            warmup_secs: How long to wait for the streams to open.
+            drain_secs: How long to wait for the last messages to arrive.
+        """
+        receivers = [
+                asyncio.ensure_future(self._receive(user_id))
+                for user_id in self._user_ids
+        ]
+        await asyncio.sleep(warmup_secs)
+
+        start = time.perf_counter()
+        await asyncio.gather(
+                self._run_at_rate(
+                    message_rate, duration_secs, self._send_message),
+                self._run_at_rate(read_rate, duration_secs, self._read))
+        elapsed_secs = time.perf_counter() - start
+        await asyncio.sleep(drain_secs)
+
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        await self._client.close()
+
+        end_to_end = self._latencies_ms.pop('EndToEnd', [])
+        results = {
+                'duration_secs': elapsed_secs,
+                'rpcs': {
+                    method: summarize(
+                        self._latencies_ms[method],
+                        self._errors[method],
+                        elapsed_secs)
+                    for method in sorted(
+                        set(self._latencies_ms) | set(self._errors))
+                },
+                'end_to_end': summarize(end_to_end, 0, elapsed_secs),
+                # Where the end-to-end latency went, hop by hop.
+                'spans': {
+                    name: summarize(durations_ms, 0, elapsed_secs)
+                    for name, durations_ms in self._spans_ms.items()
+                },
+                'slowest_trace': self._slowest_trace,
+        }
+        results['end_to_end']['expected'] = self._n_expected_deliveries
+        return results
+
+
+def _format_ms(value):
+    return '-' if value is None else f'{value:.2f}'
+
+
+def print_results(results):
+    """Prints a human readable table of the results."""
+    rows = dict(results['rpcs'], EndToEnd=results['end_to_end'])
+    columns = [f'p{p}_ms' for p in PERCENTILES] + ['max_ms']
+    print(f'{"":<14}{"count":>8}{"errors":>8}{"per_sec":>10}' +
+          ''.join(f'{c:>10}' for c in columns))
+    for name, row in rows.items():
+        print(f'{name:<14}{row["count"]:>8}{row["errors"]:>8}'
+              f'{row["throughput_per_sec"]:>10.1f}' +
+              ''.join(f'{_format_ms(row[c]):>10}' for c in columns))
+
+    if results['spans']:
+        print(f'\n{"hop":<40}' + ''.join(f'{c:>10}' for c in columns))
+        for name, row in results['spans'].items():
+            print(f'{name:<40}' + 
+                  ''.join(f'{_format_ms(row[c]):>10}' for c in columns))
+    if results['slowest_trace']:
+        print('\nSlowest', tracing.format_trace(results['slowest_trace']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, required=False,
+                        default='load_test.json',
+                        help='Path to write the JSON results to')
+    parser.add_argument('--host', type=str, required=False,
+                        default='127.0.0.1',
+                        help='The host to run the servers on')
+    parser.add_argument('--transport', type=str, required=False,
+                        default='tcp', choices=['tcp', 'uds'],
+                        help=('Whether the servers listen on TCP ports of the '
+                              '--host or on Unix domain sockets'))
+    parser.add_argument('--num_users', type=int, required=False, default=50,
+                        help='The number of users, each with an open stream')
+    parser.add_argument('--num_chats', type=int, required=False, default=50,
+                        help='The number of chats')
+    parser.add_argument('--group_size', type=int, required=False, default=5,
+                        help='The number of participants in each chat')
+    parser.add_argument('--history_length', type=int, required=False,
+                        default=100,
+                        help='The number of messages already in each chat')
+    parser.add_argument('--duration_secs', type=float, required=False,
+                        default=10, help='How long to generate load for')
+    parser.add_argument('--message_rate', type=float, required=False,
+                        default=50, help='Messages sent per second')
+    parser.add_argument('--read_rate', type=float, required=False,
+                        default=50,
+                        help='GetChats and GetMessages requests per second')
+    parser.add_argument('--max_connections', type=int, required=False,
+                        default=16,
+                        help='Maximum concurrent connections to the DataServer')
+    parser.add_argument('--trace_rate', type=float, required=False, default=1,
+                        help='The fraction of messages to trace')
+    FLAGS = parser.parse_args()
+
+    if FLAGS.group_size > FLAGS.num_users:
+        raise ValueError('--group_size can not be larger than --num_users')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'load_test.db')
+        chats = seed_database(
+                db_path, FLAGS.num_users, FLAGS.num_chats, FLAGS.group_size,
+                FLAGS.history_length)
+        socket_dir = tmp_dir if FLAGS.transport == 'uds' else None
+        with run_servers(db_path, FLAGS.host, socket_dir) as addresses:
+            load_test = LoadTest(
+                    *addresses, chats, FLAGS.max_connections, FLAGS.trace_rate)
+            loop = asyncio.get_event_loop()
+            results = loop.run_until_complete(load_test.run(
+                    FLAGS.duration_secs, FLAGS.message_rate, FLAGS.read_rate))
+            # Include the servers' own view, e.g. the time spent in the DB.
+            stats_client = client_lib.Client(*addresses)
+            results['server_stats'] = {
+                    'data': stats_client.get_stats(),
+                    'broadcast': stats_client.get_broadcast_stats(),
+            }
+
+    results = {
+            'commit': git_commit(),
+            'timestamp': time.time(),
+            'config': vars(FLAGS),
+            **results,
+    }
+    with open(FLAGS.output, 'w') as file_:
+        json.dump(results, file_, indent=2)
+    print_results(results)
@@ -0,0 +1,199 @@
+"""Compares the latency of small RPCs over loopback TCP and Unix domain sockets.
+
+Two things are measured for each transport:
+
+    1. 'echo': A ping-pong of small JSON-RPC sized messages between two
+        processes, without any servers involved. This isolates the cost of the
+        transport itself, i.e. the syscalls and the kernel network stack. A
+        socketpair(), the cheapest way for a process to talk to a child it
+        forked, is included as a baseline.
+    2. 'rpc': GetUser requests to a running DataServer, either all over a
+        single persistent connection or with a new connection per request. The
+        latter includes the server forking a worker for every connection.
+
+Results are written to a JSON file, like the load test's, so runs can be
+compared across commits.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.transport_benchmark --num_requests=5000
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from benchmarks import load_benchmark
+from talko import socket_lib
+
+_ECHO_TRANSPORTS = ('tcp', 'uds', 'socketpair')
+_RPC_TRANSPORTS = ('tcp', 'uds')
+# The number of round trips made before measuring, e.g. to fault in the code
+# paths and database pages.
+_WARMUP_REQUESTS = 50
+_MESSAGE = json.dumps(socket_lib.encode_request('GetUser', {'user_id': 1}))
+
+
+def _echo_forever(sock):
+    try:
+        while True:
+            socket_lib.send_message(sock, socket_lib.recv_message(sock))
+    except ConnectionError:
+        pass
+    finally:
+        sock.close()
+
+
+def _close_and_echo(parent_socket, sock):
+    # The forked child also holds the parent's end of the socketpair, which
+    # must be closed for the child to see the parent closing the connection.
+    parent_socket.close()
+    _echo_forever(sock)
+
+
+def _accept_and_echo(listen_socket):
+    sock, _ = listen_socket.accept()
+    listen_socket.close()
+    _echo_forever(sock)
+
+
+@contextlib.contextmanager
+def _echo_connection(transport, host, socket_dir):
+    """Yields a socket connected to an echo process over the transport."""
+    if transport == 'socketpair':
+        sock, peer_socket = socket.socketpair()
+        process = multiprocessing.Process(
+                target=_close_and_echo, args=(sock, peer_socket))
+        process.start()
+        peer_socket.close()
+    else:
+        address = (host, 0)
+        if transport == 'uds':
+            address = os.path.join(socket_dir, 'echo.sock')
+        listen_socket = socket.socket(
+                socket_lib.address_family(address), socket.SOCK_STREAM)
+        listen_socket.bind(address)
+        listen_socket.listen()
+        process = multiprocessing.Process(
+                target=_accept_and_echo, args=(listen_socket,))
+        process.start()
+        sock = socket_lib.connect(listen_socket.getsockname())
+        listen_socket.close()
+    try:
+        yield sock
+    finally:
+        sock.close()
+        process.join()
+        if transport == 'uds':
+            os.unlink(address)
+
+
+def _time_calls(fn, num_calls):
+    """Calls fn() num_calls times and summarizes the latency of the calls."""
+    for _ in range(_WARMUP_REQUESTS):
+        fn()
+    latencies_ms = []
+    start_secs = time.perf_counter()
+    for _ in range(num_calls):
+        call_start_secs = time.perf_counter()
+        fn()
+        latencies_ms.append((time.perf_counter() - call_start_secs) * 1000)
+    elapsed_secs = time.perf_counter() - start_secs
+    return load_benchmark.summarize(latencies_ms, 0, elapsed_secs)
+
+
+def measure_echo(transport, host, socket_dir, num_requests):
+    """Measures message round trips to an echo process over the transport."""
+    with _echo_connection(transport, host, socket_dir) as sock:
+        def round_trip():
+            socket_lib.send_message(sock, _MESSAGE)
+            socket_lib.recv_message(sock)
+        return _time_calls(round_trip, num_requests)
+
+
+def measure_rpc(db_path, host, socket_dir, num_requests, num_connections):
+    """Measures GetUser requests to a DataServer.
+
+    Returns:
+        The summaries of requests over a persistent connection and of requests
+        which each open a new connection.
+    """
+    params = {'user_id': 1}
+    with load_benchmark.run_servers(db_path, host, socket_dir) as addresses:
+        data_address, _ = addresses
+        sock = socket_lib.connect(data_address)
+        try:
+            persistent = _time_calls(
+                    lambda: socket_lib.send_request(
+                        'GetUser', params, sock=sock, keep_alive=True),
+                    num_requests)
+        finally:
+            sock.close()
+        new_connection = _time_calls(
+                lambda: socket_lib.send_request(
+                    'GetUser', params, address=data_address),
+                num_connections)
+    return persistent, new_connection
+
+
+def print_results(results):
+    """Prints a human readable table of the results."""
+    columns = ['mean_ms'] + [f'p{p}_ms' for p in load_benchmark.PERCENTILES]
+    print(f'{"":<28}{"count":>8}' + ''.join(f'{c:>10}' for c in columns))
+    for benchmark, rows in results['benchmarks'].items():
+        for transport, row in rows.items():
+            name = f'{benchmark} ({transport})'
+            print(f'{name:<28}{row["count"]:>8}' +
+                  ''.join(f'{row[c]:>10.3f}' for c in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, required=False,
+                        default='transport_test.json',
+                        help='Path to write the JSON results to')
+    parser.add_argument('--host', type=str, required=False,
+                        default='127.0.0.1',
+                        help='The host to use for the TCP transport')
+    parser.add_argument('--num_requests', type=int, required=False,
+                        default=2000,
+                        help=('The number of round trips over each persistent '
+                              'connection'))
+    parser.add_argument('--num_connections', type=int, required=False,
+                        default=200,
+                        help=('The number of requests made with a new '
+                              'connection each'))
+    FLAGS = parser.parse_args()
+
+    benchmarks = {'echo': {}, 'rpc.persistent': {}, 'rpc.new_connection': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for transport in _ECHO_TRANSPORTS:
+            benchmarks['echo'][transport] = measure_echo(
+                    transport, FLAGS.host, tmp_dir, FLAGS.num_requests)
+
+        db_path = os.path.join(tmp_dir, 'transport_test.db')
+        load_benchmark.seed_database(
+                db_path, num_users=2, num_chats=1, group_size=2,
+                history_length=0)
+        for transport in _RPC_TRANSPORTS:
+            socket_dir = tmp_dir if transport == 'uds' else None
+            persistent, new_connection = measure_rpc(
+                    db_path, FLAGS.host, socket_dir, FLAGS.num_requests,
+                    FLAGS.num_connections)
+            benchmarks['rpc.persistent'][transport] = persistent
+            benchmarks['rpc.new_connection'][transport] = new_connection
+
+    results = {
+            'commit': load_benchmark.git_commit(),
+            'timestamp': time.time(),
+            'config': vars(FLAGS),
+            'benchmarks': benchmarks,
+    }
+    with open(FLAGS.output, 'w') as file_:
+        json.dump(results, file_, indent=2)
+    print_results(results)
@@ -5,6 +5,16 @@ a 'terminal' (i.e. ncurses) client or a 'webapp' (i.e. Flask app).
 
 Calling the script multiple times with '--ui_client=terminal' creates multiple
 terminal clients.
+
+By default, the servers and clients talk over TCP. Since they all run on the
+same host, '--transport=uds' switches them over to (faster) Unix domain sockets
+in the '--socket_dir' instead.
+
+The servers are started (if not already running) by a supervisor process which
+waits until they are ready and restarts them if they crash, see the supervisor
+module. Sending SIGHUP to the supervisor restarts the servers, e.g. after a
+deploy, without refusing any connections. '--ui_client=none' only runs the
+supervisor, in the foreground.
 """
 
 import argparse 
@@ -12,13 +22,14 @@ import multiprocessing
 import os
 import socket
 import sqlite3
+import tempfile
 import time
 
 from talko import constants
 from talko import database_client
 from talko import server
-from talko.ui import curses_ui
-from talko.ui.webapp import app
+from talko import socket_lib
+from talko import supervisor as supervisor_lib
 
 FAKE_CHAT_SQL = f"""
 INSERT INTO Users (user_name) VALUES ("Eugen Hotaj"), ("Joe Rogan");
@@ -32,6 +43,15 @@ INSERT INTO Messages (chat_id, user_id, message_text, message_ts)
 
 def _check_socket(address):
     """Returns whether a socket is already bound to the given address."""
+    if isinstance(address, str):
+        # Binding a Unix domain socket fails whenever its file exists, even if
+        # the file was left behind by a server which is no longer running, so
+        # check whether the server is accepting connections instead.
+        try:
+            socket_lib.connect(address).close()
+            return True
+        except OSError:
+            return False
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
@@ -42,11 +62,27 @@ def _check_socket(address):
     finally:
         sock.close()
 
+
+def _start_supervisor(supervisor):
+    """Runs the supervisor in a new process and waits until it is ready."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    multiprocessing.Process(
+            target=supervisor.run_forever,
+            args=(lambda: sender.send(True),)).start()
+    sender.close()
+    try:
+        if receiver.poll(supervisor_lib.READY_TIMEOUT_SECS) and receiver.recv():
+            return
+    except EOFError:
+        pass
+    raise RuntimeError('The servers did not start.')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--ui_client', type=str, required=True,
-                        choices=['terminal', 'webapp'],
-                        help='The type of UI client to create')
+                        choices=['terminal', 'webapp', 'none'],
+                        help=('The type of UI client to create, or none to '
+                              'only run the servers'))
     parser.add_argument(
             '--terminal_user_id', type=int, required=False, 
             help='The user_id to connect as if creating a terminal client')
@@ -58,6 +94,15 @@ if __name__ == '__main__':
     parser.add_argument(
             '--insert_fake_chat', type=bool, required=False, default=False,
             help=('If true, populates the database with a fake chat'))
+    parser.add_argument(
+            '--transport', type=str, required=False, default='tcp',
+            choices=['tcp', 'uds'],
+            help=('Whether the servers listen on TCP ports or on Unix domain '
+                  'sockets'))
+    parser.add_argument(
+            '--socket_dir', type=str, required=False,
+            default=os.path.join(tempfile.gettempdir(), 'talko'),
+            help='The directory of the Unix domain sockets if --transport=uds')
 
     FLAGS = parser.parse_args()
     ui_client = FLAGS.ui_client
@@ -65,6 +110,8 @@ if __name__ == '__main__':
     db_path = FLAGS.db_path
     recreate_db = FLAGS.recreate_db
     insert_fake_chat = FLAGS.insert_fake_chat
+    transport = FLAGS.transport
+    socket_dir = FLAGS.socket_dir
 
     if ui_client == 'terminal' and user_id is None:
         raise ValueError(
@@ -72,16 +119,25 @@ if __name__ == '__main__':
     if insert_fake_chat and not recreate_db:
         raise ValueError('Fake chat can only be created if --recreate_db=True')
 
-    data_address = (constants.LOCALHOST, constants.DATA_PORT)
-    broadcast_address = (constants.LOCALHOST, constants.BROADCAST_PORT)
-
-    def start_data_server():
-        data_server = server.DataServer(data_address, broadcast_address, db_path)
-        data_server.serve_forever()
-
-    def start_broadcast_server():
-        broadcast_server = server.BroadcastServer(broadcast_address)
-        broadcast_server.serve_forever()
+    if transport == 'uds':
+        os.makedirs(socket_dir, exist_ok=True)
+        data_address = os.path.join(socket_dir, constants.DATA_SOCKET)
+        broadcast_address = os.path.join(
+                socket_dir, constants.BROADCAST_SOCKET)
+    else:
+        data_address = (constants.LOCALHOST, constants.DATA_PORT)
+        broadcast_address = (constants.LOCALHOST, constants.BROADCAST_PORT)
+
+    supervisor = supervisor_lib.Supervisor()
+    supervisor.add(
+            server.DataServer,
+            data_address,
+            broadcast_address=broadcast_address,
+            db_path=db_path)
+    supervisor.add(
+            server.BroadcastServer,
+            broadcast_address,
+            data_address=data_address)
 
     # (Re)create the chat database if necessary.
     database_client.create_database(db_path, overwrite=recreate_db)
@@ -90,13 +146,19 @@ if __name__ == '__main__':
             connection.executescript(FAKE_CHAT_SQL)
 
     # Only start the servers if they're not already running.
-    if not _check_socket(data_address) and not _check_socket(broadcast_address):
-        multiprocessing.Process(target=start_data_server).start()
-        multiprocessing.Process(target=start_broadcast_server).start()
-        time.sleep(.05)  # Wait a bit for the servers to start up.
-
-    # Create a new client.
+    running = _check_socket(data_address) or _check_socket(broadcast_address)
+    if ui_client == 'none':
+        if running:
+            raise RuntimeError('The servers are already running.')
+        supervisor.run_forever()
+    elif not running:
+        _start_supervisor(supervisor)
+
+    # Create a new client. The UIs are only imported when used, since they
+    # pull in heavy dependencies (e.g. Flask).
     if ui_client == 'terminal':
+        from talko.ui import curses_ui
         curses_ui.main(user_id, data_address, broadcast_address)
-    else:
+    elif ui_client == 'webapp':
+        from talko.ui.webapp import app
         app.main(data_address, broadcast_address)
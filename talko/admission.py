@@ -0,0 +1,61 @@
+"""Per-user rate limiting shared across the servers' worker processes."""
+
+import multiprocessing
+import time
+
+_N_SLOTS = 4096
+
+
+class TokenBuckets:
+    """A token bucket per user, stored in shared memory.
+
+    Each user may make 'burst' requests at once, after which their bucket
+    refills at 'rate' requests per second. Like the metrics, the buckets must
+    be created before forking the worker processes.
+
+    NOTE(eugenhotaj): Users are hashed into a fixed number of slots to keep the
+    memory bounded. If two users hash into the same slot, the slot is handed
+    over to whichever user was seen last, with a full bucket. This errs on the
+    side of letting requests through.
+    """
+
+    def __init__(self, rate, burst, n_slots=None):
+        """Initializes a new TokenBuckets instance.
+
+        Args:
+            rate: The number of tokens added to each bucket per second.
+            burst: The maximum number of tokens in a bucket.
+            n_slots: The number of buckets.
+        """
+        self._rate = rate
+        self._burst = burst
+        n_slots = n_slots or _N_SLOTS
+        self._user_ids = multiprocessing.RawArray('q', [-1] * n_slots)
+        self._tokens = multiprocessing.RawArray('d', n_slots)
+        self._updated_secs = multiprocessing.RawArray('d', n_slots)
+        self._lock = multiprocessing.Lock()
+
+    def acquire(self, user_id):
+        """Takes a token from the user's bucket, if there is one.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds until the
+            bucket has a token again.
+        """
+        slot = user_id % len(self._user_ids)
+        now = time.monotonic()
+        with self._lock:
+            if self._user_ids[slot] != user_id:
+                self._user_ids[slot] = user_id
+                tokens = self._burst
+            else:
+                elapsed_secs = now - self._updated_secs[slot]
+                tokens = min(
+                        self._burst,
+                        self._tokens[slot] + elapsed_secs * self._rate)
+            self._updated_secs[slot] = now
+            if tokens >= 1:
+                self._tokens[slot] = tokens - 1
+                return 0
+            self._tokens[slot] = tokens
+            return (1 - tokens) / self._rate
@@ -0,0 +1,58 @@
+"""Tests of the per-user token buckets.
+
+Run from the repository root with 'python -m unittest talko.admission_test'.
+"""
+
+import unittest
+from unittest import mock
+
+from talko import admission
+
+
+class TokenBucketsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.
+        patcher = mock.patch.object(
+                admission.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 2 tokens per second, up to 3 at once.
+        self.buckets = admission.TokenBuckets(2, 3, n_slots=8)
+
+    def test_allows_bursts_then_limits(self):
+        self.assertEqual(
+                [self.buckets.acquire(1) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(self.buckets.acquire(1), .5)
+        # Other users have their own buckets.
+        self.assertEqual(self.buckets.acquire(2), 0)
+
+    def test_buckets_refill_at_the_rate(self):
+        for _ in range(3):
+            self.buckets.acquire(1)
+        self.now += .25
+        self.assertAlmostEqual(self.buckets.acquire(1), .25)
+        self.now += .25
+        self.assertEqual(self.buckets.acquire(1), 0)
+        self.assertAlmostEqual(self.buckets.acquire(1), .5)
+
+    def test_buckets_hold_at_most_the_burst(self):
+        self.buckets.acquire(1)
+        self.now += 60
+        self.assertEqual(
+                [self.buckets.acquire(1) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(self.buckets.acquire(1), 0)
+
+    def test_colliding_users_take_over_the_slot_with_a_full_bucket(self):
+        for _ in range(3):
+            self.buckets.acquire(1)
+        # User 9 hashes into the same slot as user 1.
+        self.assertEqual(
+                [self.buckets.acquire(9) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(self.buckets.acquire(9), 0)
+        # User 1 lost their (empty) bucket to user 9, so they get a new one.
+        self.assertEqual(self.buckets.acquire(1), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
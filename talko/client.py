@@ -4,84 +4,407 @@ The clients and servers communicate with each other using the JSON-RPC protocol.
 See the 'protocol' module for what methods the servers support.
 """
 
+import asyncio
 import json
 import socket
 import time
 
+from talko import constants
 from talko import protocol
 from talko import socket_lib
+from talko import tracing
+
+_RECONNECT_DELAY_SECS = .5
+_MAX_CONNECTIONS = 16
+# The AsyncClient methods which can be repeated without side effects, i.e.
+# which are retried when a reused connection drops mid-request.
+_IDEMPOTENT_METHODS = (
+        'GetUser', 'GetChats', 'GetChatIds', 'GetMessages', 'GetUpdates')
+
+
+def _parse_stream_message(message):
+    """Returns the result of a stream message.
+
+    If the message was traced, the result also contains the 'trace', completed
+    with the time the message was received.
+    """
+    received_ms = tracing.now_ms()
+    message = json.loads(message)
+    if 'error' in message:
+        # The server failed to open the stream, see socket_lib.RPCError.
+        raise socket_lib.RPCError.from_json(message['error'])
+    result = message['result']
+    if 'trace' in message:
+        tracing.add_event(message['trace'], 'client.recv', received_ms)
+        result['trace'] = message['trace']
+    return result
 
 
 class Client:
     """A client which exposes methods for communication with the servers."""
 
-    def __init__(self, data_address, broadcast_address):
+    def __init__(self, data_address, broadcast_address, raw=False):
         """Initializes a new Client instance.
         
         Args:
-            data_address: The (host, port) address of the DataServer.
-            broadcast_address: The (host, port) address of the BroadcastServer.
+            data_address: The (host, port) address, or Unix domain socket
+                path, of the DataServer.
+            broadcast_address: The (host, port) address, or Unix domain socket
+                path, of the BroadcastServer.
+            raw: If True, the DataServer methods return the response results as
+                undecoded JSON bytes instead of Python objects. Useful to relay
+                the results (e.g. over HTTP) without re-encoding them.
         """
         self._data_address = data_address
         self._broadcast_address = broadcast_address
+        self._raw = raw
+        # When the last typing notification was sent, per chat_id.
+        self._typing_sent_secs = {}
+
+    def _send_request(self, method, request, raw=None, trace=None):
+        raw = self._raw if raw is None else raw
+        return socket_lib.send_request(
+                method, 
+                request.to_json(), 
+                address=self._data_address, 
+                raw=raw, 
+                trace=trace)
 
-    def open_stream(self, user_id):
+    def open_stream(self, user_id, last_message_id=None, events=False):
         """Opens a new message stream for the given user_id.
 
         WARNING: This function returns a *blocking* generator which yields new
         messages as they are received from the server.
+
+        If the connection to the server drops, the stream is transparently
+        reopened and resumed from the last received message, so no messages
+        are lost in between. Passing 'last_message_id' resumes the stream from
+        that message, i.e. first yields all messages after it.
+
+        If 'events' is True, the stream also yields batches of presence and
+        typing events (see protocol.EventFrame). These have 'presence' and
+        'typing' fields instead of a 'message'.
         """
-        stream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        stream_socket.connect(self._broadcast_address)
-        request = protocol.OpenStreamRequest(user_id)
-        socket_lib.send_request('OpenStreamRequest', request.to_json(),
-                                sock=stream_socket, keep_alive=True)
+        attempt = 0
         while True:
-            message = socket_lib.recv_message(stream_socket)
-            message = json.loads(message)['result']
-            yield message 
+            stream_socket = None
+            try:
+                stream_socket = socket_lib.connect(self._broadcast_address)
+                request = protocol.OpenStreamRequest(
+                        user_id, last_message_id, events)
+                socket_lib.send_request('OpenStreamRequest', request.to_json(),
+                                        sock=stream_socket, keep_alive=True)
+                attempt = 0
+                while True:
+                    message = socket_lib.recv_message(stream_socket)
+                    message = _parse_stream_message(message)
+                    if 'message' in message:
+                        message_id = message['message']['message_id']
+                        if (last_message_id is None or
+                                message_id > last_message_id):
+                            last_message_id = message_id
+                    yield message 
+            except (ConnectionError, ValueError):
+                # The stream dropped, wait a bit before resuming it.
+                time.sleep(_RECONNECT_DELAY_SECS)
+            except socket_lib.RPCError as error:
+                # The server could not open the stream, e.g. because it (or
+                # the DataServer) is overloaded, so back off before retrying.
+                time.sleep(socket_lib.retry_delay(attempt, error))
+                attempt += 1
+            finally:
+                if stream_socket:
+                    stream_socket.close()
 
-    def receive_one_message(self, user_id, timeout=None):
+    def receive_one_message(self, user_id, timeout=None, last_message_id=None):
         """Waits up to 'timeout' seconds to receive a single message.
 
         If 'timeout' is 'None', blocks indefinetly until a message is received. 
         Returns an empty object if 'timeout' is not 'None' and no message is
-        received within the 'timeout' interval.
+        received within the 'timeout' interval. If 'last_message_id' is given,
+        returns the first message after it, even if it was sent before this 
+        call.
         """
-        stream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        stream_socket.settimeout(timeout)
         try:
-            stream_socket.connect(self._broadcast_address)
-            request = protocol.OpenStreamRequest(user_id)
+            stream_socket = socket_lib.connect(
+                    self._broadcast_address, timeout)
+        except socket.timeout:
+            return {}
+        try:
+            request = protocol.OpenStreamRequest(user_id, last_message_id)
             socket_lib.send_request('OpenStreamRequest', request.to_json(),
                                     sock=stream_socket, keep_alive=True)
             message = socket_lib.recv_message(stream_socket)
-            return json.loads(message)['result']
+            return _parse_stream_message(message)
         except socket.timeout:
             return {}
         finally:
             stream_socket.close()
 
+    def send_typing(self, chat_id, user_id):
+        """Tells the other (online) chat members that the user is typing.
+
+        Can be called on every keystroke: Notifications are only sent once
+        every TYPING_INTERVAL_SECS per chat.
+        """
+        now = time.monotonic()
+        last_sent_secs = self._typing_sent_secs.get(chat_id)
+        if (last_sent_secs is not None and
+                now - last_sent_secs < constants.TYPING_INTERVAL_SECS):
+            return
+        self._typing_sent_secs[chat_id] = now
+        request = protocol.TypingRequest(chat_id, user_id)
+        socket_lib.send_request(
+                'TypingRequest',
+                request.to_json(), 
+                address=self._broadcast_address)
+
     def get_user(self, user_id):
         request = protocol.GetUserRequest(user_id)
-        response = socket_lib.send_request(
-                'GetUser', request.to_json(), address=self._data_address)
-        return response
-
-    def get_chats(self, user_id):
-        request = protocol.GetChatsRequest(user_id)
-        response = socket_lib.send_request(
-                'GetChats', request.to_json(), address=self._data_address)
-        return response
-
-    def get_messages(self, chat_id):
-        request = protocol.GetMessagesRequest(chat_id)
-        response = socket_lib.send_request(
-                'GetMessages', request.to_json(), address=self._data_address)
-        return response
-
-    def insert_message(self, chat_id, user_id, message_text):
+        return self._send_request('GetUser', request)
+
+    def get_chats(self, user_id, messages_limit=None):
+        request = protocol.GetChatsRequest(user_id, messages_limit)
+        return self._send_request('GetChats', request)
+
+    def get_chat_ids(self, user_id):
+        request = protocol.GetChatIdsRequest(user_id)
+        return self._send_request('GetChatIds', request)
+
+    def get_messages(self, chat_id, before_message_id=None, limit=None):
+        request = protocol.GetMessagesRequest(chat_id, before_message_id, limit)
+        return self._send_request('GetMessages', request)
+
+    def sync(self, user_id, cursor=None):
+        """Returns all changes for the user_id since the given cursor.
+
+        The response contains the new messages, new chats and chats whose 
+        participants changed since the cursor, along with the 'next_cursor' to
+        pass to the following sync() call. If 'cursor' is 'None', returns all
+        changes, i.e. the user's full history. If the response 'has_more',
+        sync() should be called again immediately with the 'next_cursor'.
+
+        The response only contains the messages after the cursor, including
+        for the chats the user joined since the cursor. These are listed in 
+        'joined_chat_ids' and their earlier history must be loaded with
+        get_messages().
+        """
+        cursor = protocol.Cursor.from_json(cursor or {})
+        request = protocol.GetUpdatesRequest(user_id, cursor)
+        return self._send_request('GetUpdates', request)
+
+    def insert_message(self, chat_id, user_id, message_text, trace=False):
+        """Inserts a new message into the chat and broadcasts it.
+
+        If 'trace' is True, the message is traced through the servers and
+        delivered to its receivers along with the trace. See the tracing 
+        module.
+        """
+        request = protocol.InsertMessageRequest(chat_id, user_id, message_text)
+        trace = tracing.new_trace() if trace else None
+        tracing.add_event(trace, 'client.send')
+        return self._send_request('InsertMessage', request, trace=trace)
+
+    def get_version(self, user_id=None, chat_id=None):
+        """Returns the version of the user's chats or of a single chat.
+
+        The version only changes when the chats change, so it can be used to
+        check whether a previous get_chats() (or get_messages()) response is
+        still up to date. The response is always decoded, even if 'raw'.
+        """
+        request = protocol.GetVersionRequest(user_id, chat_id)
+        return self._send_request('GetVersion', request, raw=False)
+
+    def get_pool_stats(self):
+        request = protocol.GetPoolStatsRequest()
+        return self._send_request('GetPoolStats', request)
+
+    def get_stats(self):
+        """Returns the DataServer's metrics, always decoded.
+        
+        See metrics.Metrics.snapshot() for the response format.
+        """
+        request = protocol.GetStatsRequest()
+        return self._send_request('GetStats', request, raw=False)
+
+    def _send_admin_request(self, method, request, broadcast):
+        address = self._broadcast_address if broadcast else self._data_address
+        return socket_lib.send_request(
+                method, request.to_json(), address=address)
+
+    def get_broadcast_stats(self):
+        """Returns the BroadcastServer's metrics, like get_stats()."""
+        request = protocol.GetStatsRequest()
+        return self._send_admin_request('GetStats', request, broadcast=True)
+
+    def set_profiling(self, sample_rate, mode='cprofile', broadcast=False):
+        """Profiles 'sample_rate' of the server's requests, 0 turns it off.
+
+        Profiles the DataServer, or the BroadcastServer if 'broadcast'. See
+        the profiling module for the supported modes.
+        """
+        request = protocol.SetProfilingRequest(sample_rate, mode)
+        return self._send_admin_request('SetProfiling', request, broadcast)
+
+    def dump_profiles(self, broadcast=False):
+        """Merges the server's profiles into one file per method."""
+        request = protocol.DumpProfilesRequest()
+        return self._send_admin_request('DumpProfiles', request, broadcast)
+
+
+class AsyncClient:
+    """An asyncio version of the Client.
+
+    Unlike the Client, the AsyncClient keeps persistent connections to the
+    DataServer around and reuses them across requests. Up to 'max_connections'
+    requests can be in flight at the same time, further requests wait for a 
+    connection to free up. All methods must be called from the same event 
+    loop.
+    """
+
+    def __init__(self, data_address, broadcast_address, max_connections=None):
+        """Initializes a new AsyncClient instance.
+        
+        Args:
+            data_address: See Client.
+            broadcast_address: See Client.
+            max_connections: The maximum number of concurrent connections to
+                the DataServer.
+        """
+        self._data_address = data_address
+        self._broadcast_address = broadcast_address
+        self._max_connections = max_connections or _MAX_CONNECTIONS
+        # NOTE(eugenhotaj): The semaphore is created lazily so that it binds
+        # to the running event loop, not whichever loop exists at __init__.
+        self._semaphore = None
+        self._idle_connections = []
+
+    async def _send_request(self, method, request, trace=None):
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self._max_connections)
+        attempt = 0
+        while True:
+            try:
+                return await self._send_request_once(method, request, trace)
+            except socket_lib.OverloadedError as error:
+                if attempt == socket_lib.MAX_RETRIES:
+                    raise
+                await asyncio.sleep(socket_lib.retry_delay(attempt, error))
+                attempt += 1
+
+    async def _send_request_once(self, method, request, trace):
+        async with self._semaphore:
+            while True:
+                reused = bool(self._idle_connections)
+                if reused:
+                    reader, writer = self._idle_connections.pop()
+                    if reader.at_eof():
+                        # Draining servers close idle connections without
+                        # reading any more requests from them, e.g. while
+                        # restarting, so try the next one.
+                        writer.close()
+                        continue
+                else:
+                    reader, writer = await socket_lib.open_connection_async(
+                            self._data_address)
+                completed = False
+                try:
+                    response = await socket_lib.send_request_async(
+                            method, request.to_json(), reader, writer, trace)
+                    completed = True
+                except ConnectionError:
+                    # The connection may also have been closed after the 
+                    # server read the request, so only retry the requests
+                    # which are safe to repeat.
+                    if reused and method in _IDEMPOTENT_METHODS:
+                        continue
+                    raise
+                finally:
+                    # NOTE(eugenhotaj): Connections are only reused once the
+                    # full response was read. Connections rejected by an
+                    # overloaded server are closed by the server and 
+                    # interrupted (e.g. cancelled) requests leave the response
+                    # unread, so we never reuse a connection after an error.
+                    if completed:
+                        self._idle_connections.append((reader, writer))
+                    else:
+                        writer.close()
+                return response
+
+    async def open_stream(self, user_id, last_message_id=None, events=False):
+        """Opens a new message stream for the given user_id.
+
+        Returns an async generator which yields new messages as they are 
+        received from the server, i.e. use as:
+
+            async for message in client.open_stream(user_id):
+                ...
+
+        Like Client.open_stream(), the stream is resumed from the last received
+        message if the connection to the server drops, and also yields presence
+        and typing events if 'events' is True.
+        """
+        attempt = 0
+        while True:
+            writer = None
+            try:
+                reader, writer = await socket_lib.open_connection_async(
+                        self._broadcast_address)
+                request = protocol.OpenStreamRequest(
+                        user_id, last_message_id, events)
+                await socket_lib.send_request_async(
+                        'OpenStreamRequest', request.to_json(), reader, writer)
+                attempt = 0
+                while True:
+                    message = await socket_lib.recv_message_async(reader)
+                    message = _parse_stream_message(message)
+                    if 'message' in message:
+                        message_id = message['message']['message_id']
+                        if (last_message_id is None or
+                                message_id > last_message_id):
+                            last_message_id = message_id
+                    yield message
+            except (ConnectionError, ValueError):
+                await asyncio.sleep(_RECONNECT_DELAY_SECS)
+            except socket_lib.RPCError as error:
+                await asyncio.sleep(socket_lib.retry_delay(attempt, error))
+                attempt += 1
+            finally:
+                if writer:
+                    writer.close()
+
+    async def close(self):
+        """Closes all the idle connections to the DataServer."""
+        while self._idle_connections:
+            _, writer = self._idle_connections.pop()
+            writer.close()
+
+    async def get_user(self, user_id):
+        request = protocol.GetUserRequest(user_id)
+        return await self._send_request('GetUser', request)
+
+    async def get_chats(self, user_id, messages_limit=None):
+        request = protocol.GetChatsRequest(user_id, messages_limit)
+        return await self._send_request('GetChats', request)
+
+    async def get_chat_ids(self, user_id):
+        request = protocol.GetChatIdsRequest(user_id)
+        return await self._send_request('GetChatIds', request)
+
+    async def get_messages(self, chat_id, before_message_id=None, limit=None):
+        request = protocol.GetMessagesRequest(chat_id, before_message_id, limit)
+        return await self._send_request('GetMessages', request)
+
+    async def sync(self, user_id, cursor=None):
+        """See Client.sync()."""
+        cursor = protocol.Cursor.from_json(cursor or {})
+        request = protocol.GetUpdatesRequest(user_id, cursor)
+        return await self._send_request('GetUpdates', request)
+
+    async def insert_message(self, chat_id, user_id, message_text, 
+                             trace=False):
+        """See Client.insert_message()."""
         request = protocol.InsertMessageRequest(chat_id, user_id, message_text)
-        response = socket_lib.send_request(
-                'InsertMessage', request.to_json(), address=self._data_address)
-        return response
+        trace = tracing.new_trace() if trace else None
+        tracing.add_event(trace, 'client.send')
+        return await self._send_request('InsertMessage', request, trace)
@@ -0,0 +1,192 @@
+"""Tests of the AsyncClient's connection handling.
+
+The AsyncClient talks to a fake DataServer which answers GetUser and
+InsertMessage requests, and can be told to drop connections in between.
+Run from the repository root with 'python -m unittest talko.client_test'.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from talko import client as client_lib
+from talko import socket_lib
+
+# How long to wait for the fake server before failing the test.
+_TIMEOUT_SECS = 10
+_USER = {'user_id': 1, 'user_name': 'Alice'}
+
+
+def _async_test(test):
+    """Runs the coroutine test method in a new event loop."""
+    @functools.wraps(test)
+    def run(self):
+        asyncio.run(asyncio.wait_for(test(self), _TIMEOUT_SECS))
+    return run
+
+
+class _FakeDataServer:
+    """Responds to requests, unless told to hang up or not to respond."""
+
+    def __init__(self, address):
+        self.address = address
+        self.methods = []
+        self.n_connections = 0
+        # Hang up on the next request, after reading it.
+        self.hang_up = False
+        # Hang up on the next connection after responding.
+        self.close_idle = False
+        # Don't respond to requests and set 'closed' once the client hangs up.
+        self.stall = False
+        self.closed = asyncio.Event()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(
+                self._serve, self.address)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.n_connections += 1
+        try:
+            while True:
+                request = json.loads(
+                        await socket_lib.recv_message_async(reader))
+                self.methods.append(request['method'])
+                if self.stall:
+                    await reader.read()
+                    self.closed.set()
+                    return
+                if self.hang_up:
+                    self.hang_up = False
+                    return
+                if request['method'] == 'GetUser':
+                    result = {'user': _USER}
+                else:
+                    result = {'message': request['params']}
+                response = {'result': result, 'id': request['id']}
+                await socket_lib.send_message_async(
+                        writer, json.dumps(response))
+                if self.close_idle:
+                    self.close_idle = False
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class ParseStreamMessageTest(unittest.TestCase):
+
+    def test_error_frames_raise(self):
+        error = socket_lib.OverloadedError(.5)
+        message = json.dumps(socket_lib.encode_error(error, 1))
+
+        with self.assertRaises(socket_lib.OverloadedError):
+            client_lib._parse_stream_message(message)
+
+
+class AsyncClientTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.address = os.path.join(tmp_dir, 'data.sock')
+
+    async def start(self):
+        server = _FakeDataServer(self.address)
+        await server.start()
+        client = client_lib.AsyncClient(self.address, None)
+        return server, client
+
+    async def stop(self, server, client):
+        await client.close()
+        await server.stop()
+
+    @_async_test
+    async def test_reuses_connections(self):
+        server, client = await self.start()
+        for _ in range(3):
+            response = await client.get_user(1)
+            self.assertEqual(response['user'], _USER)
+        self.assertEqual(server.n_connections, 1)
+        await self.stop(server, client)
+
+    @_async_test
+    async def test_concurrent_requests_use_separate_connections(self):
+        server, client = await self.start()
+        responses = await asyncio.gather(
+                client.get_user(1), client.get_user(1))
+        self.assertEqual(responses, [{'user': _USER}] * 2)
+        self.assertEqual(server.n_connections, 2)
+        await self.stop(server, client)
+
+    @_async_test
+    async def test_skips_connections_closed_while_idle(self):
+        server, client = await self.start()
+        server.close_idle = True
+        await client.get_user(1)
+        # Wait for the client to see the server hang up.
+        while not client._idle_connections[0][0].at_eof():
+            await asyncio.sleep(.01)
+
+        response = await client.insert_message(1, 1, 'Once')
+        self.assertEqual(response['message']['message_text'], 'Once')
+        self.assertEqual(server.methods, ['GetUser', 'InsertMessage'])
+        self.assertEqual(server.n_connections, 2)
+        await self.stop(server, client)
+
+    @_async_test
+    async def test_retries_reads_on_dropped_connections(self):
+        server, client = await self.start()
+        await client.get_user(1)
+        server.hang_up = True
+
+        response = await client.get_user(1)
+        self.assertEqual(response['user'], _USER)
+        self.assertEqual(server.methods, ['GetUser'] * 3)
+        await self.stop(server, client)
+
+    @_async_test
+    async def test_does_not_retry_writes_on_dropped_connections(self):
+        server, client = await self.start()
+        await client.get_user(1)
+        server.hang_up = True
+
+        with self.assertRaises(ConnectionError):
+            await client.insert_message(1, 1, 'Once')
+        self.assertEqual(server.methods, ['GetUser', 'InsertMessage'])
+        self.assertEqual(client._idle_connections, [])
+        await self.stop(server, client)
+
+    @_async_test
+    async def test_cancelled_request_closes_the_connection(self):
+        server, client = await self.start()
+        server.stall = True
+        writers = []
+        open_connection_async = socket_lib.open_connection_async
+        async def open_connection(address):
+            reader, writer = await open_connection_async(address)
+            writers.append(writer)
+            return reader, writer
+
+        with mock.patch.object(
+                socket_lib, 'open_connection_async', open_connection):
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.get_user(1), .1)
+        self.assertTrue(writers[0].is_closing())
+        self.assertEqual(client._idle_connections, [])
+        await server.closed.wait()
+        await self.stop(server, client)
+
+
+if __name__ == '__main__':
+    unittest.main()
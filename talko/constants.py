@@ -5,4 +5,12 @@ import socket
 LOCALHOST = socket.gethostname()
 BROADCAST_PORT = 8888
 DATA_PORT = 8889
+# The socket file names used when the servers listen on Unix domain sockets.
+BROADCAST_SOCKET = 'broadcast.sock'
+DATA_SOCKET = 'data.sock'
 MILLIS_PER_SEC = 1000
+# Clients send at most one typing notification per chat every
+# TYPING_INTERVAL_SECS while the user types, and show a user as typing for
+# TYPING_TIMEOUT_SECS after their last notification.
+TYPING_INTERVAL_SECS = 2
+TYPING_TIMEOUT_SECS = 4
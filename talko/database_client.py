@@ -1,6 +1,9 @@
 """Module which provides communication with the database."""
 
+import contextlib
 import dataclasses
+import multiprocessing
+from multiprocessing import connection as mp_connection
 import os
 import sqlite3
 
@@ -44,44 +47,83 @@ def create_database(db_path, overwrite=False):
             return
         os.remove(db_path)
     sql = open('talko/schema.sql', 'r').read()
-    connection = sqlite3.connect(db_path)
-    with connection:
-        connection.executescript(sql)
+    # NOTE(eugenhotaj): The connection must be closed before returning, since
+    # processes forked while it's open (e.g. the servers) would otherwise
+    # inherit it and lose their locks on the database once they close it.
+    with contextlib.closing(sqlite3.connect(db_path)) as connection:
+        with connection:
+            connection.executescript(sql)
 
 
 class DatabaseClient:
     """A client which handles communications with the database."""
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_only=False):
         """Initializes a new DatabaseClient instance.
 
         Args:
             db_path: The path to the SQLite database.
+            read_only: If True, opens the database with a 'mode=ro' URI. Any
+                attempt to write through this client will fail.
         """
         self._path = db_path
-        self._connection = sqlite3.connect(db_path)
+        if read_only:
+            uri = f'file:{db_path}?mode=ro'
+            self._connection = sqlite3.connect(uri, uri=True)
+        else:
+            self._connection = sqlite3.connect(db_path)
+            # NOTE(eugenhotaj): WAL mode is persistent, but databases created
+            # before schema.sql turned it on would otherwise never switch.
+            # Read-only connections can not change the journal mode.
+            self._connection.execute('PRAGMA journal_mode = WAL')
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """Runs all reads inside the block against one consistent snapshot.
+
+        The database runs in WAL mode, so an open read transaction sees the
+        database as it was when the transaction started and never blocks (nor
+        is blocked by) the writer.
+        """
+        self._connection.execute('BEGIN')
+        try:
+            yield self
+        finally:
+            self._connection.rollback()
 
     def get_user(self, user_id):
         """Returns the users with the given user_ids."""
         query = f'SELECT * FROM Users WHERE user_id = ?'
-        with self._connection:
-            cursor = self._connection.execute(query, (user_id,))
+        cursor = self._connection.execute(query, (user_id,))
         return User(*cursor.fetchone())
 
     def insert_user(self, user_name):
         """Inserts a new user into the Users table."""
-        query = 'INSERT INTO Users (user_id, user_name) VALUES (?, ?)'
+        query = 'INSERT INTO Users (user_name) VALUES (?)'
         with self._connection:
-            cursor = self._connection.execute(query, (user_id, user_name))
+            cursor = self._connection.execute(query, (user_name,))
         return User(cursor.lastrowid, user_name)
 
+    def get_users(self, user_ids):
+        """Returns the users with the given user_ids."""
+        user_ids = list(user_ids)
+        placeholders = ', '.join('?' * len(user_ids))
+        query = f'SELECT * FROM Users WHERE user_id IN ({placeholders})'
+        cursor = self._connection.execute(query, user_ids)
+        return [User(*row) for row in cursor.fetchall()]
+
+    def get_chat(self, chat_id):
+        """Returns the chat with the given chat_id."""
+        query = 'SELECT chat_id, chat_name FROM Chats WHERE chat_id = ?'
+        cursor = self._connection.execute(query, (chat_id,))
+        return Chat(*cursor.fetchone())
+
     def get_chats(self, user_id):
         """Returns all chats the user is participating in."""
         query = """SELECT Chats.chat_id, chat_name 
             FROM Chats JOIN Participants ON Chats.chat_id = Participants.chat_id
             WHERE user_id = ?"""
-        with self._connection:
-            cursor = self._connection.execute(query, (user_id,))
+        cursor = self._connection.execute(query, (user_id,))
         return [Chat(*row) for row in cursor.fetchall()]
 
     def get_participants(self, chat_id):
@@ -89,8 +131,7 @@ class DatabaseClient:
         query = """SELECT Users.user_id, user_name 
             FROM Users JOIN Participants ON Users.user_id = Participants.user_id
             WHERE chat_id = ?"""
-        with self._connection:
-            cursor = self._connection.execute(query, (chat_id,))
+        cursor = self._connection.execute(query, (chat_id,))
         return [User(*row) for row in cursor.fetchall()]
 
     def get_private_chat_id(self, user1_id, user2_id):
@@ -98,12 +139,11 @@ class DatabaseClient:
         query = f"""SELECT Participants.chat_id, user_id 
             FROM Participants JOIN  Chats ON Participants.chat_id = Chats.chat_id
             WHERE is_private = True AND user_id IN (?, ?)"""
-        with self._connection:
-            cursor = self._connection.execute(query, (user1_id, user2_id))
+        cursor = self._connection.execute(query, (user1_id, user2_id))
         user_to_chats = {user1_id: set(), user2_id: set()}
         for chat_id, user_id in cursor.fetchall():
             user_to_chats[user_id].add(chat_id)
-        private_chat = list(user_to_chats[0] & user_to_chats[1])
+        private_chat = list(user_to_chats[user1_id] & user_to_chats[user2_id])
         assert len(private_chat) <= 1
         return private_chat[0] if private_chat else None
 
@@ -124,13 +164,102 @@ class DatabaseClient:
 
         return Chat(chat_id, chat_name)
 
-    def get_messages(self, chat_id):
-        """Returns all messages for the chat with given chat_id."""
-        query = 'SELECT * FROM Messages WHERE chat_id = ? ORDER BY message_ts'
-        with self._connection:
-            cursor = self._connection.execute(query, (chat_id,))
+    def get_messages(self, chat_id, before_message_id=None, limit=None):
+        """Returns messages for the chat with given chat_id.
+
+        Args:
+            chat_id: The id of the chat.
+            before_message_id: If given, only returns messages older than it.
+            limit: If given, only returns up to this many of the newest 
+                messages (before 'before_message_id').
+        Returns:
+            The messages, oldest first.
+        """
+        query = 'SELECT * FROM Messages WHERE chat_id = ?'
+        params = [chat_id]
+        if before_message_id is not None:
+            query += ' AND message_id < ?'
+            params.append(before_message_id)
+        if limit is None:
+            query += ' ORDER BY message_id'
+        else:
+            query += ' ORDER BY message_id DESC LIMIT ?'
+            params.append(limit)
+        cursor = self._connection.execute(query, params)
+        messages = [Message(*row) for row in cursor.fetchall()]
+        if limit is not None:
+            messages.reverse()
+        return messages
+
+    def get_messages_since(self, user_id, message_id, limit):
+        """Returns up to limit messages newer than message_id.
+
+        Only messages in chats the user is participating in are returned, in
+        message_id order.
+        """
+        query = """SELECT * FROM Messages 
+            WHERE message_id > ? AND chat_id IN 
+                (SELECT chat_id FROM Participants WHERE user_id = ?)
+            ORDER BY message_id LIMIT ?"""
+        cursor = self._connection.execute(query, (message_id, user_id, limit))
         return [Message(*row) for row in cursor.fetchall()]
 
+    def get_chat_ids_changed_since(self, user_id, participant_id):
+        """Returns the user's chats which gained participants since the id.
+
+        This includes chats which the user themselves joined since the
+        participant_id.
+        """
+        query = """SELECT DISTINCT chat_id FROM Participants 
+            WHERE participant_id > ? AND chat_id IN 
+                (SELECT chat_id FROM Participants WHERE user_id = ?)"""
+        cursor = self._connection.execute(query, (participant_id, user_id))
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_chat_ids_joined_since(self, user_id, participant_id):
+        """Returns the chats which the user joined since the participant_id."""
+        query = """SELECT chat_id FROM Participants 
+            WHERE user_id = ? AND participant_id > ?"""
+        cursor = self._connection.execute(query, (user_id, participant_id))
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_max_ids(self):
+        """Returns the largest (message_id, participant_id) in the database."""
+        query = """SELECT 
+            (SELECT IFNULL(MAX(message_id), 0) FROM Messages), 
+            (SELECT IFNULL(MAX(participant_id), 0) FROM Participants)"""
+        cursor = self._connection.execute(query)
+        return cursor.fetchone()
+
+    def get_chat_version(self, chat_id):
+        """Returns the largest (message_id, participant_id) in the chat.
+
+        The version changes whenever a message or participant is added to the
+        chat. Both lookups are a single index seek.
+        """
+        query = """SELECT 
+            (SELECT IFNULL(MAX(message_id), 0) FROM Messages 
+                WHERE chat_id = ?), 
+            (SELECT IFNULL(MAX(participant_id), 0) FROM Participants 
+                WHERE chat_id = ?)"""
+        cursor = self._connection.execute(query, (chat_id, chat_id))
+        return cursor.fetchone()
+
+    def get_user_version(self, user_id):
+        """Returns the largest (message_id, participant_id) in the user's chats.
+
+        The version changes whenever a message or participant is added to any
+        of the user's chats.
+        """
+        query = """SELECT 
+            IFNULL(MAX((SELECT MAX(message_id) FROM Messages 
+                WHERE Messages.chat_id = UserChats.chat_id)), 0),
+            IFNULL(MAX((SELECT MAX(participant_id) FROM Participants 
+                WHERE Participants.chat_id = UserChats.chat_id)), 0)
+            FROM Participants AS UserChats WHERE UserChats.user_id = ?"""
+        cursor = self._connection.execute(query, (user_id,))
+        return cursor.fetchone()
+
     def insert_message(self, chat_id, user_id, message_text, message_ts):
         """Inserts a new message."""
         query = """INSERT INTO 
@@ -141,3 +270,90 @@ class DatabaseClient:
                     query, (chat_id, user_id, message_text, message_ts))
         return Message(
                 cursor.lastrowid, chat_id, user_id, message_text, message_ts)
+
+
+class ConnectionPool:
+    """A pool of processes which each own a DatabaseClient.
+
+    Work is submitted to the pool as a picklable function which is run inside
+    one of the pool processes as fn(db_client, *args). Work submitted to a pool
+    of size 1 is therefore fully serialized, which is how we run the single
+    database writer. Read-only pools run each function inside a snapshot() so
+    all the reads it makes are consistent with each other.
+    """
+
+    def __init__(self, db_path, size=1, read_only=False, backlog=1024,
+                 profiler=None):
+        """Initializes a new ConnectionPool instance and starts its processes.
+
+        Args:
+            db_path: The path to the SQLite database.
+            size: The number of processes (i.e. connections) in the pool.
+            read_only: Whether the pool connections are read-only.
+            backlog: The number of submitted functions which can be waiting
+                for a free process before new submissions block.
+            profiler: If given, the profiling.Profiler which profiles the
+                functions run in the pool, named after the function.
+        """
+        self._read_only = read_only
+        self._profiler = profiler
+        self._listener = mp_connection.Listener(
+                family='AF_UNIX', backlog=backlog)
+        self._address = self._listener.address
+        self._pending = multiprocessing.Value('i', 0)
+        self._active = multiprocessing.Value('i', 0)
+        for _ in range(size):
+            worker = multiprocessing.Process(
+                    target=self._serve_forever, args=(db_path,), daemon=True)
+            worker.start()
+
+    @property
+    def queue_depth(self):
+        """The number of submitted functions waiting for a free process."""
+        return max(self._pending.value - self._active.value, 0)
+
+    @property
+    def active(self):
+        """The number of functions currently running in the pool."""
+        return self._active.value
+
+    def run(self, fn, *args):
+        """Runs fn(db_client, *args) in the pool and returns its result."""
+        _add(self._pending, 1)
+        try:
+            with mp_connection.Client(self._address) as conn:
+                conn.send((fn, args))
+                result, error = conn.recv()
+        finally:
+            _add(self._pending, -1)
+        if error:
+            raise error
+        return result
+
+    def _serve_forever(self, db_path):
+        db_client = DatabaseClient(db_path, read_only=self._read_only)
+        while True:
+            with self._listener.accept() as conn:
+                fn, args = conn.recv()
+                _add(self._active, 1)
+                profile = None
+                if self._profiler:
+                    profile = self._profiler.start(fn.__name__)
+                try:
+                    if self._read_only:
+                        with db_client.snapshot():
+                            result = fn(db_client, *args)
+                    else:
+                        result = fn(db_client, *args)
+                    conn.send((result, None))
+                except Exception as e:
+                    conn.send((None, e))
+                finally:
+                    if profile:
+                        profile.stop()
+                    _add(self._active, -1)
+
+
+def _add(value, delta):
+    with value.get_lock():
+        value.value += delta
@@ -0,0 +1,111 @@
+"""Tests of the DatabaseClient and the read/write split ConnectionPools.
+
+Run from the repository root with
+'python -m unittest talko.database_client_test'.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from talko import database_client
+
+
+# The functions below are run inside the ConnectionPools, so they must be
+# defined at the module level in order to be picklable.
+def _count_messages(db_client):
+    return len(db_client.get_messages(1, limit=1000))
+
+
+def _insert_message(db_client, message_text):
+    return db_client.insert_message(1, 1, message_text, 0).message_id
+
+
+def _insert_user(db_client, user_name):
+    return db_client.insert_user(user_name)
+
+
+def _journal_mode(db_client):
+    return db_client._connection.execute('PRAGMA journal_mode').fetchone()[0]
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.db_path = os.path.join(tmp_dir, 'talko.db')
+        database_client.create_database(self.db_path)
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            with connection:
+                connection.executescript("""
+                    INSERT INTO Users (user_name) VALUES ("Alice");
+                    INSERT INTO Chats (chat_name, is_private)
+                        VALUES ("Notes", 0);
+                    INSERT INTO Participants (chat_id, user_id) VALUES (1, 1);
+                """)
+
+    def new_pool(self, **kwargs):
+        """Returns a new ConnectionPool whose processes the test cleans up."""
+        children = set(multiprocessing.active_children())
+        pool = database_client.ConnectionPool(self.db_path, **kwargs)
+        for process in set(multiprocessing.active_children()) - children:
+            self.addCleanup(process.join)
+            self.addCleanup(process.terminate)
+        return pool
+
+
+class DatabaseClientTest(DatabaseTestCase):
+
+    def test_snapshot_does_not_see_later_writes(self):
+        reader = database_client.DatabaseClient(self.db_path, read_only=True)
+        writer = database_client.DatabaseClient(self.db_path)
+        writer.insert_message(1, 1, 'Before', 0)
+
+        with reader.snapshot():
+            self.assertEqual(len(reader.get_messages(1)), 1)
+            # WAL mode lets the writer commit while the snapshot is open.
+            writer.insert_message(1, 1, 'During', 0)
+            self.assertEqual(len(reader.get_messages(1)), 1)
+        self.assertEqual(len(reader.get_messages(1)), 2)
+
+    def test_read_only_client_rejects_writes(self):
+        reader = database_client.DatabaseClient(self.db_path, read_only=True)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.insert_user('Mallory')
+
+    def test_writer_enables_wal_on_old_databases(self):
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            connection.execute('PRAGMA journal_mode = DELETE')
+        writer = database_client.DatabaseClient(self.db_path)
+        self.assertEqual(_journal_mode(writer), 'wal')
+
+
+class ConnectionPoolTest(DatabaseTestCase):
+
+    def test_reads_see_committed_writes(self):
+        read_pool = self.new_pool(size=2, read_only=True)
+        write_pool = self.new_pool(size=1)
+
+        message_ids = [
+                write_pool.run(_insert_message, f'Message {i}')
+                for i in range(3)
+        ]
+        self.assertEqual(message_ids, [1, 2, 3])
+        self.assertEqual(read_pool.run(_count_messages), 3)
+        self.assertEqual(read_pool.queue_depth, 0)
+
+    def test_read_pool_raises_on_writes(self):
+        read_pool = self.new_pool(size=1, read_only=True)
+        with self.assertRaises(sqlite3.OperationalError):
+            read_pool.run(_insert_user, 'Mallory')
+        # The pool keeps serving after an error.
+        self.assertEqual(read_pool.run(_count_messages), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
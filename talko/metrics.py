@@ -0,0 +1,144 @@
+"""Lightweight counters, gauges and latency histograms shared across processes.
+
+The servers handle every connection in a separate (forked) process, so metrics
+are stored in a single shared memory array which is allocated before the
+processes fork. All metric names must therefore be declared upfront. Recording
+a metric is a couple of array updates without any locks or syscalls, which
+costs well under a microsecond, so metrics can always stay on.
+
+NOTE(eugenhotaj): Since updates are not synchronized, concurrent updates to the
+same metric from different processes may (rarely) be lost. This is fine for
+monitoring purposes.
+"""
+
+import bisect
+import multiprocessing
+
+# Upper bounds of the histogram buckets, in seconds: 16us, 32us, ..., ~67s.
+# Larger values go into an extra overflow bucket.
+_BUCKET_BOUNDS = tuple(2**i / 1e6 for i in range(4, 27))
+_PERCENTILES = (50, 95, 99)
+_MILLIS_PER_SEC = 1000
+
+
+class Metrics:
+    """A fixed set of named metrics stored in shared memory."""
+
+    def __init__(self, counters=(), gauges=(), histograms=()):
+        """Initializes a new Metrics instance.
+
+        Must be created before forking the processes which record metrics.
+
+        Args:
+            counters: The names of the counters, i.e. values which only go up.
+            gauges: The names of the gauges, i.e. values which are set.
+            histograms: The names of the latency histograms.
+        """
+        self._counters = tuple(counters)
+        self._gauges = tuple(gauges)
+        self._histograms = tuple(histograms)
+        self._offsets = {}
+        size = 0
+        for name in self._counters + self._gauges:
+            self._offsets[name] = size
+            size += 1
+        # Each histogram has a slot per bucket, the overflow bucket and the
+        # sum of all observed values.
+        self._histogram_size = len(_BUCKET_BOUNDS) + 2
+        for name in self._histograms:
+            self._offsets[name] = size
+            size += self._histogram_size
+        self._values = multiprocessing.RawArray('d', size)
+
+    def __contains__(self, name):
+        return name in self._offsets
+
+    def increment(self, name, value=1):
+        """Increments the counter (or gauge) by the given value."""
+        self._values[self._offsets[name]] += value
+
+    def set(self, name, value):
+        """Sets the gauge to the given value."""
+        self._values[self._offsets[name]] = value
+
+    def observe(self, name, secs):
+        """Records a latency (in seconds) in the histogram."""
+        offset = self._offsets[name]
+        self._values[offset + bisect.bisect_left(_BUCKET_BOUNDS, secs)] += 1
+        self._values[offset + self._histogram_size - 1] += secs
+
+    def _summarize(self, name):
+        offset = self._offsets[name]
+        counts = self._values[offset:offset + self._histogram_size - 1]
+        total = sum(counts)
+        summary = {
+                'count': int(total),
+                'sum_ms':
+                    self._values[offset + self._histogram_size - 1] *
+                    _MILLIS_PER_SEC,
+                # The (upper bound in milliseconds, count) of non-empty
+                # buckets. The upper bound of the overflow bucket is 'None'.
+                'buckets': [
+                    [_bucket_bound_ms(i), int(count)]
+                    for i, count in enumerate(counts) if count
+                ],
+        }
+        # Percentiles are estimated by the upper bound of their bucket.
+        for p in _PERCENTILES:
+            summary[f'p{p}_ms'] = None
+            cumulative = 0
+            for i, count in enumerate(counts):
+                cumulative += count
+                if total and cumulative >= p / 100 * total:
+                    summary[f'p{p}_ms'] = _bucket_bound_ms(i)
+                    break
+        return summary
+
+    def snapshot(self):
+        """Returns the current value of all the metrics."""
+        return {
+                'counters': {
+                    name: self._values[self._offsets[name]]
+                    for name in self._counters
+                },
+                'gauges': {
+                    name: self._values[self._offsets[name]]
+                    for name in self._gauges
+                },
+                'histograms': {
+                    name: self._summarize(name) for name in self._histograms
+                },
+        }
+
+
+def _bucket_bound_ms(i):
+    if i == len(_BUCKET_BOUNDS):
+        return None
+    return _BUCKET_BOUNDS[i] * _MILLIS_PER_SEC
+
+
+def _metric_name(prefix, name, suffix=''):
+    # Names of the form 'family.key' are rendered as 'family{key="key"}'.
+    family, _, key = name.partition('.')
+    name = f'{prefix}_{family}{suffix}'
+    return f'{name}{{key="{key}"}}' if key else name
+
+
+def to_text(prefix, snapshot):
+    """Formats a snapshot() in a plain text, one metric per line format."""
+    lines = []
+    for kind in ('counters', 'gauges'):
+        for name, value in snapshot[kind].items():
+            lines.append(f'{_metric_name(prefix, name)} {value:.15g}')
+    for name, summary in snapshot['histograms'].items():
+        lines.append(
+                f'{_metric_name(prefix, name, "_count")} {summary["count"]}')
+        lines.append(
+                f'{_metric_name(prefix, name, "_sum_ms")} '
+                f'{summary["sum_ms"]:.15g}')
+        for p in _PERCENTILES:
+            value = summary[f'p{p}_ms']
+            if value is not None:
+                metric_name = _metric_name(prefix, name, f'_p{p}_ms')
+                lines.append(f'{metric_name} {value:.15g}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,93 @@
+"""Tests of the shared memory metrics and their text format.
+
+Run from the repository root with 'python -m unittest talko.metrics_test'.
+"""
+
+import multiprocessing
+import unittest
+
+from talko import metrics as metrics_lib
+
+
+def _record(metrics):
+    metrics.increment('requests')
+    metrics.observe('rpc.GetUser', .001)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics_lib.Metrics(
+                counters=('requests',),
+                gauges=('workers',),
+                histograms=('rpc.GetUser',))
+
+    def test_snapshot_of_counters_and_gauges(self):
+        self.metrics.increment('requests')
+        self.metrics.increment('requests', 2)
+        self.metrics.set('workers', 5)
+        self.metrics.set('workers', 3)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'requests': 3})
+        self.assertEqual(snapshot['gauges'], {'workers': 3})
+        self.assertIn('requests', self.metrics)
+        self.assertNotIn('errors', self.metrics)
+
+    def test_empty_histogram(self):
+        summary = self.metrics.snapshot()['histograms']['rpc.GetUser']
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['buckets'], [])
+        self.assertIsNone(summary['p50_ms'])
+
+    def test_histogram_percentiles_are_bucket_bounds(self):
+        # 98 fast requests (in the 16us bucket), one in the 1.024ms bucket
+        # and one which overflows all the buckets.
+        for _ in range(98):
+            self.metrics.observe('rpc.GetUser', .00001)
+        self.metrics.observe('rpc.GetUser', .001)
+        self.metrics.observe('rpc.GetUser', 100)
+
+        summary = self.metrics.snapshot()['histograms']['rpc.GetUser']
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['sum_ms'], 100001.98)
+        self.assertEqual(
+                summary['buckets'], [[.016, 98], [1.024, 1], [None, 1]])
+        self.assertEqual(summary['p50_ms'], .016)
+        self.assertEqual(summary['p95_ms'], .016)
+        self.assertEqual(summary['p99_ms'], 1.024)
+
+    def test_metrics_are_shared_with_forked_processes(self):
+        context = multiprocessing.get_context('fork')
+        processes = [
+                context.Process(target=_record, args=(self.metrics,))
+                for _ in range(3)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['counters']['requests'], 3)
+        self.assertEqual(snapshot['histograms']['rpc.GetUser']['count'], 3)
+
+    def test_to_text(self):
+        self.metrics.increment('requests')
+        self.metrics.observe('rpc.GetUser', .001)
+
+        lines = metrics_lib.to_text(
+                'talko', self.metrics.snapshot()).splitlines()
+        self.assertEqual(lines, [
+                'talko_requests 1',
+                'talko_workers 0',
+                'talko_rpc_count{key="GetUser"} 1',
+                'talko_rpc_sum_ms{key="GetUser"} 1',
+                'talko_rpc_p50_ms{key="GetUser"} 1.024',
+                'talko_rpc_p95_ms{key="GetUser"} 1.024',
+                'talko_rpc_p99_ms{key="GetUser"} 1.024',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
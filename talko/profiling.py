@@ -0,0 +1,215 @@
+"""An on-demand profiler for the requests handled by the servers.
+
+Profiling is switched on at runtime, either through the SetProfiling RPC or by
+sending SIGUSR1 to a server, and profiles a sampled fraction of the requests.
+Two modes are supported:
+
+    1. 'cprofile': Deterministic profiling via cProfile. Results are pstats
+        files which can be inspected with the pstats module or snakeviz.
+    2. 'sample': A stack sampler which records the (wall clock) stack of the
+        request every few milliseconds. Results are collapsed stack files which
+        can be turned into flamegraphs with flamegraph.pl or speedscope.
+
+Requests are handled by many (forked) processes, so every profiled request
+writes its own file to the profile_dir. The DumpProfiles RPC (or SIGUSR2) then
+merges them into a single file per RPC method, adding to the results of earlier
+dumps, and deletes them.
+
+The DataServer's connection pools are profiled as well. Their profiles are
+named after the function run in the pool (e.g. '_insert_message') and show the
+time spent in the database, which the RPC's own profile only sees as waiting
+for the pool.
+
+While profiling is disabled, the only cost per request is reading one shared
+memory value.
+"""
+
+import collections
+import cProfile
+import glob
+import multiprocessing
+import os
+import pstats
+import random
+import signal
+
+_MODES = ('cprofile', 'sample')
+_SAMPLE_INTERVAL_SECS = .001
+
+
+def _temp_path(path):
+    """Returns a hidden path to write the file at path to, before moving it.
+
+    Profiles are only moved into place once written, so that dump() never
+    reads (and deletes) half written profiles. The path is unique to the
+    process, since concurrent dumps write the same merged profiles.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.{os.getpid()}')
+
+
+def _read_stacks(path, stacks):
+    """Adds the counts of the collapsed stack file to stacks.
+
+    Returns:
+        Whether the file was read, i.e. False if it does not exist.
+    """
+    try:
+        with open(path) as file_:
+            for line in file_:
+                stack, count = line.rsplit(' ', 1)
+                stacks[stack] += int(count)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class _CProfileSession:
+
+    def __init__(self, path):
+        self._path = path + '.prof'
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        temp_path = _temp_path(self._path)
+        self._profile.dump_stats(temp_path)
+        os.replace(temp_path, self._path)
+
+
+class _SamplerSession:
+
+    def __init__(self, path):
+        self._path = path + '.folded'
+        self._stacks = collections.Counter()
+        signal.signal(signal.SIGALRM, self._sample)
+        signal.setitimer(
+                signal.ITIMER_REAL,
+                _SAMPLE_INTERVAL_SECS,
+                _SAMPLE_INTERVAL_SECS)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame:
+            code = frame.f_code
+            file_name = os.path.basename(code.co_filename)
+            stack.append(f'{code.co_name} ({file_name}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self._stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        temp_path = _temp_path(self._path)
+        with open(temp_path, 'w') as file_:
+            for stack, count in self._stacks.items():
+                file_.write(f'{stack} {count}\n')
+        os.replace(temp_path, self._path)
+
+
+class Profiler:
+    """Profiles a sampled fraction of requests across processes."""
+
+    def __init__(self, profile_dir):
+        """Initializes a new Profiler instance.
+
+        Must be created before forking the processes which handle requests.
+
+        Args:
+            profile_dir: The directory to write the profiles to.
+        """
+        self.profile_dir = profile_dir
+        self._sample_rate = multiprocessing.RawValue('d', 0)
+        self._mode = multiprocessing.RawValue('i', 0)
+        self._n_sessions = 0
+
+    @property
+    def enabled(self):
+        return self._sample_rate.value > 0
+
+    def enable(self, sample_rate, mode='cprofile'):
+        """Profiles 'sample_rate' of the requests. Zero disables profiling."""
+        if mode not in _MODES:
+            raise ValueError(f"'mode' must be one of {_MODES}, got '{mode}'.")
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("'sample_rate' must be between 0 and 1.")
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self._mode.value = _MODES.index(mode)
+        self._sample_rate.value = sample_rate
+
+    def start(self, method):
+        """Starts profiling a request to the method, if it is sampled.
+
+        Returns:
+            The profiling session, which must be stop()ed once the request is
+            handled, or 'None' if the request is not profiled.
+        """
+        sample_rate = self._sample_rate.value
+        if not sample_rate or random.random() >= sample_rate:
+            return None
+        self._n_sessions += 1
+        path = os.path.join(
+                self.profile_dir,
+                f'{method}.{os.getpid()}.{self._n_sessions}')
+        if _MODES[self._mode.value] == 'cprofile':
+            return _CProfileSession(path)
+        return _SamplerSession(path)
+
+    def dump(self):
+        """Merges the profiles of each method into a single file.
+
+        The per-request profiles are deleted once merged, so the profile_dir
+        only grows with the number of profiled methods. Several processes may
+        dump at the same time, so profiles which another dump already merged
+        (and deleted) are skipped.
+
+        Returns:
+            The paths of the merged '<method>.pstats' and '<method>.folded'
+            files.
+        """
+        profiles = collections.defaultdict(list)
+        stacks = collections.defaultdict(collections.Counter)
+        merged = []
+        for path in glob.glob(os.path.join(self.profile_dir, '*.*.*.*')):
+            # The pid, session number and extension never contain dots.
+            method, _, _, extension = os.path.basename(path).rsplit('.', 3)
+            if extension == 'prof':
+                profiles[method].append(path)
+                merged.append(path)
+            elif extension == 'folded':
+                if _read_stacks(path, stacks[method]):
+                    merged.append(path)
+
+        for method, method_profiles in profiles.items():
+            path = os.path.join(self.profile_dir, f'{method}.pstats')
+            stats = None
+            for profile_path in method_profiles + [path]:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profile_path)
+                    else:
+                        stats.add(profile_path)
+                except FileNotFoundError:
+                    pass
+            if stats is not None:
+                temp_path = _temp_path(path)
+                stats.dump_stats(temp_path)
+                os.replace(temp_path, path)
+        for method, method_stacks in stacks.items():
+            path = os.path.join(self.profile_dir, f'{method}.folded')
+            _read_stacks(path, method_stacks)
+            temp_path = _temp_path(path)
+            with open(temp_path, 'w') as file_:
+                for stack, count in method_stacks.items():
+                    file_.write(f'{stack} {count}\n')
+            os.replace(temp_path, path)
+        for path in merged:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        # Per-request profiles written in the meantime end in their number.
+        return sorted(
+                glob.glob(os.path.join(self.profile_dir, '*.pstats')) +
+                glob.glob(os.path.join(self.profile_dir, '*[!0-9].folded')))
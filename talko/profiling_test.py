@@ -0,0 +1,104 @@
+"""Tests of the Profiler's sampling, dumping and merging of profiles.
+
+Run from the repository root with 'python -m unittest talko.profiling_test'.
+"""
+
+import glob
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from talko import profiling
+
+
+def _profile_requests(profiler, method, n_requests):
+    for _ in range(n_requests):
+        session = profiler.start(method)
+        sum(range(1000))
+        session.stop()
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.profiler = profiling.Profiler(self.profile_dir)
+
+    def list_dir(self):
+        return sorted(os.listdir(self.profile_dir))
+
+    def test_disabled_profiler_does_not_profile(self):
+        self.assertFalse(self.profiler.enabled)
+        self.assertIsNone(self.profiler.start('GetUser'))
+
+    def test_invalid_params_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.profiler.enable(.5, mode='bogus')
+        with self.assertRaises(ValueError):
+            self.profiler.enable(2)
+        self.assertFalse(self.profiler.enabled)
+
+    def test_dump_merges_profiles_per_method(self):
+        self.profiler.enable(1)
+        _profile_requests(self.profiler, 'GetUser', 3)
+        _profile_requests(self.profiler, 'GetChats', 1)
+        self.assertEqual(len(self.list_dir()), 4)
+
+        paths = self.profiler.dump()
+
+        self.assertEqual(self.list_dir(), ['GetChats.pstats', 'GetUser.pstats'])
+        self.assertEqual(
+                paths, [os.path.join(self.profile_dir, name)
+                        for name in self.list_dir()])
+        stats = pstats.Stats(os.path.join(self.profile_dir, 'GetUser.pstats'))
+        n_calls = [
+                n_calls
+                for (_, _, name), (_, n_calls, _, _, _) in stats.stats.items()
+                if name == '<built-in method builtins.sum>'
+        ]
+        self.assertEqual(n_calls, [3])
+
+    def test_dump_handles_method_names_with_dots(self):
+        self.profiler.enable(1)
+        _profile_requests(self.profiler, 'Get.User', 1)
+
+        paths = self.profiler.dump()
+        self.assertEqual(
+                paths, [os.path.join(self.profile_dir, 'Get.User.pstats')])
+
+    def test_dump_adds_to_earlier_dumps(self):
+        self.profiler.enable(1, mode='sample')
+        for _ in range(2):
+            session = self.profiler.start('GetUser')
+            session._stacks['main;get_user'] += 2
+            session.stop()
+            self.profiler.dump()
+
+        self.assertEqual(self.list_dir(), ['GetUser.folded'])
+        with open(os.path.join(self.profile_dir, 'GetUser.folded')) as file_:
+            lines = file_.read().splitlines()
+        self.assertIn('main;get_user 4', lines)
+
+    def test_dump_skips_vanished_profiles(self):
+        self.profiler.enable(1)
+        _profile_requests(self.profiler, 'GetUser', 1)
+        # A profile which a concurrent dump merged (and deleted) after we
+        # listed it.
+        vanished = os.path.join(self.profile_dir, 'GetUser.1.1.prof')
+        original_glob = glob.glob
+        def glob_with_vanished(pattern):
+            if pattern.endswith('*.*.*.*'):
+                return original_glob(pattern) + [vanished]
+            return original_glob(pattern)
+        with mock.patch.object(profiling.glob, 'glob', glob_with_vanished):
+            self.profiler.dump()
+
+        self.assertEqual(self.list_dir(), ['GetUser.pstats'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,18 +6,20 @@ Two server types are supported:
 
 The BroadcastServer streams new conversation messages to connected users in 
 real time. Users can only connect or disconnect to the server and listen for
-new messages.
+new messages, as well as for (ephemeral) presence and typing events.
 
 The DataServer reads and writes data into the database. It communicates with
 clients via standard request/response based protocol.
 """
 
 import dataclasses
-from typing import List
+from typing import Any, Dict, List, Optional
 
 
 def _parse_field(type_, value):
-    return type_.from_json(value) if isinstance(value, dict) else value
+    if isinstance(value, dict) and hasattr(type_, 'from_json'):
+        return type_.from_json(value)
+    return value
 
 
 class _Serializable:
@@ -32,6 +34,10 @@ class _Serializable:
         """Creates a new instance from the given JSON object."""
         kwargs = {}
         for field in dataclasses.fields(cls):
+            # Missing fields fall back to their default values, if any. This 
+            # allows adding new (defaulted) fields without breaking old peers.
+            if field.name not in json:
+                continue
             type_, name, value = field.type, field.name, json[field.name]
             if isinstance(value, list):
                 type_ = type_.__args__[0]
@@ -64,11 +70,28 @@ class Chat(_Serializable):
     messages: List[Message]
                     
 
+@dataclasses.dataclass(frozen=True)
+class Cursor(_Serializable):
+    """A position in the (monotonic) history of changes to the database.
+
+    Since messages and participants are only ever inserted, the largest
+    message_id and participant_id a client has seen fully describe which 
+    changes it has already received.
+    """
+    message_id: int = 0
+    participant_id: int = 0
+
+
 # The classes below define the streaming conversation message protocol for the
 # BroadcastServer.
 @dataclasses.dataclass(frozen=True)
 class OpenStreamRequest(_Serializable):
     user_id: int
+    # If given, first replays all messages after this message_id which the
+    # user has not yet received.
+    last_message_id: Optional[int] = None
+    # Whether to also stream EventFrames, see below.
+    events: bool = False
 
 
 @dataclasses.dataclass(frozen=True)
@@ -86,6 +109,42 @@ class CloseStreamResponse(_Serializable):
     pass
 
 
+# A multiplexed stream carries the messages of many users over a single 
+# connection. Once the stream is open, users are added to and removed from it
+# by sending Subscribe and Unsubscribe notifications (i.e. requests without an
+# id, which receive no response) over the same connection.
+@dataclasses.dataclass(frozen=True)
+class OpenMultiplexedStreamRequest(_Serializable):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class OpenMultiplexedStreamResponse(_Serializable):
+    pass
+
+
+# Sent on a multiplexed stream when subscribing a user failed, e.g. because the
+# DataServer is overloaded. The user is no longer subscribed and must be
+# subscribed again to receive their messages.
+@dataclasses.dataclass(frozen=True)
+class SubscribeFailedFrame(_Serializable):
+    receiver_ids: List[int]
+    reason: str
+
+
+@dataclasses.dataclass(frozen=True)
+class SubscribeRequest(_Serializable):
+    user_id: int
+    # See OpenStreamRequest.
+    last_message_id: Optional[int] = None
+    events: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class UnsubscribeRequest(_Serializable):
+    user_id: int
+
+
 @dataclasses.dataclass(frozen=True)
 class BroadcastRequest(_Serializable):
     receiver_ids: List[int]
@@ -97,6 +156,74 @@ class BroadcastResponse(_Serializable):
     pass
 
 
+# Unlike a BroadcastRequest, which lists all of its receivers, a
+# BroadcastChatRequest is addressed to a chat. The BroadcastServer looks up the
+# chat's online members itself, so the request stays small regardless of the
+# chat's size. Receivers still get the message as a BroadcastRequest, with
+# only themselves in the 'receiver_ids'.
+@dataclasses.dataclass(frozen=True)
+class BroadcastChatRequest(_Serializable):
+    chat_id: int
+    message: Message
+
+
+@dataclasses.dataclass(frozen=True)
+class BroadcastChatResponse(_Serializable):
+    pass
+
+
+# Presence and typing events are never stored. The BroadcastServer coalesces
+# them over a short window and then sends each receiver a single EventFrame with
+# all the events for them, so the number of frames does not grow with how fast
+# people type. Users are online while they have a stream open. Streams which
+# ask for events first receive the presence of everyone already online in
+# their chats. A user is typing in a chat for TYPING_TIMEOUT_SECS after the
+# last TypingEvent (see the constants module).
+@dataclasses.dataclass(frozen=True)
+class PresenceEvent(_Serializable):
+    user_id: int
+    online: bool
+
+
+@dataclasses.dataclass(frozen=True)
+class TypingEvent(_Serializable):
+    chat_id: int
+    user_id: int
+
+
+@dataclasses.dataclass(frozen=True)
+class EventFrame(_Serializable):
+    receiver_ids: List[int]
+    presence: List[PresenceEvent]
+    typing: List[TypingEvent]
+
+
+# Clients may send TypingRequests as an RPC or, on multiplexed streams, as a
+# notification.
+@dataclasses.dataclass(frozen=True)
+class TypingRequest(_Serializable):
+    chat_id: int
+    user_id: int
+
+
+@dataclasses.dataclass(frozen=True)
+class TypingResponse(_Serializable):
+    pass
+
+
+# Sent by the DataServer when users join a chat, so that the BroadcastServer
+# starts delivering the chat's messages to them.
+@dataclasses.dataclass(frozen=True)
+class MembershipChangeRequest(_Serializable):
+    chat_id: int
+    user_ids: List[int]
+
+
+@dataclasses.dataclass(frozen=True)
+class MembershipChangeResponse(_Serializable):
+    pass
+
+
 # The classes below define the request/response protocol for the DataServer.
 @dataclasses.dataclass(frozen=True)
 class GetUserRequest(_Serializable):
@@ -121,6 +248,8 @@ class InsertUserResponse(_Serializable):
 @dataclasses.dataclass(frozen=True)
 class GetChatsRequest(_Serializable):
     user_id: int
+    # If given, only returns up to this many of the newest messages per chat.
+    messages_limit: Optional[int] = None
 
 
 @dataclasses.dataclass(frozen=True)
@@ -128,6 +257,16 @@ class GetChatsResponse(_Serializable):
     chats: List[Chat]
 
 
+@dataclasses.dataclass(frozen=True)
+class GetChatIdsRequest(_Serializable):
+    user_id: int
+
+
+@dataclasses.dataclass(frozen=True)
+class GetChatIdsResponse(_Serializable):
+    chat_ids: List[int]
+
+
 @dataclasses.dataclass(frozen=True)
 class InsertChatRequest(_Serializable):
     chat_name: str
@@ -142,6 +281,11 @@ class InsertChatResponse(_Serializable):
 @dataclasses.dataclass(frozen=True)
 class GetMessagesRequest(_Serializable):
     chat_id: int
+    # If given, only returns messages older than this message_id. Together with
+    # 'limit', this allows paging backwards through the chat history.
+    before_message_id: Optional[int] = None
+    # If given, only returns up to this many of the newest messages.
+    limit: Optional[int] = None
 
 
 @dataclasses.dataclass(frozen=True)
@@ -159,3 +303,90 @@ class InsertMessageRequest(_Serializable):
 @dataclasses.dataclass(frozen=True)
 class InsertMessageResponse(_Serializable):
     message: Message
+
+
+@dataclasses.dataclass(frozen=True)
+class GetUpdatesRequest(_Serializable):
+    user_id: int
+    since_cursor: Cursor
+
+
+@dataclasses.dataclass(frozen=True)
+class GetUpdatesResponse(_Serializable):
+    # New chats and chats whose participants changed. The chat messages are not
+    # filled in, new messages are returned separately in 'messages'.
+    chats: List[Chat]
+    messages: List[Message]
+    next_cursor: Cursor
+    # Whether there are more messages after next_cursor.
+    has_more: bool
+    # The chats (also in 'chats') which the user joined since the cursor. Only
+    # their messages after the cursor are returned, so clients must load their
+    # earlier history with GetMessages.
+    joined_chat_ids: List[int] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass(frozen=True)
+class GetVersionRequest(_Serializable):
+    # One, and only one, of user_id or chat_id must be given.
+    user_id: Optional[int] = None
+    chat_id: Optional[int] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class GetVersionResponse(_Serializable):
+    # The latest changes to the user's (or chat's) chats. The version can be 
+    # used as a cheap validator for cached GetChats (or GetMessages) responses.
+    version: Cursor
+
+
+@dataclasses.dataclass(frozen=True)
+class GetPoolStatsRequest(_Serializable):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class GetPoolStatsResponse(_Serializable):
+    read_queue_depth: int
+    read_active: int
+    write_queue_depth: int
+    write_active: int
+
+
+@dataclasses.dataclass(frozen=True)
+class GetStatsRequest(_Serializable):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class GetStatsResponse(_Serializable):
+    # Maps from metric name to the metric value. See metrics.Metrics.snapshot()
+    # for the format of the histograms.
+    counters: Dict[str, float]
+    gauges: Dict[str, float]
+    histograms: Dict[str, Any]
+
+
+@dataclasses.dataclass(frozen=True)
+class SetProfilingRequest(_Serializable):
+    # The fraction of requests to profile, 0 turns profiling off.
+    sample_rate: float
+    # Either 'cprofile' or 'sample'. See the profiling module.
+    mode: str = 'cprofile'
+
+
+@dataclasses.dataclass(frozen=True)
+class SetProfilingResponse(_Serializable):
+    # The directory on the server host where profiles are written to.
+    profile_dir: str
+
+
+@dataclasses.dataclass(frozen=True)
+class DumpProfilesRequest(_Serializable):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class DumpProfilesResponse(_Serializable):
+    # The paths of the merged profile of each method.
+    paths: List[str]
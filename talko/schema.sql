@@ -1,4 +1,6 @@
 PRAGMA foreign_keys = ON;
+-- WAL lets readers run against a snapshot without blocking the writer.
+PRAGMA journal_mode = WAL;
 
 CREATE TABLE Users
   (user_id INTEGER PRIMARY KEY AUTOINCREMENT, 
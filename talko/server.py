@@ -2,20 +2,63 @@
 
 import os
 import argparse
+import collections
 import json
 import logging
 import multiprocessing 
+import select
+import signal
 import socket
+import tempfile
+import threading
 import time
+from multiprocessing import managers
 
+from talko import admission
 from talko import constants
 from talko import database_client 
+from talko import metrics as metrics_lib
+from talko import profiling
 from talko import protocol
 from talko import socket_lib
+from talko import tracing
 
 
 # NOTE(eugenhotaj): We use processes instead of threads to get around the GIL.
 MAX_WORKERS = 10000
+# Connections which arrive while all workers are busy wait in a queue of up to
+# MAX_QUEUE connections for at most QUEUE_TIMEOUT_SECS. Connections which do
+# not fit in the queue, or time out, are rejected with an OverloadedError.
+MAX_QUEUE = 1000
+QUEUE_TIMEOUT_SECS = 1
+# How often the server checks for free workers while connections are queued.
+_QUEUE_POLL_SECS = .01
+# How long clients are asked to wait before retrying rejected connections.
+_RETRY_AFTER_SECS = .1
+# On SIGTERM, servers stop accepting connections and give their workers up to
+# DRAIN_TIMEOUT_SECS to finish the requests in flight.
+DRAIN_TIMEOUT_SECS = 10
+READ_POOL_SIZE = 4
+# Per-user rate limits, as (requests per second, burst size), of writes to the
+# DataServer and of streams opened with the BroadcastServer.
+WRITE_RATE_LIMIT = (10, 50)
+STREAM_RATE_LIMIT = (1, 10)
+# Presence and typing events are coalesced for EVENT_WINDOW_SECS, then sent to
+# each receiver in a single frame which reports up to MAX_TYPING_EVENTS typists
+# per chat. Typing notifications over TYPING_RATE_LIMIT are dropped. Streams
+# which were closed without unsubscribing are detected every SWEEP_SECS.
+EVENT_WINDOW_SECS = .25
+MAX_TYPING_EVENTS = 5
+TYPING_RATE_LIMIT = (1, 5)
+SWEEP_SECS = 5
+# The number of locks which serialize the writes to the BroadcastServer's
+# streams. Streams are spread over the locks, so streams sharing a lock may
+# wait on each other but never interleave.
+_N_SEND_LOCKS = 64
+# The maximum number of messages returned by a single GetUpdates request.
+MAX_UPDATES = 1000
+# The fraction of requests profiled when profiling is turned on via SIGUSR1.
+PROFILE_SAMPLE_RATE = .1
 
 # # TODO(eugenhotaj): Add more robust logging capabilities.
 # os.makedirs('/tmp/talko', exist_ok=True)
@@ -26,27 +69,104 @@ MAX_WORKERS = 10000
 #         format='%(asctime)s %(levelname)s %(pathname)s:%(lineno)s %(message)s', 
 #         datefmt='%m/%d/%Y %I:%M:%S %p')
 
+def _address_name(address):
+    """Returns a short name for the address, i.e. its port or socket file."""
+    if socket_lib.address_family(address) == socket.AF_UNIX:
+        return os.path.basename(address)
+    return address[1]
+
+
+def listen(address):
+    """Returns a new socket which is bound to and listening on the address."""
+    family = socket_lib.address_family(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    else:
+        # Remove the socket file left behind by a previous server, if any.
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+    sock.bind(address)
+    sock.listen()
+    return sock
+
+
 class Server:
     """A Server which can handle concurrent requests via processes.
 
     Requests are processed via the handle_request() method which must be 
     overridden by the subclasses.
+
+    Under overload, the server degrades gracefully instead of dropping
+    connections: Connections wait in a bounded queue for a free worker and are
+    only rejected, with an OverloadedError response telling the client when to
+    retry, once the queue is full or they have waited for too long.
+
+    The server records the latency and errors of each of its _METHODS, along
+    with any extra metrics declared by the subclasses, which are shared by all
+    the worker processes. See stats().
+
+    Requests can also be profiled on demand, see the profiling module. Sending
+    SIGUSR1 to the server toggles profiling and SIGUSR2 dumps the profiles.
+
+    Sending SIGTERM drains the server: It stops accepting connections, closes
+    idle connections and lets its workers finish the requests in flight before
+    exiting. The listening socket may be handed to the server by a supervisor
+    and shared with the next generation of the server, which then takes over
+    without any connections being refused (see the supervisor module).
     """
 
-    def __init__(self, address, max_workers=None):
+    # The JSON-RPC methods handled by the server.
+    _METHODS = ()
+    # Extra metrics recorded by the subclasses.
+    _COUNTERS = ()
+    _GAUGES = ()
+    _HISTOGRAMS = ()
+
+    def __init__(self, address, max_workers=None, max_queue=None,
+                 queue_timeout_secs=None, listen_socket=None):
         """Initializes a new Server instance.
         
         Args:
-            address: The (host, port) tuple address to bind this server to.
+            address: The (host, port) tuple address to bind this server to, or
+                a path to bind a Unix domain socket to.
             max_workers: The total number of workers to use for serving 
                 requests. Requests which exceed the number of available workers
-                are dropped.
+                are queued.
+            max_queue: The maximum number of queued connections.
+            queue_timeout_secs: How long connections may be queued for.
+            listen_socket: A socket which is already listening on the address,
+                e.g. one created by listen() in a supervisor. If 'None', the
+                server binds the address itself.
         """
         self._address = address
         self._max_workers = max_workers or MAX_WORKERS
+        self._max_queue = MAX_QUEUE if max_queue is None else max_queue
+        self._queue_timeout_secs = queue_timeout_secs or QUEUE_TIMEOUT_SECS
+        self._socket = listen_socket
+        # Set once the server starts draining, and read by the workers after
+        # each request.
+        self._draining = multiprocessing.RawValue('b', 0)
+        # Whether the worker is waiting for a (next) request.
+        self._idle = True
+        self._wakeup = None
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self._metrics = metrics_lib.Metrics(
+                counters=(
+                    ('connections.accepted', 'connections.shed',
+                     'rate_limited') +
+                    tuple(f'errors.{method}' for method in self._METHODS) +
+                    self._COUNTERS),
+                gauges=('workers', 'queue') + self._GAUGES,
+                histograms=(
+                    ('queue_wait',) +
+                    tuple(f'rpc.{method}' for method in self._METHODS) + 
+                    self._HISTOGRAMS))
+        self._profiler = profiling.Profiler(os.path.join(
+                tempfile.gettempdir(), 'talko', 'profiles', 
+                f'{type(self).__name__}-{_address_name(address)}'))
 
     def handle_request(self, client_socket):
         """Handles a request. 
@@ -60,13 +180,91 @@ class Server:
         """
         raise NotImplementedError()
 
-    def _handle_request(self, client_socket, host, port):
-        # logging.info(f'Connection from {host}:{port} established')
+    def stats(self):
+        """Returns a snapshot of the server's metrics.
+        
+        Subclasses can override this method to refresh their gauges first.
+        """
+        return self._metrics.snapshot()
+
+    def _set_profiling(self, params):
+        request = protocol.SetProfilingRequest.from_json(params)
+        try:
+            self._profiler.enable(request.sample_rate, request.mode)
+        except ValueError as error:
+            raise socket_lib.RPCError(socket_lib.INVALID_PARAMS, str(error))
+        return protocol.SetProfilingResponse(self._profiler.profile_dir)
+
+    def _dump_profiles(self):
+        return protocol.DumpProfilesResponse(self._profiler.dump())
+
+    def _dump_profiles_on_signal(self, signum, frame):
+        # Runs on the accept loop, which must outlive a failed dump.
+        try:
+            self._profiler.dump()
+        except Exception:
+            logging.exception('Dumping the profiles failed.')
+
+    def _start_profile(self, method):
+        """Starts profiling the request, see profiling.Profiler.start().
+
+        Profiles are named after the method, so requests to unknown methods,
+        whose names may contain any characters, are never profiled.
+        """
+        if method not in self._METHODS:
+            return None
+        return self._profiler.start(method)
+
+    def _toggle_profiling(self, signum, frame):
+        sample_rate = 0 if self._profiler.enabled else PROFILE_SAMPLE_RATE
+        self._profiler.enable(sample_rate)
+
+    def _check_rate_limit(self, limiter, user_id):
+        """Raises an OverloadedError if the user is over the rate limit."""
+        retry_after_secs = limiter.acquire(user_id)
+        if retry_after_secs:
+            self._metrics.increment('rate_limited')
+            raise socket_lib.OverloadedError(retry_after_secs, 'Rate limited')
+
+    def _record_request(self, method, start_secs, failed=False):
+        """Records a request to the method which started at start_secs."""
+        name = f'rpc.{method}'
+        if name not in self._metrics:
+            return
+        self._metrics.observe(name, time.perf_counter() - start_secs)
+        if failed:
+            self._metrics.increment(f'errors.{method}')
+
+    def _start_draining(self, signum, frame):
+        self._draining.value = 1
+        # Wakes up the accept loop.
+        self._wakeup.send(b'\0')
+
+    def _stop_worker(self, signum, frame):
+        # Idle workers exit right away, busy ones once they've responded.
+        if self._idle:
+            raise SystemExit()
+
+    def _request_done(self):
+        """Marks the worker idle, returns whether to keep the connection.
+
+        Subclasses which handle several requests per connection must call this
+        method after each response.
+        """
+        self._idle = True
+        return not self._draining.value
+
+    def _handle_request(self, client_socket, client_address):
+        # logging.info(f'Connection from {client_address} established')
+        # The worker's copy of the listening socket would otherwise keep the
+        # socket open after the server exits.
+        self._socket.close()
+        signal.signal(signal.SIGTERM, self._stop_worker)
         try:
             keep_alive = self.handle_request(client_socket)
             if not keep_alive:
                 client_socket.close()
-                # logging.info(f'Connection from {host}:{port} closed')
+                # logging.info(f'Connection from {client_address} closed')
         except Exception:
             client_socket.close()
             raise
@@ -80,43 +278,273 @@ class Server:
             return False
         return is_alive
 
-    def serve_forever(self):
-        """Serves requests indefinitely using a separate process per request."""
-        self._socket.bind(self._address)
-        self._socket.listen()
+    def _reject(self, client_socket):
+        """Responds to the connection's request with an OverloadedError.
+
+        Must not block the accept loop, so the request id is only read if the
+        request already arrived. Otherwise, the error is sent without an id.
+        """
+        id_ = None
+        try:
+            client_socket.setblocking(False)
+            try:
+                id_ = json.loads(socket_lib.recv_message(client_socket))['id']
+            except (OSError, ValueError, KeyError):
+                pass
+            error = socket_lib.OverloadedError(_RETRY_AFTER_SECS)
+            response = socket_lib.encode_error(error, id_)
+            socket_lib.send_message(client_socket, json.dumps(response))
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+        self._metrics.increment('connections.shed')
+        # logging.warning(f'Connection from {client_address} shed')
+
+    def serve_forever(self, on_ready=None):
+        """Serves requests using a separate process per request until drained.
+
+        Args:
+            on_ready: Called once the server accepts connections, e.g. to tell
+                a supervisor that the server has started.
+        """
+        signal.signal(signal.SIGUSR1, self._toggle_profiling)
+        signal.signal(signal.SIGUSR2, self._dump_profiles_on_signal)
+        if self._socket is None:
+            self._socket = listen(self._address)
+        # NOTE(eugenhotaj): Other generations of the server may accept from
+        # the same listening socket, so we wait for it to become readable
+        # instead of blocking in accept().
+        self._socket.setblocking(False)
+        wakeup, self._wakeup = socket.socketpair()
+        signal.signal(signal.SIGTERM, self._start_draining)
+        if on_ready:
+            on_ready()
 
         workers = []
+        # The (client_socket, client_address, queued_secs) of connections
+        # waiting for a free worker. The client_address is empty for Unix
+        # domain sockets.
+        queue = collections.deque()
+        drain_deadline = None
         while True:
-            result = self._socket.accept()
-            workers = [w for w in workers if self._keep_if_alive(worker)]
-            if result:
-                client_socket, (host, port) = result
-                if len(workers) < self._max_workers:
-                    worker = multiprocessing.Process(
-                            target=self._handle_request, 
-                            args=(client_socket, host, port))
-                    worker.start()
-                    workers.append(worker)
-                else:
-                    # If the server is overloaded, shed any new connections.
-                    client_socket.shutdown(socket.SHUT_RDWR)
-                    client_socket.close()
-                    # logging.warning(f'Connection from {host}:{port} shed')
+            if self._draining.value and drain_deadline is None:
+                drain_deadline = time.monotonic() + DRAIN_TIMEOUT_SECS
+                self._socket.close()
+                for worker in workers:
+                    worker.terminate()
+            if drain_deadline is not None and (
+                    not (workers or queue) or
+                    time.monotonic() > drain_deadline):
+                break
+
+            # Only wake up periodically while connections are queued (or the
+            # server drains), in order to hand them to workers as soon as
+            # these free up.
+            timeout = None
+            if queue or drain_deadline is not None:
+                timeout = _QUEUE_POLL_SECS
+            sockets = [wakeup]
+            if drain_deadline is None:
+                sockets.append(self._socket)
+            readable, _, _ = select.select(sockets, [], [], timeout)
+            if self._socket in readable:
+                try:
+                    client_socket, client_address = self._socket.accept()
+                    client_socket.settimeout(None)
+                    if len(queue) < self._max_queue:
+                        queue.append((
+                            client_socket, client_address, time.monotonic()))
+                    else:
+                        self._reject(client_socket)
+                except BlockingIOError:
+                    # Another generation accepted the connection first.
+                    pass
+
+            workers = [w for w in workers if self._keep_if_alive(w)]
+            while queue and len(workers) < self._max_workers:
+                client_socket, client_address, queued_secs = queue.popleft()
+                worker = multiprocessing.Process(
+                        target=self._handle_request,
+                        args=(client_socket, client_address))
+                worker.start()
+                # The parent's copy of the socket is no longer needed.
+                client_socket.close()
+                workers.append(worker)
+                self._metrics.increment('connections.accepted')
+                self._metrics.observe(
+                        'queue_wait', time.monotonic() - queued_secs)
+            now = time.monotonic()
+            while queue and now - queue[0][2] > self._queue_timeout_secs:
+                self._reject(queue.popleft()[0])
+            self._metrics.set('workers', len(workers))
+            self._metrics.set('queue', len(queue))
+
+        for worker in workers:
+            worker.kill()
+        wakeup.close()
+        self._wakeup.close()
  
 
+def _to_message(m, users):
+    return protocol.Message(
+            m.message_id, m.chat_id, users[m.user_id], m.message_text, 
+            m.message_ts)
+
+
+def _to_chat(db_client, chat, user_id, messages_limit=None):
+    # TODO(eugen): This is horrible!!! We need to be smarter about how we fill
+    # out the chat objects. Either via joins, or by bulk requesting users and
+    # messages.
+    users = {}
+    for p in db_client.get_participants(chat.chat_id):
+        users[p.user_id] = protocol.User(p.user_id, p.user_name)
+    messages = []
+    if messages_limit != 0:
+        messages = [
+                _to_message(m, users) 
+                for m in db_client.get_messages(
+                    chat.chat_id, limit=messages_limit)
+        ]
+    # TODO(eugenhotaj): Move chat_name logic to a helper function.
+    users = list(users.values())
+    chat_name = chat.chat_name
+    if len(users) == 2:
+        chat_name = [
+                user.user_name for user in users if user.user_id != user_id
+        ][0]
+    return protocol.Chat(chat.chat_id, chat_name, users, messages)
+
+
+# The functions below are run inside the DataServer's ConnectionPools, so they
+# must be defined at the module level in order to be picklable.
+def _get_user(db_client, user_id):
+    user = db_client.get_user(user_id)
+    return protocol.User(user.user_id, user.user_name)
+
+
+def _insert_user(db_client, user_name):
+    user = db_client.insert_user(user_name)
+    return protocol.User(user.user_id, user.user_name)
+
+
+def _get_chats(db_client, user_id, messages_limit):
+    chats = [
+            _to_chat(db_client, chat, user_id, messages_limit) 
+            for chat in db_client.get_chats(user_id)
+    ]
+    def last_message_ts(chat):
+        return chat.messages[-1].message_ts if chat.messages else 0
+    return sorted(chats, key=last_message_ts, reverse=True)
+
+
+def _get_chat_ids(db_client, user_id):
+    return [chat.chat_id for chat in db_client.get_chats(user_id)]
+
+
+def _insert_chat(db_client, chat_name, user_ids):
+    chat_id = None
+    if len(user_ids) == 2:
+        chat_id = db_client.get_private_chat_id(*user_ids)
+    if chat_id:
+        chat = database_client.Chat(chat_id, chat_name)
+    else:
+        chat = db_client.insert_chat(chat_name, user_ids)
+    # Runs on the single writer, so don't hold it up loading the history.
+    return _to_chat(db_client, chat, user_ids[0], messages_limit=0)
+
+
+def _get_messages(db_client, chat_id, before_message_id, limit):
+    users = {}
+    for p in db_client.get_participants(chat_id):
+        users[p.user_id] = protocol.User(p.user_id, p.user_name)
+    messages = db_client.get_messages(chat_id, before_message_id, limit)
+    return [_to_message(m, users) for m in messages]
+
+
+def _get_updates(db_client, user_id, since_cursor):
+    max_message_id, max_participant_id = db_client.get_max_ids()
+    messages = db_client.get_messages_since(
+            user_id, since_cursor.message_id, MAX_UPDATES)
+    has_more = len(messages) == MAX_UPDATES
+    if has_more:
+        max_message_id = messages[-1].message_id
+
+    users = {}
+    for user in db_client.get_users({m.user_id for m in messages}):
+        users[user.user_id] = protocol.User(user.user_id, user.user_name)
+    messages = [_to_message(m, users) for m in messages]
+
+    chats = []
+    changed = db_client.get_chat_ids_changed_since(
+            user_id, since_cursor.participant_id)
+    for chat_id in changed:
+        chat = db_client.get_chat(chat_id)
+        chats.append(_to_chat(db_client, chat, user_id, messages_limit=0))
+    joined_chat_ids = db_client.get_chat_ids_joined_since(
+            user_id, since_cursor.participant_id)
+
+    next_cursor = protocol.Cursor(max_message_id, max_participant_id)
+    return chats, messages, next_cursor, has_more, joined_chat_ids
+
+
+def _get_version(db_client, user_id, chat_id):
+    if chat_id is not None:
+        return protocol.Cursor(*db_client.get_chat_version(chat_id))
+    return protocol.Cursor(*db_client.get_user_version(user_id))
+
+
+def _insert_message(db_client, chat_id, user_id, message_text, message_ts):
+    # The timestamps of each database stage, used to trace the message.
+    events = [('db.start', tracing.now_ms())]
+    message = db_client.insert_message(
+            chat_id, user_id, message_text, message_ts)
+    events.append(('db.insert', tracing.now_ms()))
+    # NOTE(eugenhotaj): The receivers are looked up by the BroadcastServer, so
+    # we only need the sender here, not all the chat's participants.
+    user = db_client.get_user(user_id)
+    users = {user_id: protocol.User(user.user_id, user.user_name)}
+    events.append(('db.get_user', tracing.now_ms()))
+    return _to_message(message, users), events
+
+
 class DataServer(Server):
     """A Server which handles reading and writing conversation data.
 
     Unlike the BroadcastServer, the DataServer operates via a request/response
-    protocol. This means that it handles exactly one request per client 
-    connection and responds back with exactly one response, after which the 
-    connection to the client socket is terminated.
+    protocol. This means that it responds to each client request with exactly
+    one response. Requests on the same connection are handled one after the
+    other until the client closes the connection, so clients may either use a
+    new connection per request or keep a persistent connection around.
 
-    If the client sends multiple requests on the same socket, only the first
-    request is processed and subsequent requests are ignored.
+    Reads and writes go to separate ConnectionPools. Read-only requests are 
+    served by a pool of read-only connections, each request against its own
+    snapshot of the database. All mutations go through a single writer so they
+    never contend with each other, nor wait on the readers.
     """
 
-    def __init__(self, address, broadcast_address, db_path, max_workers=None):
+    _METHODS = (
+            'GetUser', 'InsertUser', 'GetChats', 'GetChatIds', 'InsertChat',
+            'GetMessages', 'InsertMessage', 'GetUpdates', 'GetVersion',
+            'GetPoolStats', 'GetStats', 'SetProfiling', 'DumpProfiles')
+    _GAUGES = (
+            'pool.read_queue_depth', 'pool.read_active', 
+            'pool.write_queue_depth', 'pool.write_active')
+    # Requests to the BroadcastServer which failed after the write committed.
+    _COUNTERS = ('broadcast.failed',)
+    # The time spent in the database, by ConnectionPool function, and the time
+    # spent sending new messages to the BroadcastServer.
+    _HISTOGRAMS = tuple(
+            f'db.{fn.__name__[1:]}' 
+            for fn in (_get_user, _insert_user, _get_chats, _get_chat_ids,
+                       _insert_chat, _get_messages, _get_updates,
+                       _get_version, _insert_message)
+    ) + ('broadcast',)
+
+    def __init__(self, address, broadcast_address, db_path, max_workers=None,
+                 read_pool_size=None, max_queue=None, queue_timeout_secs=None,
+                 listen_socket=None):
         """Initializes a new DataServer instance.
 
         Args:
@@ -124,169 +552,851 @@ class DataServer(Server):
             broadcast_address: The (host, port) address of the BroadcastServer
                 which will handle broadcasting new messages to online users.
             db_path: The path to the SQLite chat database.
+            max_workers: See the base class.
+            read_pool_size: The number of read-only database connections.
+            max_queue: See the base class.
+            queue_timeout_secs: See the base class.
+            listen_socket: See the base class.
         """
-        super().__init__(address, max_workers=max_workers)
+        super().__init__(
+                address,
+                max_workers=max_workers,
+                max_queue=max_queue,
+                queue_timeout_secs=queue_timeout_secs,
+                listen_socket=listen_socket)
+        self._write_limiter = admission.TokenBuckets(*WRITE_RATE_LIMIT)
         self._broadcast_address = broadcast_address
         self._db_path = db_path
+        self._read_pool = database_client.ConnectionPool(
+                db_path, 
+                size=read_pool_size or READ_POOL_SIZE, 
+                read_only=True,
+                profiler=self._profiler)
+        self._write_pool = database_client.ConnectionPool(
+                db_path, size=1, profiler=self._profiler)
 
     def handle_request(self, client_socket):
         """See the base class."""
-        db_client = database_client.DatabaseClient(self._db_path)
-        request = socket_lib.recv_message(client_socket)
-        request = json.loads(request)
-        method, params, id_ = request['method'], request['params'], request['id']
+        while True:
+            try:
+                request = socket_lib.recv_message(client_socket)
+            except ConnectionError:
+                return False
+            self._idle = False
+            start_secs = time.perf_counter()
+            recv_ms = tracing.now_ms()
+            request = json.loads(request)
+            method, params, id_ = (
+                    request['method'], request['params'], request['id'])
+            trace = request.get('trace')
+            tracing.add_event(trace, 'data.recv', recv_ms)
+            profile = self._start_profile(method)
+            failed = False
+            try:
+                response = self._handle_method(method, params, trace)
+                response = {'result': response.to_json(), 'id': id_}
+            except socket_lib.RPCError as error:
+                failed = True
+                response = socket_lib.encode_error(error, id_)
+            except Exception:
+                self._record_request(method, start_secs, failed=True)
+                raise
+            finally:
+                if profile:
+                    profile.stop()
+            socket_lib.send_message(client_socket, json.dumps(response))
+            self._record_request(method, start_secs, failed)
+            if not self._request_done():
+                return False
+
+    def _run(self, pool, fn, *args):
+        """Runs fn in the pool and records the time spent in the database."""
+        start_secs = time.perf_counter()
+        try:
+            return pool.run(fn, *args)
+        finally:
+            self._metrics.observe(
+                    f'db.{fn.__name__[1:]}', time.perf_counter() - start_secs)
 
+    def _send_broadcast_request(self, method, request, trace=None):
+        """Sends the request to the BroadcastServer after a committed write.
+
+        Failures are logged and counted, but not returned to the client: An
+        error (in particular an OverloadedError) tells clients to retry, which
+        would repeat the write. Streams which miss the request catch up when
+        they are resumed.
+        """
+        try:
+            socket_lib.send_request(
+                    method,
+                    request.to_json(),
+                    address=self._broadcast_address,
+                    trace=trace)
+        except (OSError, socket_lib.RPCError):
+            logging.exception(f'{method} to the BroadcastServer failed.')
+            self._metrics.increment('broadcast.failed')
+
+    def stats(self):
+        """See the base class."""
+        self._metrics.set('pool.read_queue_depth', self._read_pool.queue_depth)
+        self._metrics.set('pool.read_active', self._read_pool.active)
+        self._metrics.set(
+                'pool.write_queue_depth', self._write_pool.queue_depth)
+        self._metrics.set('pool.write_active', self._write_pool.active)
+        return super().stats()
+
+    def _handle_method(self, method, params, trace=None):
         if method == 'GetUser':
             request = protocol.GetUserRequest.from_json(params)
-            user = db_client.get_user(request.user_id)
+            user = self._run(self._read_pool, _get_user, request.user_id)
             response = protocol.GetUserResponse(user)
         elif method == 'InsertUser':
             request = protocol.InsertUserRequest.from_json(params)
-            user = db_client.insert_user(request.user_name)
+            user = self._run(
+                    self._write_pool, _insert_user, request.user_name)
             response = protocol.InsertUserResponse(user)
         elif method == 'GetChats':
-            # TODO(eugen): This is horrible!!! We need to be smarter about
-            # how we fill out the chat objects. Either via joins, or by bulk
-            # requesting users and messages.
             request = protocol.GetChatsRequest.from_json(params)
-            chats = []
-            for chat in db_client.get_chats(request.user_id):
-                users = {}
-                for p in db_client.get_participants(chat.chat_id):
-                    users[p.user_id] = protocol.User(p.user_id, p.user_name)
-                messages = []
-                for m in db_client.get_messages(chat.chat_id):
-                    message = protocol.Message(
-                            m.message_id,
-                            m.chat_id,
-                            users[m.user_id],
-                            m.message_text,
-                            m.message_ts)
-                    messages.append(message)
-                # TODO(eugenhotaj): Move chat_name logic to a helper function.
-                users = list(users.values())
-                chat_name = chat.chat_name
-                if len(users) == 2:
-                    chat_name = [
-                            user.user_name for user in users 
-                            if user.user_id != request.user_id
-                    ][0]
-                chat = protocol.Chat(
-                    chat.chat_id, chat_name, users, messages)
-                chats.append(chat)
-            chats = sorted(chats, key=lambda chat: chat.messages[-1].message_ts,
+            chats = self._run(
+                    self._read_pool, 
+                    _get_chats, 
+                    request.user_id, 
+                    request.messages_limit)
             response = protocol.GetChatsResponse(chats)
+        elif method == 'GetChatIds':
+            request = protocol.GetChatIdsRequest.from_json(params)
+            chat_ids = self._run(
+                    self._read_pool, _get_chat_ids, request.user_id)
+            response = protocol.GetChatIdsResponse(chat_ids)
         elif method == 'InsertChat':
             request = protocol.InsertChatRequest.from_json(params)
-            user_ids = request.user_ids
-            chat_id = None
-            if len(user_ids) == 2:
-                chat = db_client.get_private_chat_id(*user_ids)
-            if not chat_id:
-                chat = db_client.insert_chat(request.chat_name, user_ids)
+            self._check_rate_limit(self._write_limiter, request.user_ids[0])
+            chat = self._run(
+                    self._write_pool, 
+                    _insert_chat, 
+                    request.chat_name, 
+                    request.user_ids)
+            # The participants' streams need to start receiving the chat's
+            # messages. This is a no-op if the chat already existed.
+            request = protocol.MembershipChangeRequest(
+                    chat.chat_id, [user.user_id for user in chat.users])
+            self._send_broadcast_request('MembershipChangeRequest', request)
             response = protocol.InsertChatResponse(chat)
         elif method == 'GetMessages':
-            # TODO(eugen): This is horrible!!! We need to be smarter about
-            # how we fill out the chat objects. Either via joins, or by bulk
-            # requesting users and messages.
             request = protocol.GetMessagesRequest.from_json(params)
-            users = {}
-            for p in db_client.get_participants(request.chat_id):
-                users[p.user_id] = protocol.User(p.user_id, p.user_name)
-            messages = []
-            for m in db_client.get_messages(request.chat_id):
-                message = protocol.Message(
-                        m.message_id,
-                        m.chat_id,
-                        users[m.user_id],
-                        m.message_text,
-                        m.message_ts)
-                messages.append(message)
+            messages = self._run(
+                    self._read_pool, 
+                    _get_messages, 
+                    request.chat_id, 
+                    request.before_message_id, 
+                    request.limit)
             response = protocol.GetMessagesResponse(messages)
         elif method == 'InsertMessage':
             request = protocol.InsertMessageRequest.from_json(params)
+            self._check_rate_limit(self._write_limiter, request.user_id)
             message_ts = int(time.time() * constants.MILLIS_PER_SEC)
-            message = db_client.insert_message(
+            message, db_events = self._run(
+                    self._write_pool, 
+                    _insert_message,
                     request.chat_id, 
                     request.user_id, 
                     request.message_text, 
                     message_ts)
-            user = db_client.get_user(request.user_id)
-            user = protocol.User(user.user_id, user.user_name)
-            message = protocol.Message(
-                    message.message_id,
-                    message.chat_id,
-                    user,
-                    message.message_text,
-                    message.message_ts)
-            receivers = db_client.get_participants(request.chat_id)
-            receiver_ids = [
-                    receiver.user_id for receiver in receivers 
-                    if receiver.user_id != request.user_id
-            ]
-            request = protocol.BroadcastRequest(receiver_ids, message)
-            socket_lib.send_request(
-                    'BroadcastRequest', 
-                    request.to_json(), 
-                    address=self._broadcast_address)
+            for name, ts_ms in db_events:
+                tracing.add_event(trace, name, ts_ms)
+            request = protocol.BroadcastChatRequest(message.chat_id, message)
+            start_secs = time.perf_counter()
+            tracing.add_event(trace, 'data.broadcast')
+            self._send_broadcast_request(
+                    'BroadcastChatRequest', request, trace)
+            self._metrics.observe(
+                    'broadcast', time.perf_counter() - start_secs)
             response = protocol.InsertMessageResponse(message)
+        elif method == 'GetUpdates':
+            request = protocol.GetUpdatesRequest.from_json(params)
+            updates = self._run(
+                    self._read_pool, 
+                    _get_updates, 
+                    request.user_id, 
+                    request.since_cursor)
+            response = protocol.GetUpdatesResponse(*updates)
+        elif method == 'GetVersion':
+            request = protocol.GetVersionRequest.from_json(params)
+            if (request.user_id is None) == (request.chat_id is None):
+                raise socket_lib.RPCError(
+                        socket_lib.INVALID_PARAMS,
+                        "One, and only one, 'user_id' or 'chat_id' must be "
+                        "provided.")
+            version = self._run(
+                    self._read_pool, 
+                    _get_version, 
+                    request.user_id, 
+                    request.chat_id)
+            response = protocol.GetVersionResponse(version)
+        elif method == 'GetPoolStats':
+            response = protocol.GetPoolStatsResponse(
+                    read_queue_depth=self._read_pool.queue_depth,
+                    read_active=self._read_pool.active,
+                    write_queue_depth=self._write_pool.queue_depth,
+                    write_active=self._write_pool.active)
+        elif method == 'GetStats':
+            response = protocol.GetStatsResponse(**self.stats())
+        elif method == 'SetProfiling':
+            response = self._set_profiling(params)
+        elif method == 'DumpProfiles':
+            response = self._dump_profiles()
         else:
             # TODO(eugenhotaj): Return back a malformed request response.
             raise NotImplementedError()
+        return response
+
+
+class _ChatIndex:
+    """Maps chats to their online members, i.e. users with an open stream.
+
+    Lives in the BroadcastServer's manager process, so that every operation is
+    a single (atomic) round trip from the worker processes. Since it knows when
+    users come online or go offline, the index also collects the presence and
+    typing events of each chat until they are drained.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = collections.defaultdict(set)
+        self._chat_ids = {}
+        # The users whose streams receive presence and typing events.
+        self._event_users = set()
+        # The events since the last drain_events(): The latest presence of
+        # each user (along with the chats to announce it in), the typists in
+        # each chat, and the users who must be told who is already online.
+        self._presence = {}
+        self._typing = collections.defaultdict(set)
+        self._needs_snapshot = set()
+
+    def _set_presence(self, user_id, online, chat_ids):
+        presence = self._presence.setdefault(user_id, [online, set()])
+        presence[0] = online
+        presence[1].update(chat_ids)
+
+    def add_user(self, user_id, chat_ids=(), events=False):
+        """Marks the user online and adds them to the given chats."""
+        with self._lock:
+            user_chat_ids = self._chat_ids.setdefault(user_id, set())
+            user_chat_ids.update(chat_ids)
+            for chat_id in chat_ids:
+                self._members[chat_id].add(user_id)
+            if chat_ids:
+                self._set_presence(user_id, True, chat_ids)
+            if events and user_id not in self._event_users:
+                self._event_users.add(user_id)
+                self._needs_snapshot.add(user_id)
+
+    def remove_user(self, user_id):
+        """Removes the (offline) user from all of their chats."""
+        with self._lock:
+            chat_ids = self._chat_ids.pop(user_id, ())
+            for chat_id in chat_ids:
+                members = self._members[chat_id]
+                members.discard(user_id)
+                if not members:
+                    del self._members[chat_id]
+            if chat_ids:
+                self._set_presence(user_id, False, chat_ids)
+            self._event_users.discard(user_id)
+            self._needs_snapshot.discard(user_id)
+
+    def add_members(self, chat_id, user_ids):
+        """Adds the users to the chat. Offline users are ignored."""
+        with self._lock:
+            for user_id in user_ids:
+                if user_id in self._chat_ids:
+                    self._chat_ids[user_id].add(chat_id)
+                    self._members[chat_id].add(user_id)
+                    self._set_presence(user_id, True, (chat_id,))
+                    if user_id in self._event_users:
+                        self._needs_snapshot.add(user_id)
+
+    def request_snapshot(self, user_id):
+        """Tells the user who is online with the next drain, if they get events.
+
+        E.g. for streams which missed earlier events while they were opened.
+        """
+        with self._lock:
+            if user_id in self._event_users:
+                self._needs_snapshot.add(user_id)
+
+    def add_typing(self, chat_id, user_id):
+        """Records that the user is typing, if they are an online member."""
+        with self._lock:
+            if user_id in self._members.get(chat_id, ()):
+                self._typing[chat_id].add(user_id)
+
+    def members(self, chat_id):
+        with self._lock:
+            return list(self._members.get(chat_id, ()))
+
+    def online_users(self):
+        with self._lock:
+            return list(self._chat_ids)
+
+    def n_chats(self):
+        with self._lock:
+            return len(self._members)
+
+    def drain_events(self):
+        """Returns, and forgets, the events collected since the last drain.
+
+        Returns:
+            A dict from receiver_id to the receiver's ([(user_id, online)],
+            [(chat_id, user_id)]) presence and typing events. Receivers never
+            get their own events and get each user's presence at most once.
+        """
+        with self._lock:
+            frames = {}
+            for user_id, (online, chat_ids) in self._presence.items():
+                for receiver_id in self._event_receivers(chat_ids, user_id):
+                    frames.setdefault(receiver_id, ({}, []))[0][user_id] = (
+                            online)
+            for receiver_id in self._needs_snapshot:
+                presence = frames.setdefault(receiver_id, ({}, []))[0]
+                for chat_id in self._chat_ids.get(receiver_id, ()):
+                    for user_id in self._members[chat_id]:
+                        if user_id != receiver_id:
+                            presence.setdefault(user_id, True)
+            for chat_id, user_ids in self._typing.items():
+                # Bound the frame size no matter how many people type at once.
+                user_ids = sorted(user_ids)[:MAX_TYPING_EVENTS]
+                for receiver_id in self._event_receivers((chat_id,)):
+                    typing = frames.setdefault(receiver_id, ({}, []))[1]
+                    typing.extend(
+                            (chat_id, user_id) for user_id in user_ids
+                            if user_id != receiver_id)
+            self._presence = {}
+            self._typing = collections.defaultdict(set)
+            self._needs_snapshot = set()
+        return {
+                receiver_id: (list(presence.items()), typing)
+                for receiver_id, (presence, typing) in frames.items()
+                if presence or typing
+        }
+
+    def _event_receivers(self, chat_ids, user_id=None):
+        """Returns the online members of the chats who want events."""
+        receiver_ids = set()
+        for chat_id in chat_ids:
+            receiver_ids.update(self._members.get(chat_id, ()))
+        receiver_ids.discard(user_id)
+        return receiver_ids & self._event_users
+
+
+class _BroadcastManager(managers.SyncManager):
+    pass
+
 
-        response = {'result': response.to_json(), 'id': id_}
-        socket_lib.send_message(client_socket, json.dumps(response))
+_BroadcastManager.register('ChatIndex', _ChatIndex)
+
+
+def _encode_broadcast(receiver_id, message, trace):
+    """Returns the stream message delivering the message to the receiver.
+
+    NOTE(eugenhotaj): Equivalent to json.dumps() of the BroadcastRequest
+    ([receiver_id], message) stream message, but the (pre-encoded) message and
+    trace are only encoded once per fan-out instead of once per receiver.
+    """
+    return (f'{{"jsonrpc": "2.0", "result": {{"receiver_ids": [{receiver_id}]'
+            f', "message": {message}}}{trace}}}')
 
 
 class BroadcastServer(Server):
-    """A Server which handles streaming new conversations messages to users."""
+    """A Server which handles streaming new conversations messages to users.
+
+    Streams can be resumed from the last message a client has seen. Any 
+    messages the client missed are first replayed from the DataServer, after
+    which the stream switches over to live delivery. Live messages which arrive
+    during the replay are held back and delivered right after it, so the client
+    sees every message, in order.
 
-    def __init__(self, address, max_workers=None):
+    New messages are addressed to chats (see BroadcastChatRequest). The server
+    keeps an index from each chat to its online members, filled in with the
+    user's chats (from the DataServer) when their stream opens and kept up to
+    date by MembershipChangeRequests. Fanning out a message only touches the
+    chat's online members.
+
+    Presence and typing events are ephemeral and never reach the DataServer.
+    The index collects them and a separate process delivers them in batches,
+    every EVENT_WINDOW_SECS, to the streams which asked for them. Frames are
+    dropped rather than waited on if a receiver falls behind.
+    """
+
+    _METHODS = (
+            'OpenStreamRequest', 'OpenMultiplexedStreamRequest', 
+            'CloseStreamRequest', 'BroadcastRequest', 'BroadcastChatRequest',
+            'MembershipChangeRequest', 'TypingRequest', 'GetStats',
+            'SetProfiling', 'DumpProfiles')
+    # Live messages sent, held back during a replay, not delivered because
+    # the receiver was offline or dropped since they were already replayed.
+    # Typing notifications accepted, typing notifications and event frames
+    # dropped, and event frames sent.
+    _COUNTERS = (
+            'deliveries.sent', 'deliveries.held', 'deliveries.offline',
+            'deliveries.replayed', 'events.typing', 'events.dropped',
+            'events.frames')
+    _GAUGES = ('streams.open', 'streams.replaying', 'index.chats')
+    # The time spent sending a BroadcastRequest to all the receivers, the
+    # time spent replaying missed messages to a resumed stream and the time
+    # spent sending a batch of event frames.
+    _HISTOGRAMS = ('fanout', 'replay', 'events.flush')
+
+    def __init__(self, address, data_address=None, max_workers=None,
+                 max_queue=None, queue_timeout_secs=None, listen_socket=None):
         """Initializes a new BroadcastServer instance.
 
         Args: 
             address: See the base class.
+            data_address: The (host, port) address of the DataServer used to
+                look up the chats of new streams and to replay missed messages
+                to resumed streams. If 'None', streams can not be resumed and
+                only receive chat-addressed messages for chats they join
+                while open.
             max_workers: See the base class.
+            max_queue: See the base class.
+            queue_timeout_secs: See the base class.
+            listen_socket: See the base class.
+        """
+        super().__init__(
+                address,
+                max_workers=max_workers,
+                max_queue=max_queue,
+                queue_timeout_secs=queue_timeout_secs,
+                listen_socket=listen_socket)
+        # NOTE(eugenhotaj): Subscriptions on multiplexed streams are not rate
+        # limited, since they come from trusted frontends (e.g. the webapp)
+        # which already deduplicate their users' streams.
+        self._stream_limiter = admission.TokenBuckets(*STREAM_RATE_LIMIT)
+        self._typing_limiter = admission.TokenBuckets(*TYPING_RATE_LIMIT)
+        self._data_address = data_address
+        manager = _BroadcastManager()
+        manager.start()
+        # Maps user_ids to their (stream socket, stream_id). The stream_id
+        # is the pid of the worker serving the stream.
+        self._socket_table = manager.dict()
+        self._chat_index = manager.ChatIndex()
+        # NOTE(eugenhotaj): The fan-outs, replays and the event flusher all
+        # write to the streams from different processes and messages may take
+        # more than one send() call, e.g. once the socket's buffer fills up,
+        # so writes must hold the stream's lock to not interleave. Unlike the
+        # manager's locks, these are inherited by the forked workers and
+        # don't cost a round trip to the manager.
+        self._send_locks = [
+                multiprocessing.Lock() for _ in range(_N_SEND_LOCKS)]
+        # Maps user_ids whose streams are being opened (and replayed) to the
+        # (list of) live messages held back until the replay was sent, and
+        # afterwards to the last replayed message_id.
+        self._held_table = manager.dict()
+        self._held_lock = manager.Lock()
+
+    def _send_lock(self, stream_id):
+        return self._send_locks[stream_id % _N_SEND_LOCKS]
+
+    def _send_live(self, receiver_id, message_id, message):
+        stream = self._socket_table.get(receiver_id)
+        if not stream:
+            self._metrics.increment('deliveries.offline')
+            return
+        receiver_socket, stream_id = stream
+        held = self._held_table.get(receiver_id)
+        if isinstance(held, list):
+            with self._held_lock:
+                # Check again now that we hold the lock, the replay might 
+                # have finished in the meantime.
+                held = self._held_table.get(receiver_id)
+                if isinstance(held, list):
+                    held.append((message_id, message))
+                    self._held_table[receiver_id] = held
+                    self._metrics.increment('deliveries.held')
+                    return
+        # Messages committed before the replay's snapshot may still be on
+        # their way here after the replay finished, but were already replayed.
+        if held is not None and message_id <= held:
+            self._metrics.increment('deliveries.replayed')
+            return
+        try:
+            with self._send_lock(stream_id):
+                socket_lib.send_message(receiver_socket, message)
+        except OSError:
+            # The stream is gone. Don't let it fail the delivery to the other
+            # receivers, the client catches up via a replay when it reconnects.
+            self._unsubscribe(receiver_id)
+            self._metrics.increment('deliveries.offline')
+            return
+        self._metrics.increment('deliveries.sent')
+
+    def _record_typing(self, chat_id, user_id):
+        if self._typing_limiter.acquire(user_id):
+            self._metrics.increment('events.dropped')
+            return
+        self._chat_index.add_typing(chat_id, user_id)
+        self._metrics.increment('events.typing')
+
+    def _flush_events(self):
+        """Sends each receiver a single frame with their pending events."""
+        frames = self._chat_index.drain_events()
+        if not frames:
+            return
+        start_secs = time.perf_counter()
+        for receiver_id, (presence, typing) in frames.items():
+            # Events are ephemeral, so there's no need to hold them back for
+            # streams which are being opened. Those only need to know who is
+            # online once they are open.
+            if isinstance(self._held_table.get(receiver_id), list):
+                self._chat_index.request_snapshot(receiver_id)
+                continue
+            stream = self._socket_table.get(receiver_id)
+            if not stream:
+                continue
+            receiver_socket, stream_id = stream
+            frame = protocol.EventFrame(
+                    [receiver_id],
+                    [protocol.PresenceEvent(*event) for event in presence],
+                    [protocol.TypingEvent(*event) for event in typing])
+            frame = {'jsonrpc': '2.0', 'result': frame.to_json()}
+            send_lock = self._send_lock(stream_id)
+            # Like a full send buffer, a busy stream drops the frame.
+            sent = False
+            if send_lock.acquire(block=False):
+                try:
+                    sent = socket_lib.try_send_message(
+                            receiver_socket, json.dumps(frame))
+                except OSError:
+                    # The stream is gone, the next sweep cleans it up.
+                    pass
+                finally:
+                    send_lock.release()
+            self._metrics.increment(
+                    'events.frames' if sent else 'events.dropped')
+        self._metrics.observe('events.flush', time.perf_counter() - start_secs)
+
+    def _sweep_streams(self):
+        """Unsubscribes the users whose streams were closed by the client.
+
+        Plain streams are not read from after they are opened, so the server
+        would otherwise not notice them closing until it sends to them.
+        """
+        for user_id in self._chat_index.online_users():
+            stream = self._socket_table.get(user_id)
+            if not stream:
+                continue
+            stream_socket, _ = stream
+            try:
+                # A closed stream reads as EOF, an open one would block.
+                closed = not stream_socket.recv(
+                        1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                closed = False
+            except OSError:
+                closed = True
+            if closed:
+                self._unsubscribe(user_id)
+
+    def _send_events_forever(self):
+        last_sweep_secs = time.monotonic()
+        while True:
+            time.sleep(EVENT_WINDOW_SECS)
+            if time.monotonic() - last_sweep_secs > SWEEP_SECS:
+                self._sweep_streams()
+                last_sweep_secs = time.monotonic()
+            self._flush_events()
+
+    def serve_forever(self, on_ready=None):
+        """See the base class."""
+        multiprocessing.Process(
+                target=self._send_events_forever, daemon=True).start()
+        super().serve_forever(on_ready)
+
+    def _fanout(self, receiver_ids, message, trace):
+        """Sends the message to each of the online receivers."""
+        start_secs = time.perf_counter()
+        encoded_trace = ''
+        if trace is not None:
+            # Receivers add their own event to get the full trace.
+            tracing.add_event(trace, 'broadcast.fanout')
+            encoded_trace = f', "trace": {json.dumps(trace)}'
+        encoded_message = json.dumps(message.to_json())
+        for receiver_id in receiver_ids:
+            self._send_live(
+                    receiver_id,
+                    message.message_id,
+                    _encode_broadcast(
+                        receiver_id, encoded_message, encoded_trace))
+        self._metrics.observe('fanout', time.perf_counter() - start_secs)
+
+    def _fetch_replay(self, user_id, last_message_id):
+        """Returns the (encoded) messages the user missed since last_message_id.
+
+        Also returns the message_id the replay ends at, which later live
+        messages are checked against.
         """
-        super().__init__(address, max_workers=max_workers)
-        self._socket_table = multiprocessing.Manager().dict()
+        start_secs = time.perf_counter()
+        # The stream only needs the missed messages, so start from the user's
+        # current participant_id to not rebuild all their chats.
+        request = protocol.GetVersionRequest(user_id)
+        response = socket_lib.send_request(
+                'GetVersion', request.to_json(), address=self._data_address)
+        cursor = protocol.Cursor(
+                last_message_id, response['version']['participant_id'])
+        messages = []
+        has_more = True
+        while has_more:
+            request = protocol.GetUpdatesRequest(user_id, cursor)
+            response = socket_lib.send_request(
+                    'GetUpdates', request.to_json(), 
+                    address=self._data_address)
+            for message in response['messages']:
+                # Like live broadcasts, don't echo the user's own messages.
+                if message['user']['user_id'] == user_id:
+                    continue
+                message = protocol.BroadcastRequest([user_id], message)
+                message = {'jsonrpc': '2.0', 'result': message.to_json()}
+                messages.append(json.dumps(message))
+            cursor = protocol.Cursor.from_json(response['next_cursor'])
+            has_more = response['has_more']
+        self._metrics.observe('replay', time.perf_counter() - start_secs)
+        return messages, cursor.message_id
+
+    def stats(self):
+        """See the base class."""
+        self._metrics.set('streams.open', len(self._socket_table))
+        self._metrics.set('streams.replaying', sum(
+                isinstance(held, list) for held in self._held_table.values()))
+        self._metrics.set('index.chats', self._chat_index.n_chats())
+        return super().stats()
 
     def handle_request(self, client_socket):
         """See the base class."""
-        request = socket_lib.recv_message(client_socket)
+        try:
+            request = socket_lib.recv_message(client_socket)
+        except ConnectionError:
+            # The client hung up without a request, e.g. a probe checking
+            # whether the server is up.
+            return False
+        self._idle = False
+        recv_ms = tracing.now_ms()
         request = json.loads(request)
         method, params, id_ = request['method'], request['params'], request['id']
+        trace = request.get('trace')
+        tracing.add_event(trace, 'broadcast.recv', recv_ms)
 
+        start_secs = time.perf_counter()
+        profile = self._start_profile(method)
         keep_alive = False
-        if method == 'OpenStreamRequest':
-            request = protocol.OpenStreamRequest.from_json(params)
-            self._socket_table[request.user_id] = client_socket
-            response = protocol.OpenStreamResponse()
-            keep_alive = True
-        elif method == 'CloseStreamRequest':
-            request = protocol.OpenStreamRequest.from_json(request)
-            table_socket = self._socket_table[request.user_id]
-            del self._socket_table[request.user_id]
-            # If the client_socket is the same as the socket in the 
-            # socket_table, defer closing it until we have send back a
-            # response.
-            if table_socket != client_socket:
-                table_socket.close()
-            response = protocol.CloseStreamResponse()
-        elif method == 'BroadcastRequest':
-            request = protocol.BroadcastRequest.from_json(params)
-            for receiver_id in request.receiver_ids:
-                if receiver_id in self._socket_table:
-                    # TODO(eugenhoatj): Sending the BroadcastRequest to the 
-                    # client doesn't really make sense.
-                    response = {'jsonrpc': '2.0', 'result': request.to_json()}
-                    socket_lib.send_message(self._socket_table[receiver_id], 
-                                            json.dumps(response))
-            response = protocol.BroadcastResponse()
-        else:
-            # TODO(eugenhotaj): Return back a malformed request response.
-            raise NotImplementedError()
+        subscription = None
+        multiplexed = False
+        failed = False
+        try:
+            if method == 'OpenStreamRequest':
+                request = protocol.OpenStreamRequest.from_json(params)
+                self._check_rate_limit(self._stream_limiter, request.user_id)
+                # Look up the user's chats and missed messages before 
+                # responding, so that failures are sent back as the response
+                # instead of in the middle of the stream.
+                replay = self._subscribe(
+                        request.user_id, request.last_message_id,
+                        client_socket, request.events)
+                subscription = (request.user_id, replay)
+                response = protocol.OpenStreamResponse()
+                keep_alive = True
+            elif method == 'OpenMultiplexedStreamRequest':
+                response = protocol.OpenMultiplexedStreamResponse()
+                multiplexed = True
+            elif method == 'CloseStreamRequest':
+                request = protocol.OpenStreamRequest.from_json(request)
+                table_socket, _ = self._socket_table[request.user_id]
+                self._unsubscribe(request.user_id)
+                # If the client_socket is the same as the socket in the 
+                # socket_table, defer closing it until we have send back a
+                # response.
+                if table_socket != client_socket:
+                    table_socket.close()
+                response = protocol.CloseStreamResponse()
+            elif method == 'BroadcastRequest':
+                request = protocol.BroadcastRequest.from_json(params)
+                self._fanout(request.receiver_ids, request.message, trace)
+                response = protocol.BroadcastResponse()
+            elif method == 'BroadcastChatRequest':
+                request = protocol.BroadcastChatRequest.from_json(params)
+                sender_id = request.message.user.user_id
+                receiver_ids = [
+                        user_id
+                        for user_id in self._chat_index.members(request.chat_id)
+                        if user_id != sender_id
+                ]
+                self._fanout(receiver_ids, request.message, trace)
+                response = protocol.BroadcastChatResponse()
+            elif method == 'TypingRequest':
+                request = protocol.TypingRequest.from_json(params)
+                self._record_typing(request.chat_id, request.user_id)
+                response = protocol.TypingResponse()
+            elif method == 'MembershipChangeRequest':
+                request = protocol.MembershipChangeRequest.from_json(params)
+                self._chat_index.add_members(request.chat_id, request.user_ids)
+                response = protocol.MembershipChangeResponse()
+            elif method == 'GetStats':
+                response = protocol.GetStatsResponse(**self.stats())
+            elif method == 'SetProfiling':
+                response = self._set_profiling(params)
+            elif method == 'DumpProfiles':
+                response = self._dump_profiles()
+            else:
+                # TODO(eugenhotaj): Return back a malformed request response.
+                raise NotImplementedError()
 
-        response = {'result': response.to_json(), 'id': id_}
-        socket_lib.send_message(client_socket, json.dumps(response))
+            response = {'result': response.to_json(), 'id': id_}
+            socket_lib.send_message(client_socket, json.dumps(response))
+            if subscription:
+                self._resume(*subscription, client_socket)
+        except socket_lib.RPCError as error:
+            response = socket_lib.encode_error(error, id_)
+            socket_lib.send_message(client_socket, json.dumps(response))
+            keep_alive = multiplexed = False
+            failed = True
+        except Exception:
+            if subscription:
+                # E.g. the client hung up before the response was sent.
+                self._unsubscribe(subscription[0])
+            self._record_request(method, start_secs, failed=True)
+            raise
+        finally:
+            if profile:
+                profile.stop()
+        self._record_request(method, start_secs, failed)
+        # Draining servers don't take new notifications on multiplexed
+        # streams, the client reopens the stream with the next generation.
+        if self._request_done() and multiplexed:
+            self._serve_multiplexed_stream(client_socket)
         return keep_alive
+
+    def _subscribe(self, user_id, last_message_id, client_socket, events=False):
+        """Registers the user's stream and fetches the messages they missed.
+
+        Nothing is sent to the client_socket yet: Live messages and events are
+        held back until _resume() sends the returned replay, which must only be
+        called once the client was told that the stream is open.
+
+        If looking up the user's chats or fetching their missed messages 
+        fails, e.g. because the DataServer is down or overloaded, the user is
+        unsubscribed again before the error is raised.
+        """
+        try:
+            return self._start_stream(
+                    user_id, last_message_id, client_socket, events)
+        except Exception:
+            # Otherwise, the user would stay online in the chat index, their
+            # live messages would be held back for the stream forever and the
+            # manager would keep its copy of the socket.
+            self._unsubscribe(user_id)
+            raise
+
+    def _start_stream(self, user_id, last_message_id, client_socket, events):
+        # Start holding back live messages *before* registering the socket,
+        # so none are sent before the response and the replay.
+        self._held_table[user_id] = []
+        self._socket_table[user_id] = (client_socket, os.getpid())
+        # Mark the user online first, so that chats they join while we look
+        # up their other chats are not missed.
+        self._chat_index.add_user(user_id, events=events)
+        if not self._data_address:
+            return [], None
+        request = protocol.GetChatIdsRequest(user_id)
+        response = socket_lib.send_request(
+                'GetChatIds', request.to_json(), address=self._data_address)
+        self._chat_index.add_user(user_id, response['chat_ids'])
+        if last_message_id is None:
+            return [], None
+        return self._fetch_replay(user_id, last_message_id)
+
+    def _resume(self, user_id, replay, client_socket):
+        """Sends the replay, then the live messages held back in the meantime."""
+        try:
+            self._send_replay(user_id, replay, client_socket)
+        except Exception:
+            self._unsubscribe(user_id)
+            raise
+
+    def _send_replay(self, user_id, replay, client_socket):
+        messages, last_message_id = replay
+        send_lock = self._send_lock(os.getpid())
+        for message in messages:
+            with send_lock:
+                socket_lib.send_message(client_socket, message)
+        with self._held_lock:
+            for message_id, message in self._held_table[user_id]:
+                # Messages committed before the replay started are both 
+                # replayed and held, so drop the duplicates.
+                if last_message_id is None or message_id > last_message_id:
+                    with send_lock:
+                        socket_lib.send_message(client_socket, message)
+            if last_message_id is None:
+                self._held_table.pop(user_id, None)
+            else:
+                self._held_table[user_id] = last_message_id
+
+    def _unsubscribe(self, user_id):
+        self._socket_table.pop(user_id, None)
+        self._held_table.pop(user_id, None)
+        self._chat_index.remove_user(user_id)
+
+    def _send_subscribe_failed(self, user_id, client_socket, error):
+        logging.warning(f'Subscribing user {user_id} failed: {error!r}')
+        frame = protocol.SubscribeFailedFrame([user_id], str(error))
+        frame = {'jsonrpc': '2.0', 'result': frame.to_json()}
+        with self._send_lock(os.getpid()):
+            socket_lib.send_message(client_socket, json.dumps(frame))
+
+    def _serve_multiplexed_stream(self, client_socket):
+        """Handles Subscribe/Unsubscribe notifications until the stream closes.
+
+        Users whose subscription fails are sent a SubscribeFailedFrame, the
+        stream itself stays open for its other users.
+
+        NOTE(eugenhotaj): Messages for all the stream's users are written to 
+        the same socket by different worker processes, all of which hold the
+        stream's send lock while writing (see _send_lock()).
+        """
+        user_ids = set()
+        try:
+            while True:
+                request = json.loads(socket_lib.recv_message(client_socket))
+                self._idle = False
+                method, params = request['method'], request['params']
+                if method == 'SubscribeRequest':
+                    request = protocol.SubscribeRequest.from_json(params)
+                    user_ids.add(request.user_id)
+                    try:
+                        replay = self._subscribe(
+                                request.user_id, request.last_message_id, 
+                                client_socket, request.events)
+                    except (OSError, socket_lib.RPCError) as error:
+                        # The stream is shared by many users, so only drop
+                        # the (already unsubscribed) user instead of closing
+                        # it.
+                        user_ids.discard(request.user_id)
+                        self._send_subscribe_failed(
+                                request.user_id, client_socket, error)
+                    else:
+                        self._resume(request.user_id, replay, client_socket)
+                elif method == 'UnsubscribeRequest':
+                    request = protocol.UnsubscribeRequest.from_json(params)
+                    user_ids.discard(request.user_id)
+                    self._unsubscribe(request.user_id)
+                elif method == 'TypingRequest':
+                    request = protocol.TypingRequest.from_json(params)
+                    self._record_typing(request.chat_id, request.user_id)
+                else:
+                    logging.warning(f'Ignoring unknown notification {method}.')
+                if not self._request_done():
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            for user_id in user_ids:
+                self._unsubscribe(user_id)
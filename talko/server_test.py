@@ -0,0 +1,599 @@
+"""End-to-end tests of the DataServer and BroadcastServer.
+
+Each test runs both servers, on Unix domain sockets, against a fresh database.
+Run from the repository root with 'python -m unittest talko.server_test'.
+"""
+
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from talko import client as client_lib
+from talko import database_client
+from talko import protocol
+from talko import server
+from talko import socket_lib
+
+# How long to wait for any single message before failing the test.
+_TIMEOUT_SECS = 10
+# The servers hand sockets to their workers by forking.
+_CONTEXT = multiprocessing.get_context('fork')
+
+# Alice (1), Bob (2) and Carol (3) all take part in chat 1.
+_FIXTURE_SQL = """
+INSERT INTO Users (user_name) VALUES ("Alice"), ("Bob"), ("Carol");
+INSERT INTO Chats (chat_name, is_private) VALUES ("Friends", 0);
+INSERT INTO Participants (chat_id, user_id) VALUES (1, 1), (1, 2), (1, 3);
+"""
+
+
+def _serve(server_cls, address, listen_socket, kwargs):
+    # Like the supervisor, run each server in its own process group so that
+    # tearing down the test also kills the processes the server started.
+    os.setpgrp()
+    server_cls(address, listen_socket=listen_socket, **kwargs).serve_forever()
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.join()
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a DataServer and a BroadcastServer for each test."""
+
+    # Extra arguments of the DataServer's and BroadcastServer's constructors.
+    data_kwargs = {}
+    broadcast_kwargs = {}
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.db_path = os.path.join(tmp_dir, 'talko.db')
+        database_client.create_database(self.db_path)
+        # NOTE(eugenhotaj): Connections must be closed before forking the
+        # servers, which would otherwise inherit them and lose their own locks
+        # on the database whenever they close the copies.
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            with connection:
+                connection.executescript(_FIXTURE_SQL)
+        self.data_address = os.path.join(tmp_dir, 'data.sock')
+        self.broadcast_address = os.path.join(tmp_dir, 'broadcast.sock')
+        self.data_server = self._start(
+                server.DataServer, self.data_address,
+                broadcast_address=self.broadcast_address,
+                db_path=self.db_path, **self.data_kwargs)
+        self.broadcast_server = self._start(
+                server.BroadcastServer, self.broadcast_address,
+                data_address=self.data_address, **self.broadcast_kwargs)
+        self.client = client_lib.Client(
+                self.data_address, self.broadcast_address)
+
+    def _start(self, server_cls, address, **kwargs):
+        # Binding the address up front means connections wait in the backlog
+        # until the server is up, so there is no need to wait for it here.
+        listen_socket = server.listen(address)
+        process = _CONTEXT.Process(
+                target=_serve,
+                args=(server_cls, address, listen_socket, kwargs))
+        process.start()
+        listen_socket.close()
+        self.addCleanup(_kill, process)
+        return process
+
+    def execute(self, sql, params=()):
+        """Runs the statement straight against the database."""
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            with connection:
+                connection.execute(sql, params)
+
+    def insert_messages(self, n_messages, user_id=1):
+        """Inserts messages straight into the database, without broadcasts."""
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            with connection:
+                connection.executemany(
+                        """INSERT INTO Messages
+                        (chat_id, user_id, message_text, message_ts)
+                        VALUES (1, ?, ?, 0)""",
+                        [(user_id, f'Message {i}') for i in range(n_messages)])
+
+    def count_messages(self, message_text):
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            query = 'SELECT COUNT(*) FROM Messages WHERE message_text = ?'
+            return connection.execute(query, (message_text,)).fetchone()[0]
+
+    def open_stream(self, user_id, last_message_id=None, events=False):
+        stream = socket_lib.connect(self.broadcast_address, _TIMEOUT_SECS)
+        self.addCleanup(stream.close)
+        request = protocol.OpenStreamRequest(user_id, last_message_id, events)
+        socket_lib.send_request('OpenStreamRequest', request.to_json(),
+                                sock=stream, keep_alive=True)
+        return stream
+
+    def wait_for_chats(self, n_chats):
+        """Waits until n_chats chats have online members.
+
+        Subscriptions on multiplexed streams have no response, so live
+        messages sent right after subscribing may be missed.
+        """
+        deadline = time.monotonic() + _TIMEOUT_SECS
+        while (self.client.get_broadcast_stats()['gauges']['index.chats'] <
+                n_chats):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(.01)
+
+    def recv_message_ids(self, stream, n_messages):
+        message_ids = []
+        for _ in range(n_messages):
+            message = json.loads(socket_lib.recv_message(stream))['result']
+            message_ids.append(message['message']['message_id'])
+        return message_ids
+
+    def assertNoMessage(self, stream):
+        stream.settimeout(.5)
+        with self.assertRaises(socket.timeout):
+            socket_lib.recv_message(stream)
+        stream.settimeout(_TIMEOUT_SECS)
+
+
+class ReplayTest(ServerTestCase):
+
+    def test_replays_missed_messages_then_streams_live(self):
+        self.insert_messages(5)
+        stream = self.open_stream(2, last_message_id=2)
+        self.assertEqual(self.recv_message_ids(stream, 3), [3, 4, 5])
+
+        message = self.client.insert_message(1, 1, 'Live')['message']
+        self.assertEqual(self.recv_message_ids(stream, 1), [6])
+        self.assertEqual(message['message_id'], 6)
+        self.assertNoMessage(stream)
+
+    def test_drops_live_messages_which_were_replayed(self):
+        self.insert_messages(5)
+        stream = self.open_stream(2, last_message_id=2)
+        self.assertEqual(self.recv_message_ids(stream, 3), [3, 4, 5])
+
+        # A broadcast which only arrives once the replay is done, for a
+        # message the replay already sent.
+        replayed = self.client.get_messages(1)['messages'][3]
+        request = protocol.BroadcastRequest.from_json(
+                {'receiver_ids': [2], 'message': replayed})
+        socket_lib.send_request('BroadcastRequest', request.to_json(),
+                                address=self.broadcast_address)
+        self.client.insert_message(1, 1, 'Live')
+        self.assertEqual(self.recv_message_ids(stream, 1), [6])
+        self.assertNoMessage(stream)
+
+    def test_broken_stream_does_not_fail_the_fanout(self):
+        broken = self.open_stream(3)
+        stream = self.open_stream(2)
+        # Wait until both streams are subscribed.
+        self.client.insert_message(1, 1, 'First')
+        self.assertEqual(self.recv_message_ids(stream, 1), [1])
+        # Closing with SO_LINGER 0 resets the connection, so the server's
+        # next send to it fails.
+        broken.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        broken.close()
+
+        for message_id in (2, 3):
+            message = self.client.insert_message(1, 1, 'Next')['message']
+            self.assertEqual(message['message_id'], message_id)
+            self.assertEqual(self.recv_message_ids(stream, 1), [message_id])
+
+
+class UpdatesTest(ServerTestCase):
+
+    def test_sync_returns_changes_since_the_cursor(self):
+        self.insert_messages(3)
+        response = self.client.sync(2)
+        self.assertEqual(
+                [m['message_id'] for m in response['messages']], [1, 2, 3])
+        self.assertEqual([c['chat_id'] for c in response['chats']], [1])
+        self.assertFalse(response['has_more'])
+
+        self.client.insert_message(1, 1, 'New')
+        response = self.client.sync(2, response['next_cursor'])
+        self.assertEqual(
+                [m['message_text'] for m in response['messages']], ['New'])
+        self.assertEqual(response['chats'], [])
+        self.assertEqual(response['joined_chat_ids'], [])
+
+    def test_sync_pages_through_messages(self):
+        self.insert_messages(server.MAX_UPDATES + 5)
+        response = self.client.sync(2)
+        self.assertEqual(len(response['messages']), server.MAX_UPDATES)
+        self.assertTrue(response['has_more'])
+        self.assertEqual(
+                response['next_cursor']['message_id'], server.MAX_UPDATES)
+
+        response = self.client.sync(2, response['next_cursor'])
+        self.assertEqual(
+                [m['message_id'] for m in response['messages']],
+                list(range(server.MAX_UPDATES + 1, server.MAX_UPDATES + 6)))
+        self.assertFalse(response['has_more'])
+
+    def test_sync_marks_chats_joined_since_the_cursor(self):
+        self.execute('INSERT INTO Chats (chat_name, is_private) '
+                     'VALUES ("Book club", 0)')
+        self.execute('INSERT INTO Participants (chat_id, user_id) '
+                     'VALUES (2, 1), (2, 3)')
+        self.execute('INSERT INTO Messages '
+                     '(chat_id, user_id, message_text, message_ts) '
+                     'VALUES (2, 1, "Before", 0)')
+        cursor = self.client.sync(2)['next_cursor']
+
+        self.execute('INSERT INTO Participants (chat_id, user_id) '
+                     'VALUES (2, 2)')
+        response = self.client.sync(2, cursor)
+        self.assertEqual([c['chat_id'] for c in response['chats']], [2])
+        self.assertEqual(response['joined_chat_ids'], [2])
+        # The history from before the cursor is left to GetMessages.
+        self.assertEqual(response['messages'], [])
+        messages = self.client.get_messages(2)['messages']
+        self.assertEqual([m['message_text'] for m in messages], ['Before'])
+
+
+class TracingTest(ServerTestCase):
+
+    def test_traces_messages_through_both_servers(self):
+        stream = self.open_stream(2)
+        response = self.client.insert_message(1, 1, 'Traced', trace=True)
+        message = json.loads(socket_lib.recv_message(stream))
+
+        self.assertEqual(
+                message['result']['message'], response['message'])
+        trace = message['trace']
+        names = [name for name, _ in trace['events']]
+        self.assertEqual(names, [
+                'client.send', 'data.recv', 'db.start', 'db.insert',
+                'db.get_user', 'data.broadcast', 'broadcast.recv',
+                'broadcast.fanout'])
+        timestamps = [ts_ms for _, ts_ms in trace['events']]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_untraced_messages_have_no_trace(self):
+        stream = self.open_stream(2)
+        self.client.insert_message(1, 1, 'Untraced')
+        message = json.loads(socket_lib.recv_message(stream))
+        self.assertNotIn('trace', message)
+
+
+class ResumeFailureTest(ServerTestCase):
+
+    # A DataServer with a single worker and a tiny queue, which rejects all
+    # requests while the worker serves a persistent connection.
+    data_kwargs = {
+            'max_workers': 1, 'max_queue': 1, 'queue_timeout_secs': .05}
+
+    def occupy_data_server(self):
+        self.data_connection = socket_lib.connect(
+                self.data_address, _TIMEOUT_SECS)
+        self.addCleanup(self.data_connection.close)
+        request = protocol.GetUserRequest(1)
+        socket_lib.send_request('GetUser', request.to_json(),
+                                sock=self.data_connection, keep_alive=True)
+
+    def test_failed_replay_unsubscribes_the_stream(self):
+        self.insert_messages(5)
+        self.occupy_data_server()
+        # The error is sent back instead of the OpenStreamResponse.
+        with self.assertRaises(socket_lib.OverloadedError):
+            self.open_stream(2, last_message_id=2)
+
+        gauges = self.client.get_broadcast_stats()['gauges']
+        self.assertEqual(gauges['streams.open'], 0)
+        self.assertEqual(gauges['streams.replaying'], 0)
+
+    def test_client_reopens_the_stream_once_the_replay_succeeds(self):
+        self.insert_messages(5)
+        self.occupy_data_server()
+        stream = self.client.open_stream(2, last_message_id=2)
+        free = threading.Timer(.5, self.data_connection.close)
+        free.start()
+        self.addCleanup(free.cancel)
+
+        message_ids = [next(stream)['message']['message_id'] for _ in range(3)]
+        self.assertEqual(message_ids, [3, 4, 5])
+        stream.close()
+
+    def test_failed_subscription_keeps_the_multiplexed_stream_open(self):
+        stream = socket_lib.connect(self.broadcast_address, _TIMEOUT_SECS)
+        self.addCleanup(stream.close)
+        request = protocol.OpenMultiplexedStreamRequest()
+        socket_lib.send_request('OpenMultiplexedStreamRequest',
+                                request.to_json(), sock=stream,
+                                keep_alive=True)
+        self.occupy_data_server()
+
+        socket_lib.send_notification(stream, 'BogusRequest', {})
+        request = protocol.SubscribeRequest(2)
+        socket_lib.send_notification(
+                stream, 'SubscribeRequest', request.to_json())
+        frame = json.loads(socket_lib.recv_message(stream))['result']
+        self.assertEqual(frame['receiver_ids'], [2])
+        self.assertIn('reason', frame)
+
+        self.data_connection.close()
+        socket_lib.send_notification(
+                stream, 'SubscribeRequest', request.to_json())
+        self.wait_for_chats(1)
+        self.client.insert_message(1, 1, 'Hello')
+        self.assertEqual(self.recv_message_ids(stream, 1), [1])
+
+
+class ChatMembershipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = server._ChatIndex()
+
+    def test_indexes_online_users_by_chat(self):
+        self.index.add_user(1, [1, 2])
+        self.index.add_user(2, [2])
+
+        self.assertEqual(self.index.members(1), [1])
+        self.assertEqual(sorted(self.index.members(2)), [1, 2])
+        self.assertEqual(self.index.members(3), [])
+        self.assertEqual(sorted(self.index.online_users()), [1, 2])
+        self.assertEqual(self.index.n_chats(), 2)
+
+    def test_removed_users_leave_all_their_chats(self):
+        self.index.add_user(1, [1, 2])
+        self.index.add_user(2, [2])
+        self.index.remove_user(1)
+
+        self.assertEqual(self.index.members(1), [])
+        self.assertEqual(self.index.members(2), [2])
+        self.assertEqual(self.index.online_users(), [2])
+        # Chats without online members are dropped.
+        self.assertEqual(self.index.n_chats(), 1)
+
+    def test_only_online_users_are_added_to_chats(self):
+        # Users are online, without chats, until their chats are looked up.
+        self.index.add_user(1)
+        self.index.add_members(3, [1, 2])
+
+        self.assertEqual(self.index.members(3), [1])
+        self.index.add_user(1, [1])
+        self.assertEqual(self.index.members(1), [1])
+        self.assertEqual(self.index.members(3), [1])
+
+
+class DrainEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = server._ChatIndex()
+
+    def test_presence_is_coalesced_per_user(self):
+        self.index.add_user(1, [1], events=True)
+        self.index.drain_events()
+        # Bob comes online twice and goes offline within the window.
+        self.index.add_user(2, [1])
+        self.index.add_members(1, [2])
+        self.index.remove_user(2)
+
+        self.assertEqual(self.index.drain_events(), {1: ([(2, False)], [])})
+        self.assertEqual(self.index.drain_events(), {})
+
+    def test_new_event_streams_get_a_presence_snapshot(self):
+        self.index.add_user(1, [1])
+        self.index.add_user(3, [2])
+        self.index.add_user(2, [1, 2], events=True)
+
+        frames = self.index.drain_events()
+        presence, typing = frames[2]
+        self.assertEqual(sorted(presence), [(1, True), (3, True)])
+        self.assertEqual(typing, [])
+        # Only streams which asked for events get frames.
+        self.assertEqual(list(frames), [2])
+
+    def test_typing_is_capped_and_not_echoed(self):
+        n_users = server.MAX_TYPING_EVENTS + 2
+        for user_id in range(1, n_users + 1):
+            self.index.add_user(user_id, [1], events=True)
+        self.index.drain_events()
+        for user_id in range(1, n_users + 1):
+            self.index.add_typing(1, user_id)
+            self.index.add_typing(1, user_id)
+        # Users who aren't online members of the chat are ignored.
+        self.index.add_typing(2, 1)
+        self.index.add_typing(1, n_users + 1)
+
+        frames = self.index.drain_events()
+        typists = list(range(1, server.MAX_TYPING_EVENTS + 1))
+        self.assertEqual(
+                frames[1], ([], [(1, user_id) for user_id in typists[1:]]))
+        self.assertEqual(
+                frames[n_users], ([], [(1, user_id) for user_id in typists]))
+
+
+class EventStreamTest(ServerTestCase):
+
+    def recv_frame(self, stream):
+        return json.loads(socket_lib.recv_message(stream))['result']
+
+    def test_typing_is_rate_limited_and_coalesced(self):
+        self.open_stream(1)
+        stream = self.open_stream(2, events=True)
+        # The first frame tells Bob who is already online.
+        frame = self.recv_frame(stream)
+        self.assertEqual(frame['presence'], [{'user_id': 1, 'online': True}])
+
+        _, burst = server.TYPING_RATE_LIMIT
+        # Sent straight to the server, since the Client throttles them.
+        request = protocol.TypingRequest(1, 1)
+        for _ in range(burst + 1):
+            socket_lib.send_request('TypingRequest', request.to_json(),
+                                    address=self.broadcast_address)
+
+        frame = self.recv_frame(stream)
+        self.assertEqual(frame['typing'], [{'chat_id': 1, 'user_id': 1}])
+        counters = self.client.get_broadcast_stats()['counters']
+        self.assertEqual(counters['events.typing'], burst)
+        self.assertEqual(counters['events.dropped'], 1)
+
+
+class ChatIndexTest(ServerTestCase):
+
+    def test_broadcasts_reach_only_the_chat_members(self):
+        carol = self.open_stream(3)
+        bob = self.open_stream(2)
+        request = protocol.InsertChatRequest('Duo', [1, 3])
+        chat = socket_lib.send_request(
+                'InsertChat', request.to_json(),
+                address=self.data_address)['chat']
+
+        self.client.insert_message(chat['chat_id'], 1, 'Hi Carol')
+        message = json.loads(socket_lib.recv_message(carol))['result']
+        self.assertEqual(message['message']['message_text'], 'Hi Carol')
+        self.assertNoMessage(bob)
+
+    def test_failed_chat_lookup_takes_the_user_offline(self):
+        _kill(self.data_server)
+        with self.assertRaises(ConnectionError):
+            self.open_stream(2)
+
+        # Adding an offline user to a chat is a no-op.
+        request = protocol.MembershipChangeRequest(1, [2])
+        socket_lib.send_request('MembershipChangeRequest', request.to_json(),
+                                address=self.broadcast_address)
+        gauges = self.client.get_broadcast_stats()['gauges']
+        self.assertEqual(gauges['streams.open'], 0)
+        self.assertEqual(gauges['index.chats'], 0)
+
+
+class StatsTest(ServerTestCase):
+
+    def test_records_requests_and_errors_per_method(self):
+        for _ in range(2):
+            self.client.get_user(1)
+        with self.assertRaises(socket_lib.RPCError):
+            self.client.get_version()
+
+        stats = self.client.get_stats()
+        self.assertEqual(stats['histograms']['rpc.GetUser']['count'], 2)
+        self.assertEqual(stats['histograms']['db.get_user']['count'], 2)
+        self.assertEqual(stats['counters']['errors.GetUser'], 0)
+        self.assertEqual(stats['counters']['errors.GetVersion'], 1)
+
+    def test_broadcast_server_records_fanouts(self):
+        stream = self.open_stream(2)
+        self.client.insert_message(1, 1, 'Hello')
+        self.recv_message_ids(stream, 1)
+
+        stats = self.client.get_broadcast_stats()
+        self.assertEqual(
+                stats['histograms']['rpc.BroadcastChatRequest']['count'], 1)
+        self.assertEqual(stats['histograms']['fanout']['count'], 1)
+        self.assertEqual(stats['counters']['deliveries.sent'], 1)
+        self.assertEqual(stats['gauges']['streams.open'], 1)
+
+
+class ProfilingTest(ServerTestCase):
+
+    def test_invalid_params_are_rejected(self):
+        for sample_rate, mode in ((.5, 'bogus'), (2, 'cprofile')):
+            with self.assertRaises(socket_lib.RPCError) as context:
+                self.client.set_profiling(sample_rate, mode)
+            self.assertEqual(
+                    context.exception.code, socket_lib.INVALID_PARAMS)
+        self.assertEqual(self.client.get_user(1)['user']['user_name'], 'Alice')
+
+    def test_unknown_methods_are_not_profiled(self):
+        profile_dir = self.client.set_profiling(1)['profile_dir']
+        with self.assertRaises(ConnectionError):
+            socket_lib.send_request('../GetUser', {'user_id': 1},
+                                    address=self.data_address)
+        self.client.get_user(1)
+
+        paths = self.client.dump_profiles()['paths']
+        self.assertIn(os.path.join(profile_dir, 'GetUser.pstats'), paths)
+        self.assertEqual(
+                [path for path in paths if not path.startswith(profile_dir)],
+                [])
+        parent_dir = os.path.dirname(profile_dir)
+        self.assertEqual(glob.glob(os.path.join(parent_dir, 'GetUser.*')), [])
+
+
+class OverloadTest(ServerTestCase):
+
+    # A BroadcastServer with a single worker and a tiny queue, which rejects
+    # all requests while the worker serves a multiplexed stream.
+    broadcast_kwargs = {
+            'max_workers': 1, 'max_queue': 1, 'queue_timeout_secs': .05}
+
+    def test_rejected_broadcast_does_not_repeat_the_write(self):
+        stream = socket_lib.connect(self.broadcast_address, _TIMEOUT_SECS)
+        self.addCleanup(stream.close)
+        request = protocol.OpenMultiplexedStreamRequest()
+        socket_lib.send_request('OpenMultiplexedStreamRequest',
+                                request.to_json(), sock=stream,
+                                keep_alive=True)
+
+        message = self.client.insert_message(1, 1, 'Once')['message']
+
+        self.assertEqual(message['message_text'], 'Once')
+        self.assertEqual(self.count_messages('Once'), 1)
+        stats = self.client.get_stats()
+        self.assertEqual(stats['counters']['broadcast.failed'], 1)
+
+    def test_rate_limited_writes_are_retried_and_written_once(self):
+        _, burst = server.WRITE_RATE_LIMIT
+        n_messages = 0
+        # Writes are much faster than the rate limit, so the user soon runs
+        # out of tokens and has their writes retried.
+        while not self.client.get_stats()['counters']['rate_limited']:
+            self.assertLess(n_messages, 10 * burst)
+            for _ in range(10):
+                self.client.insert_message(1, 1, 'Limited')
+            n_messages += 10
+
+        self.assertEqual(self.count_messages('Limited'), n_messages)
+
+
+class DrainTest(ServerTestCase):
+
+    def test_drain_finishes_replay(self):
+        # Enough messages for the replay to take several GetUpdates.
+        n_messages = 3 * server.MAX_UPDATES
+        self.insert_messages(n_messages)
+        stream = self.open_stream(2, last_message_id=0)
+        os.kill(self.broadcast_server.pid, signal.SIGTERM)
+
+        message_ids = self.recv_message_ids(stream, n_messages)
+        self.assertEqual(message_ids, list(range(1, n_messages + 1)))
+        self.broadcast_server.join(server.DRAIN_TIMEOUT_SECS + _TIMEOUT_SECS)
+        self.assertEqual(self.broadcast_server.exitcode, 0)
+
+    def test_drain_closes_idle_connections(self):
+        connection = socket_lib.connect(self.data_address, _TIMEOUT_SECS)
+        self.addCleanup(connection.close)
+        request = protocol.GetUserRequest(1)
+        response = socket_lib.send_request(
+                'GetUser', request.to_json(), sock=connection,
+                keep_alive=True)
+        self.assertEqual(response['user']['user_name'], 'Alice')
+
+        os.kill(self.data_server.pid, signal.SIGTERM)
+
+        self.assertEqual(connection.recv(1), b'')
+        self.data_server.join(server.DRAIN_TIMEOUT_SECS + _TIMEOUT_SECS)
+        self.assertEqual(self.data_server.exitcode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,40 +6,241 @@ the payload in bytes. The payload consists of one, and only one, pickled Python
 object defined in protocol.py. Because we control.
 """
 
+import asyncio
 import collections
 import dataclasses
 import errno
 import json
+import random
 import socket 
+import time
 import uuid
 
 HEADER_BYTES = 10
 PACKET_BYTES = 4096
+_RESULT_PREFIX = b'{"result": '
+
+# JSON-RPC error code (from the range reserved for server errors) returned when
+# a request is not processed because the server is overloaded, or the user is
+# over their rate limit.
+OVERLOADED = -32000
+# The standard JSON-RPC error code returned for requests with invalid params.
+INVALID_PARAMS = -32602
+# The number of times send_request() retries overloaded requests and the bounds
+# of the (exponential) backoff between the retries.
+MAX_RETRIES = 3
+_RETRY_BASE_SECS = .05
+_RETRY_MAX_SECS = 2
+
+
+class RPCError(Exception):
+    """An error returned by the server instead of a result."""
+
+    # How long the server asked the client to wait before retrying.
+    retry_after_secs = 0
+
+    def __init__(self, code, message, data=None):
+        super().__init__(f'{message} (code {code})')
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_json(self):
+        error = {'code': self.code, 'message': self.message}
+        if self.data is not None:
+            error['data'] = self.data
+        return error
+
+    @classmethod
+    def from_json(cls, error):
+        if error['code'] == OVERLOADED:
+            return OverloadedError(
+                    error['data']['retry_after_ms'] / 1000, error['message'])
+        return cls(error['code'], error['message'], error.get('data'))
+
+
+class OverloadedError(RPCError):
+    """The request was rejected before being processed, and may be retried.
+
+    Returned when the server is overloaded or the user is over their rate
+    limit. Since the request was not processed, it is safe to retry even
+    non-idempotent requests after 'retry_after_secs'.
+    """
+
+    def __init__(self, retry_after_secs, message='Overloaded'):
+        super().__init__(
+                OVERLOADED, message,
+                {'retry_after_ms': int(retry_after_secs * 1000)})
+        self.retry_after_secs = retry_after_secs
+
+
+def encode_error(error, id_):
+    """Returns a JSON-RPC error response object for the RPCError."""
+    return {'error': error.to_json(), 'id': id_}
+
+
+def retry_delay(attempt, error):
+    """Returns how long to wait before retrying a failed request.
+
+    Backs off exponentially with the number of attempts, but never retries
+    sooner than the server asked for. The delay is jittered so that clients
+    rejected together don't all retry at the same time.
+    """
+    delay = min(_RETRY_BASE_SECS * 2**attempt, _RETRY_MAX_SECS)
+    delay = max(delay, error.retry_after_secs)
+    return delay * random.uniform(.5, 1.5)
+
+
+def address_family(address):
+    """Returns the socket family of the address.
+
+    Addresses are either (host, port) tuples, for TCP sockets, or filesystem
+    paths, for Unix domain sockets. Unix domain sockets skip the TCP/IP stack
+    altogether, so they have lower latency when all services run on one host.
+    """
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+def connect(address, timeout=None):
+    """Returns a new socket connected to the (TCP or Unix domain) address."""
+    sock = socket.socket(address_family(address), socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_connection_async(address):
+    """Returns the asyncio (reader, writer) streams connected to the address."""
+    if address_family(address) == socket.AF_UNIX:
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+def _encode_message(message):
+    message = bytes(message, 'utf-8')
+    return bytes(f'{len(message):<{HEADER_BYTES}}', 'utf-8') + message
 
 
 def send_message(sock, message):
     """Sends the string message using the socket."""
-    message = f'{len(message):<{HEADER_BYTES}}{message}'
-    message = bytes(message, 'utf-8')
-    sock.send(message)
+    sock.sendall(_encode_message(message))
+
+
+def try_send_message(sock, message):
+    """Sends the string message, unless the socket's send buffer is full.
+
+    Unlike send_message(), does not wait for a slow receiver to catch up.
+    Returns whether the message was sent.
+    """
+    data = _encode_message(message)
+    try:
+        n_sent = sock.send(data, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return False
+    # Once part of the message is out, the rest must follow or the receiver
+    # can no longer tell where messages start.
+    sock.sendall(data[n_sent:])
+    return True
 
 
 def _recv_bytes(sock, n_bytes):
-    """Receives n_bytes from the socket and decodes them to utf-8 strings."""
-    return sock.recv(n_bytes).decode('utf-8')
+    """Receives exactly n_bytes from the socket."""
+    data = []
+    while n_bytes:
+        packet = sock.recv(min(n_bytes, PACKET_BYTES))
+        if not packet:
+            raise ConnectionResetError('Socket closed by peer.')
+        data.append(packet)
+        n_bytes -= len(packet)
+    return b''.join(data)
+
 
+def recv_message(sock, decode=True): 
+    """Receives a full string message from the socket.
 
-def recv_message(sock): 
-    """Receives a full string message from the socket."""
+    Args:
+        sock: The socket to receive the message from.
+        decode: If False, returns the raw utf-8 encoded bytes of the message.
+    Raises:
+        ConnectionResetError: If the socket is closed before a full message
+            is received.
+    """
     message_size = int(_recv_bytes(sock, HEADER_BYTES))
-    received_size = 0
-    message = []
-    while received_size < message_size:
-        n_bytes = min(message_size - received_size, PACKET_BYTES)
-        message.append(_recv_bytes(sock, n_bytes))
-        received_size += n_bytes
-    message = ''.join(message)
-    return message
+    message = _recv_bytes(sock, message_size)
+    return message.decode('utf-8') if decode else message
+
+
+async def send_message_async(writer, message):
+    """Sends the string message using the asyncio StreamWriter."""
+    writer.write(_encode_message(message))
+    await writer.drain()
+
+
+async def recv_message_async(reader):
+    """Receives a full string message from the asyncio StreamReader.
+
+    Raises:
+        ConnectionResetError: If the stream is closed before a full message
+            is received.
+    """
+    try:
+        message_size = int(await reader.readexactly(HEADER_BYTES))
+        message = await reader.readexactly(message_size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError('Stream closed by peer.')
+    return message.decode('utf-8')
+
+
+def encode_request(method, params, trace=None):
+    """Returns a new JSON-RPC request object for the given method.
+
+    If a 'trace' is given (see the tracing module), it is propagated in the 
+    request's 'trace' field.
+    """
+    request = {'jsonrpc': '2.0', 'method': method, 'params': params}
+    if trace is not None:
+        request['trace'] = trace
+    request['id'] = uuid.uuid4().int
+    return request
+
+
+def send_notification(sock, method, params):
+    """Sends a JSON-RPC notification, i.e. a request without a response."""
+    request = {'jsonrpc': '2.0', 'method': method, 'params': params}
+    send_message(sock, json.dumps(request))
+
+
+def decode_response(request, response):
+    """Returns the result of the (string) response to the given request.
+
+    Raises:
+        RPCError: If the server responded with an error.
+    """
+    response = json.loads(response)
+    if 'error' in response:
+        # NOTE(eugenhotaj): The id may be 'None' if the server rejected the
+        # request without reading it.
+        raise RPCError.from_json(response['error'])
+    assert request['id'] == response['id']
+    return response['result']
+
+
+def extract_raw_result(request, response):
+    """Returns the undecoded JSON bytes of the result in the (bytes) response.
+
+    Servers encode responses as '{"result": <result>, "id": <id>}', so the 
+    result can be sliced out of the response without decoding the JSON. Falls
+    back to decoding and re-encoding the result for any other layout.
+    """
+    suffix = bytes(f', "id": {request["id"]}}}', 'utf-8')
+    if response.startswith(_RESULT_PREFIX) and response.endswith(suffix):
+        return response[len(_RESULT_PREFIX):-len(suffix)]
+    result = decode_response(request, response)
+    return bytes(json.dumps(result), 'utf-8')
 
 
 def send_request(
@@ -47,7 +248,9 @@ def send_request(
         params, 
         sock=None,
         address=None, 
-        keep_alive=False):
+        keep_alive=False,
+        raw=False,
+        trace=None):
     """Sends a JSON-RPC request to the given address.
 
     Args:
@@ -55,32 +258,69 @@ def send_request(
         params: The RPC method parameters.
         sock: The socket to use for sending the request and receiving the
             response. If 'None', the 'address' field must be given.        
-        address: The (host, port) tuple address where to send the request and
-            receive the response. Must be 'None' if a 'sock' is provided.
+        address: The (host, port) tuple, or Unix domain socket path, where to
+            send the request and receive the response. Must be 'None' if a
+            'sock' is provided.
         keep_alive: If True, does not close the socket before returning. Setting
             this to 'True' is only meaningful if a 'sock' is provided.
+        raw: If True, returns the result as undecoded JSON bytes.
+        trace: The trace to propagate with the request, if any.
     Returns:
         The response or 'None'.
+    Raises:
+        RPCError: If the server responded with an error. OverloadedErrors are
+            first retried up to MAX_RETRIES times, with backoff, if an
+            'address' is given.
     """
     if bool(sock) == bool(address):
         raise ValueError(
                 "One, and only one, 'sock' or 'address' must be provided.")
+    attempt = 0
+    while True:
+        try:
+            return _send_request(
+                    method, params, sock, address, keep_alive, raw, trace)
+        except OverloadedError as error:
+            # The server may have closed the connection, so only retry if we
+            # can reconnect.
+            if sock or attempt == MAX_RETRIES:
+                raise
+            time.sleep(retry_delay(attempt, error))
+            attempt += 1
+
+
+def _send_request(method, params, sock, address, keep_alive, raw, trace):
     if not sock:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(address)
+        sock = connect(address)
 
-    request = {
-            'jsonrpc': '2.0', 
-            'method': method, 
-            'params': params, 
-            'id': uuid.uuid4().int
-    }
-    send_message(sock, json.dumps(request))
-    response = json.loads(recv_message(sock))
-    assert request['id'] == response['id']
+    request = encode_request(method, params, trace)
+    try:
+        send_message(sock, json.dumps(request))
+        response = recv_message(sock, decode=not raw)
+    finally:
+        if not keep_alive:
+            sock.close()
+    if raw:
+        return extract_raw_result(request, response)
+    return decode_response(request, response)
 
-    if not keep_alive:
-        sock.close()
-    # TODO(eugenhotaj): We can't assume that the response succeeded here. 
-    # We also need to handle response['error'] correctly.
-    return response['result']
+
+async def send_request_async(method, params, reader, writer, trace=None):
+    """Sends a JSON-RPC request over the given asyncio streams.
+
+    Unlike send_request(), the streams are always kept alive so they can be
+    reused for further requests.
+
+    Args:
+        method: The RPC method name.
+        params: The RPC method parameters.
+        reader: The asyncio StreamReader to receive the response from.
+        writer: The asyncio StreamWriter to send the request with.
+        trace: The trace to propagate with the request, if any.
+    Returns:
+        The response or 'None'.
+    """
+    request = encode_request(method, params, trace)
+    await send_message_async(writer, json.dumps(request))
+    response = await recv_message_async(reader)
+    return decode_response(request, response)
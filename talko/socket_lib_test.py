@@ -0,0 +1,123 @@
+"""Tests of the socket_lib's JSON-RPC helpers and addressing.
+
+Run from the repository root with 'python -m unittest talko.socket_lib_test'.
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from talko import server
+from talko import socket_lib
+
+# How long to wait for any single message before failing the test.
+_TIMEOUT_SECS = 10
+
+
+class ExtractRawResultTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = socket_lib.encode_request('GetUser', {'user_id': 1})
+        self.result = {'user': {'user_id': 1, 'user_name': 'Alice'}}
+
+    def test_slices_the_result_out_of_server_responses(self):
+        result = b'{"user": {"user_id": 1, "user_name": "Alice"}}'
+        # The servers encode their responses with json.dumps().
+        response = json.dumps({'result': self.result, 'id': self.request['id']})
+
+        raw = socket_lib.extract_raw_result(
+                self.request, bytes(response, 'utf-8'))
+        self.assertEqual(raw, result)
+
+    def test_reencodes_the_result_of_other_layouts(self):
+        response = json.dumps(
+                {'id': self.request['id'], 'jsonrpc': '2.0',
+                 'result': self.result})
+
+        raw = socket_lib.extract_raw_result(
+                self.request, bytes(response, 'utf-8'))
+        self.assertEqual(json.loads(raw), self.result)
+
+    def test_raises_errors(self):
+        error = socket_lib.OverloadedError(.5)
+        response = json.dumps(socket_lib.encode_error(error, None))
+
+        with self.assertRaises(socket_lib.OverloadedError) as context:
+            socket_lib.extract_raw_result(
+                    self.request, bytes(response, 'utf-8'))
+        self.assertEqual(context.exception.retry_after_secs, .5)
+
+
+class AddressTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.socket_path = os.path.join(tmp_dir, 'test.sock')
+
+    def listen(self, address):
+        """Returns the listening socket and the address it's bound to."""
+        listen_socket = server.listen(address)
+        self.addCleanup(listen_socket.close)
+        return listen_socket, listen_socket.getsockname()
+
+    def assertRoundTrips(self, listen_socket, address):
+        sock = socket_lib.connect(address, _TIMEOUT_SECS)
+        self.addCleanup(sock.close)
+        peer_socket, _ = listen_socket.accept()
+        self.addCleanup(peer_socket.close)
+
+        socket_lib.send_message(sock, 'ping')
+        self.assertEqual(socket_lib.recv_message(peer_socket), 'ping')
+
+    def test_address_family(self):
+        self.assertEqual(
+                socket_lib.address_family(('localhost', 8000)),
+                socket.AF_INET)
+        self.assertEqual(
+                socket_lib.address_family(self.socket_path), socket.AF_UNIX)
+
+    def test_tcp_addresses(self):
+        listen_socket, address = self.listen(('localhost', 0))
+        self.assertEqual(listen_socket.family, socket.AF_INET)
+        self.assertRoundTrips(listen_socket, address)
+
+    def test_unix_domain_socket_addresses(self):
+        listen_socket, address = self.listen(self.socket_path)
+        self.assertEqual(listen_socket.family, socket.AF_UNIX)
+        self.assertEqual(address, self.socket_path)
+        self.assertRoundTrips(listen_socket, address)
+
+    def test_listen_replaces_stale_socket_files(self):
+        listen_socket, _ = self.listen(self.socket_path)
+        listen_socket.close()
+        self.assertTrue(os.path.exists(self.socket_path))
+
+        listen_socket, address = self.listen(self.socket_path)
+        self.assertRoundTrips(listen_socket, address)
+
+    def test_connecting_to_missing_socket_files_fails(self):
+        with self.assertRaises(FileNotFoundError):
+            socket_lib.connect(self.socket_path)
+
+    def test_async_connections(self):
+        for address in (('localhost', 0), self.socket_path):
+            listen_socket, address = self.listen(address)
+
+            async def send():
+                _, writer = await socket_lib.open_connection_async(address)
+                await socket_lib.send_message_async(writer, 'ping')
+                writer.close()
+
+            asyncio.run(send())
+            peer_socket, _ = listen_socket.accept()
+            self.addCleanup(peer_socket.close)
+            self.assertEqual(socket_lib.recv_message(peer_socket), 'ping')
+
+
+if __name__ == '__main__':
+    unittest.main()
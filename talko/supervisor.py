@@ -0,0 +1,250 @@
+"""Runs the servers in child processes and keeps them running.
+
+The Supervisor binds the servers' listening sockets itself and hands them to
+each server process it starts. Since the sockets outlive the servers:
+
+    1. Connections which arrive while a server (re)starts wait in the socket's
+        backlog until the server is up, instead of being refused.
+    2. Restarting a server (e.g. on SIGHUP after a deploy) first starts a new
+        generation of the server on the same socket, waits until it is ready
+        and only then drains the old generation. For a moment, both accept
+        connections.
+
+Servers tell the supervisor that they're ready over a pipe, once they accept
+connections, so nobody has to guess how long they take to start. Servers which
+crash are restarted with exponential backoff.
+"""
+
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import time
+
+from talko import server
+
+# How long a server may take to become ready before it's considered broken.
+READY_TIMEOUT_SECS = 30
+# Crashed servers are restarted after _MIN_BACKOFF_SECS, doubling with every
+# crash up to _MAX_BACKOFF_SECS. Servers which ran for _STABLE_SECS before
+# crashing start over from _MIN_BACKOFF_SECS.
+_MIN_BACKOFF_SECS = .1
+_MAX_BACKOFF_SECS = 10
+_STABLE_SECS = 60
+# How much longer than the drain itself old generations may take to exit.
+_EXIT_GRACE_SECS = 1
+
+# NOTE(eugenhotaj): Servers are started with 'spawn' rather than 'fork' so
+# that every new generation runs the code currently on disk, e.g. after a
+# deploy, instead of a copy of the supervisor's.
+_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def _serve(server_cls, address, kwargs, listen_socket, ready):
+    # Spawned processes default to spawning their own children too, but the
+    # servers hand sockets to their workers by forking.
+    multiprocessing.set_start_method('fork', force=True)
+    # Each server gets its own process group, so Ctrl-C in a terminal only
+    # reaches the supervisor (which drains the servers), and the processes a
+    # crashed server leaves behind can be killed along with it.
+    os.setpgrp()
+    server_ = server_cls(address, listen_socket=listen_socket, **kwargs)
+
+    def on_ready():
+        ready.send(True)
+        ready.close()
+
+    server_.serve_forever(on_ready)
+
+
+def _kill(process):
+    """Kills the process and any processes it left behind."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.join()
+
+
+class _Child:
+    """A supervised server and its current process."""
+
+    def __init__(self, server_cls, address, kwargs):
+        self.server_cls = server_cls
+        self.address = address
+        self.kwargs = kwargs
+        self.name = f'{server_cls.__name__}-{server._address_name(address)}'
+        self.listen_socket = None
+        self.process = None
+        self.started_secs = 0
+        self.n_crashes = 0
+        self.restart_secs = 0
+
+
+class Supervisor:
+    """Starts servers, waits until they are ready and keeps them running.
+
+    Once running, sending SIGHUP to the supervisor restarts all the servers
+    without refusing connections and SIGTERM (or SIGINT) drains and stops them.
+    """
+
+    def __init__(self):
+        self._children = []
+        # Old generations which are draining, as (process, deadline) tuples.
+        self._retiring = []
+        self._restart = False
+        self._stop = False
+        self._wakeup = None
+
+    def add(self, server_cls, address, **kwargs):
+        """Adds a server to start and supervise.
+
+        Args:
+            server_cls: The Server subclass to run.
+            address: The address to listen on.
+            kwargs: Any other arguments of the server_cls's constructor.
+        """
+        self._children.append(_Child(server_cls, address, kwargs))
+
+    def _start(self, child):
+        """Starts a new generation of the child and waits until it's ready.
+
+        Returns:
+            The new process, or 'None' if it exited or timed out before it
+            became ready.
+        """
+        receiver, sender = _CONTEXT.Pipe(duplex=False)
+        process = _CONTEXT.Process(
+                target=_serve,
+                args=(child.server_cls, child.address, child.kwargs,
+                      child.listen_socket, sender),
+                name=child.name)
+        process.start()
+        # Only the child holds the sending end now, so the receiver sees EOF
+        # if the child exits before it's ready.
+        sender.close()
+        try:
+            if receiver.poll(READY_TIMEOUT_SECS) and receiver.recv():
+                return process
+        except EOFError:
+            pass
+        finally:
+            receiver.close()
+        logging.error(f'{child.name} did not become ready.')
+        _kill(process)
+        return None
+
+    def _retire(self, process):
+        """Drains the (old generation) process in the background."""
+        process.terminate()
+        deadline = (
+                time.monotonic() + server.DRAIN_TIMEOUT_SECS +
+                _EXIT_GRACE_SECS)
+        self._retiring.append((process, deadline))
+
+    def _reap(self):
+        """Restarts crashed children and cleans up the retired ones."""
+        now = time.monotonic()
+        for child in self._children:
+            if child.process and not child.process.is_alive():
+                logging.error(
+                        f'{child.name} exited with code '
+                        f'{child.process.exitcode}, restarting.')
+                _kill(child.process)
+                child.process.close()
+                child.process = None
+                if now - child.started_secs > _STABLE_SECS:
+                    child.n_crashes = 0
+                child.restart_secs = now + min(
+                        _MAX_BACKOFF_SECS,
+                        _MIN_BACKOFF_SECS * 2 ** child.n_crashes)
+                child.n_crashes += 1
+            if not child.process and now >= child.restart_secs:
+                child.process = self._start(child)
+                child.started_secs = time.monotonic()
+                if not child.process:
+                    child.restart_secs = now + _MAX_BACKOFF_SECS
+
+        retiring = []
+        for process, deadline in self._retiring:
+            if process.is_alive() and now <= deadline:
+                retiring.append((process, deadline))
+                continue
+            _kill(process)
+            process.close()
+        self._retiring = retiring
+
+    def _restart_all(self):
+        """Replaces every child with a new generation, once it is ready."""
+        for child in self._children:
+            process = self._start(child)
+            if not process:
+                logging.error(f'Keeping the old generation of {child.name}.')
+                continue
+            if child.process:
+                self._retire(child.process)
+            child.process = process
+            child.started_secs = time.monotonic()
+            child.n_crashes = 0
+
+    def _handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._restart = True
+        elif signum != signal.SIGCHLD:
+            self._stop = True
+        # Wakes up the supervision loop.
+        try:
+            self._wakeup.send(b'\0')
+        except BlockingIOError:
+            # The loop has yet to wake up from earlier signals.
+            pass
+
+    def run_forever(self, on_ready=None):
+        """Starts the servers and supervises them until SIGTERM or SIGINT.
+
+        Args:
+            on_ready: Called once all the servers are ready.
+        Raises:
+            RuntimeError: If a server does not start.
+        """
+        wakeup, self._wakeup = socket.socketpair()
+        self._wakeup.setblocking(False)
+        # NOTE(eugenhotaj): The servers' own children inherit the pipes behind
+        # the processes' sentinels, so we find out about exited servers via
+        # SIGCHLD instead.
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGCHLD):
+            signal.signal(signum, self._handle_signal)
+        for child in self._children:
+            child.listen_socket = server.listen(child.address)
+        for child in self._children:
+            child.process = self._start(child)
+            if not child.process:
+                raise RuntimeError(f'{child.name} did not start.')
+            child.started_secs = time.monotonic()
+        if on_ready:
+            on_ready()
+
+        while not self._stop:
+            timeout = None
+            if self._retiring or any(not c.process for c in self._children):
+                timeout = _MIN_BACKOFF_SECS
+            if select.select([wakeup], [], [], timeout)[0]:
+                wakeup.recv(1024)
+            if self._restart:
+                self._restart = False
+                self._restart_all()
+            self._reap()
+
+        for child in self._children:
+            if child.process:
+                self._retire(child.process)
+        for process, deadline in self._retiring:
+            process.join(max(deadline - time.monotonic(), 0))
+            _kill(process)
+        for child in self._children:
+            child.listen_socket.close()
+        wakeup.close()
+        self._wakeup.close()
@@ -0,0 +1,114 @@
+"""Tests of the Supervisor's readiness handshake, restarts and handoffs.
+
+The supervisor runs a DataServer on a Unix domain socket, against a fresh
+database.
+Run from the repository root with 'python -m unittest talko.supervisor_test'.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import shutil
+import signal
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from talko import database_client
+from talko import protocol
+from talko import server
+from talko import socket_lib
+from talko import supervisor as supervisor_lib
+
+# How long to wait for any single request or handoff before failing the test.
+_TIMEOUT_SECS = 30
+_CONTEXT = multiprocessing.get_context('fork')
+
+
+def _supervise(data_address, db_path, ready):
+    supervisor = supervisor_lib.Supervisor()
+    supervisor.add(
+            server.DataServer,
+            data_address,
+            broadcast_address=None,
+            db_path=db_path)
+
+    def on_ready():
+        ready.send([child.process.pid for child in supervisor._children])
+        ready.close()
+
+    supervisor.run_forever(on_ready)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        db_path = os.path.join(tmp_dir, 'talko.db')
+        database_client.create_database(db_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as connection:
+            with connection:
+                connection.execute(
+                        'INSERT INTO Users (user_name) VALUES ("Alice")')
+        self.data_address = os.path.join(tmp_dir, 'data.sock')
+
+        receiver, sender = _CONTEXT.Pipe(duplex=False)
+        self.supervisor = _CONTEXT.Process(
+                target=_supervise, args=(self.data_address, db_path, sender))
+        self.supervisor.start()
+        self.addCleanup(self.stop)
+        sender.close()
+        # The supervisor only reports the servers once they are ready.
+        self.assertTrue(receiver.poll(_TIMEOUT_SECS))
+        [self.server_pid] = receiver.recv()
+        receiver.close()
+
+    def stop(self):
+        os.kill(self.supervisor.pid, signal.SIGTERM)
+        self.supervisor.join(server.DRAIN_TIMEOUT_SECS + _TIMEOUT_SECS)
+        self.assertEqual(self.supervisor.exitcode, 0)
+
+    def assertServes(self):
+        sock = socket_lib.connect(self.data_address, _TIMEOUT_SECS)
+        with contextlib.closing(sock):
+            request = protocol.GetUserRequest(1)
+            response = socket_lib.send_request(
+                    'GetUser', request.to_json(), sock=sock)
+        self.assertEqual(response['user']['user_name'], 'Alice')
+
+    def test_ready_servers_accept_requests(self):
+        self.assertServes()
+
+    def test_restarts_crashed_servers(self):
+        os.kill(self.server_pid, signal.SIGKILL)
+
+        # Requests wait in the socket's backlog until the server restarted.
+        self.assertServes()
+
+    def test_sighup_hands_off_without_refusing_connections(self):
+        self.assertServes()
+        os.kill(self.supervisor.pid, signal.SIGHUP)
+
+        # Keep sending requests until the old generation drained and exited.
+        deadline = time.monotonic() + _TIMEOUT_SECS
+        n_requests = 0
+        while _is_running(self.server_pid):
+            self.assertLess(time.monotonic(), deadline)
+            self.assertServes()
+            n_requests += 1
+        self.assertGreater(n_requests, 0)
+        self.assertServes()
+
+
+if __name__ == '__main__':
+    unittest.main()
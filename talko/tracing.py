@@ -0,0 +1,45 @@
+"""Helpers to trace messages through the servers, from sender to receivers.
+
+A trace is a JSON object carried in the 'trace' field of the JSON-RPC envelope,
+next to the 'method' and 'params'. Every process the message passes through
+appends timestamped events to it, e.g. when the DataServer received the request
+or when the BroadcastServer started fanning out the message. The time between
+consecutive events is the time spent in each hop. All the processes run on the
+same host, so the timestamps are wall clock milliseconds.
+"""
+
+import time
+import uuid
+
+from talko import constants
+
+
+def new_trace():
+    """Returns a new, empty trace."""
+    return {'trace_id': uuid.uuid4().hex, 'events': []}
+
+
+def now_ms():
+    return time.time() * constants.MILLIS_PER_SEC
+
+
+def add_event(trace, name, ts_ms=None):
+    """Appends the named event to the trace, if there is a trace."""
+    if trace is not None:
+        trace['events'].append([name, now_ms() if ts_ms is None else ts_ms])
+
+
+def spans(trace):
+    """Returns the ('from->to', duration_ms) of every hop in the trace."""
+    events = trace['events']
+    return [
+            (f'{start_name}->{end_name}', end_ms - start_ms)
+            for (start_name, start_ms), (end_name, end_ms)
+            in zip(events, events[1:])
+    ]
+
+
+def format_trace(trace):
+    """Returns a one line, human readable, breakdown of the trace."""
+    hops = ', '.join(f'{name} {ms:.2f}ms' for name, ms in spans(trace))
+    return f'trace {trace["trace_id"]}: {hops}'
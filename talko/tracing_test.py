@@ -0,0 +1,40 @@
+"""Tests of the tracing helpers.
+
+Run from the repository root with 'python -m unittest talko.tracing_test'.
+"""
+
+import unittest
+
+from talko import tracing
+
+
+class TracingTest(unittest.TestCase):
+
+    def test_add_event_without_a_trace_is_a_noop(self):
+        tracing.add_event(None, 'client.send')
+
+    def test_spans_between_consecutive_events(self):
+        trace = tracing.new_trace()
+        tracing.add_event(trace, 'client.send', 1000)
+        tracing.add_event(trace, 'data.recv', 1001.5)
+        tracing.add_event(trace, 'client.recv', 1004)
+
+        self.assertEqual(tracing.spans(trace), [
+                ('client.send->data.recv', 1.5),
+                ('data.recv->client.recv', 2.5)])
+        self.assertEqual(
+                tracing.format_trace(trace),
+                f'trace {trace["trace_id"]}: client.send->data.recv 1.50ms, '
+                'data.recv->client.recv 2.50ms')
+
+    def test_events_default_to_now(self):
+        trace = tracing.new_trace()
+        before_ms = tracing.now_ms()
+        tracing.add_event(trace, 'client.send')
+        (name, ts_ms), = trace['events']
+        self.assertEqual(name, 'client.send')
+        self.assertGreaterEqual(ts_ms, before_ms)
+
+
+if __name__ == '__main__':
+    unittest.main()
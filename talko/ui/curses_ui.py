@@ -3,13 +3,27 @@
 import argparse
 import curses
 import math
+import queue
+import textwrap
 import threading
+import time
 
 from talko import client as client_lib
 from talko import constants
+from talko import socket_lib
 
 _LEFT_PANE_PERCENT  = .7
 _INPUT_HEIGHT_PERCENT = .2
+# The number of messages fetched per page of chat history.
+_PAGE_SIZE = 100
+# The maximum number of (wrapped) message lines kept in memory.
+_MAX_MESSAGE_LINES = 2000
+_SCROLL_KEYS = {
+        curses.KEY_PPAGE: 1,
+        curses.KEY_NPAGE: -1,
+        curses.KEY_UP: 1 / 3,
+        curses.KEY_DOWN: -1 / 3,
+}
 
 
 class Window:
@@ -41,6 +55,18 @@ class Window:
 
 class ChatsWindow(Window):
 
+    def __init__(self, scr, user_id):
+        super().__init__(scr)
+        self._user_id = user_id
+        self._online_user_ids = set()
+
+    def set_online(self, user_id, online):
+        if online:
+            self._online_user_ids.add(user_id)
+        else:
+            self._online_user_ids.discard(user_id)
+        self._needs_redraw = True
+
     def redraw(self):
         self._scr.erase()
         self._scr.border(' ', 0, 0, 0, curses.ACS_HLINE, 0, curses.ACS_HLINE, 0)
@@ -48,29 +74,180 @@ class ChatsWindow(Window):
         right_align = len(str(len(self._data)))
         for i, chat in enumerate(self._data):
             chat_name = chat['chat_name']
-            text = f'{i + 1:>{right_align}}. {chat_name}'
+            # Chats with another member online are marked with a '*'.
+            online = any(
+                    user['user_id'] in self._online_user_ids
+                    for user in chat['users']
+                    if user['user_id'] != self._user_id)
+            marker = '*' if online else ' '
+            text = f'{i + 1:>{right_align}}.{marker}{chat_name}'
             self._scr.addstr(i + 1, 0, text)
 
 
 class MessagesWindow(Window):
+    """Renders a scrollable, line-wrapped view of the chat messages.
 
-    def __init__(self, scr, chat_name):
+    Only a bounded window of the chat history is kept in memory. Its wrapped
+    lines are written into a curses pad, where appending a message only writes
+    the message's own lines and scrolling only moves the visible region of the
+    pad. Older messages are fetched page by page when the user scrolls past the
+    top of the window.
+    """
+
+    def __init__(self, scr, chat_name, max_lines=None):
         super().__init__(scr)
         self._chat_name = chat_name
+        self._status = ''
+        self._max_lines = max_lines or _MAX_MESSAGE_LINES
+        self._view_height = self._height - 2
+        self._line_width = self._width - 3
+        self._pad = curses.newpad(self._max_lines, self._width - 2)
+        # The wrapped lines in the pad and the message_id of each line.
+        self._lines = []
+        self._line_ids = []
+        # The number of lines the view is scrolled up from the bottom.
+        self._scroll = 0
+        self._needs_redraw_pad = True
+        # Whether there are older (or newer) messages which are not in memory.
+        self.has_older = False
+        self.has_newer = False
+
+    @property
+    def first_message_id(self):
+        return self._line_ids[0] if self._line_ids else None
+
+    @property
+    def page_size(self):
+        return self._view_height
+
+    @property
+    def at_top(self):
+        return self._top_line() == 0
+
+    @property
+    def at_bottom(self):
+        return self._scroll == 0
+
+    def _wrap(self, messages):
+        """Returns the wrapped lines of the messages and their message_ids."""
+        lines, line_ids = [], []
+        for message in messages:
+            user, text = message['user'], message['message_text']
+            text = f'{user["user_name"]}: {text}'
+            wrapped = textwrap.wrap(
+                    text, self._line_width, subsequent_indent='  ') or ['']
+            lines.extend(wrapped)
+            line_ids.extend([message['message_id']] * len(wrapped))
+        return lines, line_ids
+
+    def _top_line(self):
+        return max(len(self._lines) - self._view_height - self._scroll, 0)
+
+    def _write_pad(self, start=0):
+        """Writes the lines from 'start' to the end into the pad."""
+        for i in range(start, len(self._lines)):
+            self._pad.move(i, 0)
+            self._pad.clrtoeol()
+            self._pad.addstr(i, 0, self._lines[i])
+        self._needs_redraw_pad = True
+
+    def _trim_top(self, n_lines):
+        # Only drop whole messages so the first message is never cut off.
+        while n_lines < len(self._lines) and (
+                self._line_ids[n_lines] == self._line_ids[n_lines - 1]):
+            n_lines += 1
+        del self._lines[:n_lines]
+        del self._line_ids[:n_lines]
+        self._pad.erase()
+        self._write_pad()
+        self.has_older = True
+
+    def set_messages(self, messages, has_older):
+        """Replaces the messages in the window, e.g. with the latest page."""
+        self._lines, self._line_ids = self._wrap(messages)
+        self._scroll = 0
+        self.has_older = has_older
+        self.has_newer = False
+        self._pad.erase()
+        if len(self._lines) > self._max_lines:
+            self._trim_top(len(self._lines) - self._max_lines)
+        else:
+            self._write_pad()
+
+    def append(self, message):
+        """Appends a new message to the bottom of the window."""
+        if self.has_newer:
+            # We're showing older history and the newest messages were dropped,
+            # the message will be fetched when we jump back to the bottom.
+            return
+        lines, line_ids = self._wrap([message])
+        if len(self._lines) + len(lines) > self._max_lines:
+            # Drop half the window at once so trimming is amortized O(1).
+            self._trim_top(max(self._max_lines // 2, len(lines)))
+        start = len(self._lines)
+        self._lines.extend(lines)
+        self._line_ids.extend(line_ids)
+        if self._scroll:
+            # Keep the view still if the user scrolled up.
+            self._scroll += len(lines)
+        self._write_pad(start)
+
+    def prepend(self, messages, has_older):
+        """Prepends a page of older messages to the top of the window."""
+        if not messages:
+            self.has_older = False
+            return
+        lines, line_ids = self._wrap(messages)
+        self._lines = lines + self._lines
+        self._line_ids = line_ids + self._line_ids
+        self.has_older = has_older
+        overflow = len(self._lines) - self._max_lines
+        if overflow > 0:
+            # Drop the newest lines, we're scrolling away from them.
+            del self._lines[-overflow:]
+            del self._line_ids[-overflow:]
+            self._scroll = max(self._scroll - overflow, 0)
+            self.has_newer = True
+        self._pad.erase()
+        self._write_pad()
+
+    def scroll(self, n_lines):
+        """Scrolls the view up (n_lines > 0) or down (n_lines < 0)."""
+        max_scroll = max(len(self._lines) - self._view_height, 0)
+        scroll = min(max(self._scroll + int(n_lines), 0), max_scroll)
+        if scroll != self._scroll:
+            self._scroll = scroll
+            self._needs_redraw_pad = True
+
+    def scroll_to_bottom(self):
+        self.scroll(-self._scroll)
+
+    def set_status(self, status):
+        """Shows the status, e.g. who is typing, next to the chat name."""
+        if status != self._status:
+            self._status = status
+            self._needs_redraw = True
+
+    def draw(self):
+        super().draw()
+        if self._needs_redraw_pad:
+            begin_y, begin_x = self._scr.getbegyx()
+            self._pad.noutrefresh(
+                    self._top_line(), 0,
+                    begin_y + 1, begin_x + 1,
+                    begin_y + self._view_height, begin_x + self._width - 2)
+            self._needs_redraw_pad = False
 
     def redraw(self):
         self._scr.erase()
         self._scr.border(0, 0, 0, 0, 
                          0, curses.ACS_TTEE, curses.ACS_LTEE, curses.ACS_RTEE)
-
-        self._scr.addstr(0, 2, self._chat_name)
-        # TODO(eugenhotaj): Using self._height as the number of messages to 
-        # display assumes each messages will fit on a single line. We should
-        # use a pad here instead.
-        for i, message in enumerate(self._data[-self._height + 2:]):
-            user , text = message['user'], message['message_text']
-            text = f'{user["user_name"]}: {text}'
-            self._scr.addstr(i + 1, 1, text)
+        title = self._chat_name
+        if self._status:
+            title = f'{title} ({self._status})'
+        self._scr.addstr(0, 2, title[:self._width - 4])
+        # The pad is drawn over the (now blank) inside of the window.
+        self._needs_redraw_pad = True
 
 
 class InputWindow(Window):
@@ -120,16 +297,17 @@ def _main(stdscr, user_id, data_address, broadcast_address):
  
     client = client_lib.Client(data_address, broadcast_address)
     user_name = client.get_user(user_id)['user']['user_name']
-    chats = client.get_chats(user_id)['chats']
+    chats = client.get_chats(user_id, messages_limit=1)['chats']
     open_chat = chats[0]
-    messages = client.get_messages(open_chat['chat_id'])['messages']
+    messages = client.get_messages(
+            open_chat['chat_id'], limit=_PAGE_SIZE)['messages']
 
     # Component which renders the current conversation messages.
     n_lines, n_cols = messages_height, left_pane_width
     begin_y, begin_x = 0, 0
     win = stdscr.subwin(n_lines, n_cols, begin_y, begin_x)
     messages_win = MessagesWindow(win, open_chat['chat_name'])
-    messages_win.data = messages
+    messages_win.set_messages(messages, len(messages) == _PAGE_SIZE)
 
     # Component which handles the input box.
     n_lines, n_cols = input_height, left_pane_width
@@ -141,22 +319,108 @@ def _main(stdscr, user_id, data_address, broadcast_address):
     n_lines, n_cols = height, right_pane_width
     begin_y, begin_x = 0, left_pane_width 
     win = stdscr.subwin(n_lines, n_cols, begin_y, begin_x)
-    chats_win = ChatsWindow(win)
+    chats_win = ChatsWindow(win, user_id)
     chats_win.data = chats
 
-    # Handle new messages in a separate thread.
+    user_names = {
+            user['user_id']: user['user_name']
+            for chat in chats for user in chat['users']
+    }
+    # When each (chat_id, user_id) who is typing was last seen typing.
+    typing_secs = {}
+
+    def typing_status():
+        now = time.monotonic()
+        for key, seen_secs in list(typing_secs.items()):
+            if now - seen_secs > constants.TYPING_TIMEOUT_SECS:
+                del typing_secs[key]
+        names = [
+                user_names.get(typing_user_id, 'Someone')
+                for chat_id, typing_user_id in typing_secs
+                if chat_id == open_chat['chat_id']
+        ]
+        if not names:
+            return ''
+        verb = 'is' if len(names) == 1 else 'are'
+        return f'{", ".join(sorted(names))} {verb} typing...'
+
+    # Network calls happen in background threads. Since curses is not thread
+    # safe, their results are queued up and applied by the main loop.
+    updates = queue.Queue()
+
+    # Resume the stream from the newest message we loaded, so messages sent
+    # while loading aren't missed.
+    loaded_message_ids = [message['message_id'] for message in messages] + [
+            message['message_id']
+            for chat in chats for message in chat['messages']
+    ]
+    last_message_id = max(loaded_message_ids, default=None)
+
     def on_new_message():
-        lock = threading.RLock()
-        message_generator = client.open_stream(user_id)
-        for message in message_generator:
-            with lock:
-                messages_win.data = messages_win.data + [message['message']]
+        stream = client.open_stream(
+                user_id, last_message_id=last_message_id, events=True)
+        for message in stream:
+            if 'message' in message:
+                updates.put(('append', message['message']))
+            else:
+                updates.put(('events', message))
+
+    def fetch_messages(action, before_message_id=None):
+        try:
+            messages = client.get_messages(
+                    open_chat['chat_id'], before_message_id, _PAGE_SIZE)
+        except (OSError, socket_lib.RPCError):
+            # E.g. the server is restarting or still overloaded after the
+            # retries. The fetch is retried on the next scroll.
+            updates.put(('fetch_failed', None))
+            return
+        updates.put((action, messages['messages']))
+
+    fetching = False
+
+    def maybe_fetch_messages():
+        nonlocal fetching
+        if fetching:
+            return
+        if messages_win.at_top and messages_win.has_older:
+            args = ('prepend', messages_win.first_message_id)
+        elif messages_win.at_bottom and messages_win.has_newer:
+            args = ('latest',)
+        else:
+            return
+        fetching = True
+        threading.Thread(target=fetch_messages, args=args, daemon=True).start()
 
     threading.Thread(target=on_new_message, daemon=True).start()
  
     stdscr.timeout(17)
     while True:
+        # Apply updates from the background threads.
+        while not updates.empty():
+            action, data = updates.get()
+            if action == 'append':
+                # A new message means its sender has stopped typing.
+                typing_secs.pop(
+                        (data['chat_id'], data['user']['user_id']), None)
+                if data['chat_id'] == open_chat['chat_id']:
+                    messages_win.append(data)
+            elif action == 'events':
+                for event in data['presence']:
+                    chats_win.set_online(event['user_id'], event['online'])
+                for event in data['typing']:
+                    key = (event['chat_id'], event['user_id'])
+                    typing_secs[key] = time.monotonic()
+            elif action == 'prepend':
+                messages_win.prepend(data, len(data) == _PAGE_SIZE)
+                fetching = False
+            elif action == 'latest':
+                messages_win.set_messages(data, len(data) == _PAGE_SIZE)
+                fetching = False
+            elif action == 'fetch_failed':
+                fetching = False
+
         # Draw the screen.
+        messages_win.set_status(typing_status())
         input_win.draw()
         messages_win.draw()
         chats_win.draw()
@@ -170,11 +434,23 @@ def _main(stdscr, user_id, data_address, broadcast_address):
             char = curses.KEY_BACKSPACE
         
         # Update state.
+        if char in _SCROLL_KEYS:
+            messages_win.scroll(_SCROLL_KEYS[char] * messages_win.page_size)
+            maybe_fetch_messages()
+            continue
         message_text = input_win.send_input(char)
         if message_text is not None:
             chat_id = open_chat['chat_id']
-            message = client.insert_message(chat_id, user_id, message_text)['message']
-            messages_win.data = messages_win.data + [message]
+            message = client.insert_message(chat_id, user_id, message_text)
+            messages_win.append(message['message'])
+            messages_win.scroll_to_bottom()
+            maybe_fetch_messages()
+        elif 31 < char < 126:
+            try:
+                client.send_typing(open_chat['chat_id'], user_id)
+            except (OSError, socket_lib.RPCError):
+                # Typing events are ephemeral, so just drop this one.
+                pass
 
 
 def main(user_id, data_address, broadcast_address):
@@ -11,11 +11,44 @@ import multiprocessing
 import flask
 import json
 from talko import client
+from talko import constants
+from talko import metrics
+from talko.ui.webapp import hub as hub_lib
 
+_SSE_KEEP_ALIVE_SECS = 15
+_SSE_RETRY_MILLIS = 1000
 
-def main(data_address, broadcast_address):
-    backend_client = client.Client(data_address, broadcast_address)
-    user_to_thread = {}
+
+def _json_response(raw_json, etag=None):
+    response = flask.Response(raw_json, mimetype='application/json')
+    if etag:
+        response.set_etag(etag)
+        # Browsers may cache the response but must revalidate it every time.
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _make_etag(prefix, id_, version):
+    return f'{prefix}{id_}-{version["message_id"]}-{version["participant_id"]}'
+
+
+def _not_modified(etag):
+    """Returns a 304 response if the request's ETag matches, else 'None'."""
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+
+def create_app(data_address, broadcast_address):
+    """Returns the Flask app serving the UI from the given backend servers."""
+    # NOTE(eugenhotaj): The backend responses are already JSON, so we relay the
+    # raw bytes instead of decoding them only to have Flask re-encode them.
+    backend_client = client.Client(data_address, broadcast_address, raw=True)
+    stream_hub = hub_lib.StreamHub(broadcast_address)
+    stream_hub.start()
 
     app = flask.Flask(__name__)
 
@@ -24,18 +57,40 @@ def main(data_address, broadcast_address):
     @app.route('/index')
     def home():
         user_id = int(flask.request.args.get('user_id'))
-        return flask.render_template('home.html', user_id=user_id)
+        return flask.render_template(
+                'home.html',
+                user_id=user_id,
+                typing_interval_secs=constants.TYPING_INTERVAL_SECS,
+                typing_timeout_secs=constants.TYPING_TIMEOUT_SECS)
 
     @app.route('/chats')
     def get_chats():
         user_id = int(flask.request.args.get('user_id'))
-        return backend_client.get_chats(user_id)
+        # NOTE(eugenhotaj): The version must be fetched *before* the chats so
+        # that the ETag is never newer than the response it validates.
+        version = backend_client.get_version(user_id=user_id)['version']
+        etag = _make_etag('u', user_id, version)
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+        messages_limit = flask.request.args.get('messages_limit', type=int)
+        chats = backend_client.get_chats(user_id, messages_limit)
+        return _json_response(chats, etag)
 
     @app.route('/messages')
     def get_messages():
-        user_id = int(flask.request.args.get('user_id'))
         chat_id = int(flask.request.args.get('chat_id'))
-        return backend_client.get_messages(chat_id)
+        version = backend_client.get_version(chat_id=chat_id)['version']
+        etag = _make_etag('c', chat_id, version)
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+        before_message_id = flask.request.args.get(
+                'before_message_id', type=int)
+        limit = flask.request.args.get('limit', type=int)
+        messages = backend_client.get_messages(
+                chat_id, before_message_id, limit)
+        return _json_response(messages, etag)
 
     @app.route('/messages', methods=['POST'])
     def insert_message():
@@ -44,12 +99,87 @@ def main(data_address, broadcast_address):
         message_text = flask.request.json.get('message_text')
         if None in (chat_id, user_id, message_text):
             return flask.abort(400)
-        return backend_client.insert_message(chat_id, user_id, message_text)
+        return _json_response(
+                backend_client.insert_message(chat_id, user_id, message_text))
+
+    @app.route('/typing', methods=['POST'])
+    def send_typing():
+        chat_id = flask.request.json.get('chat_id')
+        user_id = flask.request.json.get('user_id')
+        if None in (chat_id, user_id):
+            return flask.abort(400)
+        stream_hub.send_typing(chat_id, user_id)
+        return flask.Response(status=204)
 
     @app.route('/message-stream')
     def message_stream():
         user_id = int(flask.request.args.get('user_id'))
-        return backend_client.receive_one_message(user_id, timeout=25)
+        last_message_id = flask.request.args.get('last_message_id')
+        if last_message_id is not None:
+            last_message_id = int(last_message_id)
+        return stream_hub.receive_one_message(
+                user_id, timeout=25, last_message_id=last_message_id)
+
+    @app.route('/events')
+    def events():
+        """Streams the user's new messages as Server-Sent Events.
+
+        Each event's id is the message_id so that, when the browser reconnects,
+        the stream resumes from the 'Last-Event-ID' without losing messages.
+
+        Presence and typing events are sent as 'activity' events without an id,
+        since missing a few of them is harmless. Each stream starts with the
+        latest known presence instead.
+        """
+        user_id = int(flask.request.args.get('user_id'))
+        last_message_id = flask.request.headers.get(
+                'Last-Event-ID', flask.request.args.get('last_message_id'))
+        if last_message_id is not None:
+            last_message_id = int(last_message_id)
+
+        def stream(last_message_id):
+            yield f'retry: {_SSE_RETRY_MILLIS}\n\n'
+            last_event_seq, presence = stream_hub.current_events(user_id)
+            if presence:
+                yield f'event: activity\ndata: {json.dumps(presence)}\n\n'
+            while True:
+                response = stream_hub.receive_one_message(
+                        user_id, 
+                        timeout=_SSE_KEEP_ALIVE_SECS, 
+                        last_message_id=last_message_id,
+                        last_event_seq=last_event_seq)
+                if not response:
+                    # Comments keep idle connections (and proxies) alive.
+                    yield ': keep-alive\n\n'
+                    continue
+                if 'message' not in response:
+                    last_event_seq = response['event_seq']
+                    data = json.dumps(response)
+                    yield f'event: activity\ndata: {data}\n\n'
+                    continue
+                last_message_id = response['message']['message_id']
+                data = json.dumps(response)
+                yield f'id: {last_message_id}\nevent: message\ndata: {data}\n\n'
 
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return flask.Response(
+                stream(last_message_id), 
+                mimetype='text/event-stream', 
+                headers=headers)
+
+    @app.route('/stats')
+    def stats():
+        """Returns the metrics of both backend servers as plain text."""
+        text = (
+                metrics.to_text('talko_data', backend_client.get_stats()) + 
+                metrics.to_text(
+                    'talko_broadcast', backend_client.get_broadcast_stats()))
+        return flask.Response(text, mimetype='text/plain')
+
+    return app
+
+
+def main(data_address, broadcast_address):
+    app = create_app(data_address, broadcast_address)
     port = os.environ['PORT'] if 'PORT' in os.environ else None
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,123 @@
+"""End-to-end tests of the webapp against running backend servers.
+
+Run from the repository root with 'python -m unittest talko.ui.webapp.app_test'.
+"""
+
+import json
+import unittest
+
+from talko import server_test
+from talko.ui.webapp import app as app_lib
+
+
+def _parse_event(chunk):
+    """Returns the fields of a Server-Sent Event, 'None' for comments."""
+    event = {}
+    for line in chunk.decode('utf-8').splitlines():
+        if not line or line.startswith(':'):
+            continue
+        name, _, value = line.partition(': ')
+        event[name] = value
+    return event or None
+
+
+class AppTestCase(server_test.ServerTestCase):
+    """Runs the webapp against a DataServer and a BroadcastServer."""
+
+    def setUp(self):
+        super().setUp()
+        app = app_lib.create_app(self.data_address, self.broadcast_address)
+        self.http = app.test_client()
+
+
+class CachingTest(AppTestCase):
+
+    def get(self, path, etag=None, **query):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.http.get(path, query_string=query, headers=headers)
+
+    def assertRevalidates(self, path, **query):
+        """Checks the path's ETag until a new message is inserted."""
+        response = self.get(path, **query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+                response.headers['Cache-Control'], 'private, no-cache')
+        etag = response.headers['ETag']
+
+        response = self.get(path, etag, **query)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self.client.insert_message(1, 1, 'New')
+        response = self.get(path, etag, **query)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        return response.json
+
+    def test_chats_are_revalidated(self):
+        chats = self.assertRevalidates('/chats', user_id=2)['chats']
+        self.assertEqual(
+                [m['message_text'] for m in chats[0]['messages']], ['New'])
+
+    def test_messages_are_revalidated(self):
+        messages = self.assertRevalidates(
+                '/messages', chat_id=1)['messages']
+        self.assertEqual([m['message_text'] for m in messages], ['New'])
+
+    def test_other_chats_do_not_change_the_etag(self):
+        self.execute('INSERT INTO Chats (chat_name, is_private) '
+                     'VALUES ("Book club", 0)')
+        self.execute('INSERT INTO Participants (chat_id, user_id) '
+                     'VALUES (2, 2)')
+        response = self.get('/messages', chat_id=2)
+        etag = response.headers['ETag']
+        self.client.insert_message(1, 1, 'New')
+
+        response = self.get('/messages', etag, chat_id=2)
+        self.assertEqual(response.status_code, 304)
+
+
+class EventsTest(AppTestCase):
+
+    def open_events(self, user_id, **kwargs):
+        response = self.http.get(
+                '/events', query_string={'user_id': user_id},
+                buffered=False, **kwargs)
+        self.addCleanup(response.close)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        return response.iter_encoded()
+
+    def next_message(self, events):
+        """Returns the (id, data) of the next message event."""
+        for chunk in events:
+            event = _parse_event(chunk)
+            if event and event.get('event') == 'message':
+                return int(event['id']), json.loads(event['data'])
+        self.fail('The event stream ended.')
+
+    def test_streams_missed_then_live_messages(self):
+        self.insert_messages(2)
+        events = self.open_events(2, headers={'Last-Event-ID': '0'})
+        self.assertEqual(_parse_event(next(events)), {'retry': '1000'})
+
+        for message_id in (1, 2):
+            event_id, data = self.next_message(events)
+            self.assertEqual(event_id, message_id)
+            self.assertEqual(data['message']['message_id'], message_id)
+
+        self.client.insert_message(1, 1, 'Live')
+        event_id, data = self.next_message(events)
+        self.assertEqual(event_id, 3)
+        self.assertEqual(data['message']['message_text'], 'Live')
+
+    def test_resumes_from_the_last_event_id(self):
+        self.insert_messages(3)
+        events = self.open_events(2, headers={'Last-Event-ID': '1'})
+
+        event_id, _ = self.next_message(events)
+        self.assertEqual(event_id, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,340 @@
+"""An in-process hub which fans out broadcast messages to webapp requests.
+
+Instead of opening a new connection to the BroadcastServer for every long poll,
+the webapp process keeps a few multiplexed stream connections open and
+subscribes the users it serves on them. Incoming messages are buffered per user
+and handed to whichever requests are waiting on that user. The number of
+connections between the webapp and the BroadcastServer is therefore constant
+per webapp process, independent of the number of browsers.
+
+Users are subscribed from the oldest message any of their requests is waiting
+after, so the buffer holds every message after 'resume_from'. Requests which
+resume from an older message (e.g. an EventSource reconnecting with its
+Last-Event-ID) resubscribe the user from there, which replays the missed
+messages into the buffer.
+
+Presence and typing events are buffered the same way, but numbered by the hub
+itself since they have no message_id. The hub also remembers the latest
+presence of everyone in the users' chats, so that a new request can start from
+a snapshot instead of replaying old events.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+
+from talko import protocol
+from talko import socket_lib
+
+# The number of recent messages (and event frames) buffered for each
+# subscribed user.
+_BUFFER_SIZE = 100
+# Users without waiters for this long are unsubscribed from the stream.
+_IDLE_SECS = 60
+_RECONNECT_DELAY_SECS = .5
+
+
+class _UserState:
+    """The messages, events and waiters for a single subscribed user."""
+
+    def __init__(self, lock, resume_from):
+        # The buffer holds every message after resume_from. If 'None', it
+        # holds every message after the oldest buffered one.
+        self.resume_from = resume_from
+        # The messages, in message_id order.
+        self.messages = collections.deque()
+        # (event_seq, frame) tuples of the latest event frames.
+        self.events = collections.deque(maxlen=_BUFFER_SIZE)
+        self.event_seq = 0
+        self.presence = {}
+        self.condition = threading.Condition(lock)
+        self.n_waiters = 0
+        self.last_active = time.time()
+
+    @property
+    def last_message_id(self):
+        if not self.messages:
+            return self.resume_from
+        return self.messages[-1]['message']['message_id']
+
+    def covers(self, message_id):
+        """Returns whether all the messages after message_id are buffered."""
+        if self.resume_from is not None:
+            return message_id >= self.resume_from
+        if self.messages:
+            return message_id >= self.messages[0]['message']['message_id']
+        return False
+
+    def add_message(self, message):
+        """Buffers the message, unless it's a duplicate.
+
+        Resubscribing replays messages which may already be buffered or older
+        than live messages which arrived in the meantime.
+        """
+        message_id = message['message']['message_id']
+        if self.resume_from is not None and message_id <= self.resume_from:
+            return
+        index = len(self.messages)
+        while index:
+            other_id = self.messages[index - 1]['message']['message_id']
+            if other_id == message_id:
+                return
+            if other_id < message_id:
+                break
+            index -= 1
+        self.messages.insert(index, message)
+        if len(self.messages) > _BUFFER_SIZE:
+            evicted = self.messages.popleft()
+            self.resume_from = evicted['message']['message_id']
+
+    def first_after(self, message_id):
+        """Returns the first buffered message after message_id, if any."""
+        for message in self.messages:
+            if message['message']['message_id'] > message_id:
+                return message
+        return None
+
+    def add_events(self, frame):
+        self.event_seq += 1
+        self.events.append((self.event_seq, frame))
+        for event in frame['presence']:
+            self.presence[event['user_id']] = event['online']
+
+    def first_event_after(self, event_seq):
+        """Returns the first buffered event frame after event_seq, if any."""
+        for seq, frame in self.events:
+            if seq > event_seq:
+                return dict(frame, event_seq=seq)
+        return None
+
+
+class _Upstream:
+    """A single multiplexed stream connection to the BroadcastServer."""
+
+    def __init__(self, broadcast_address, hub):
+        self._broadcast_address = broadcast_address
+        self._hub = hub
+        self._socket = None
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run_forever, daemon=True).start()
+
+    def send(self, method, request):
+        """Sends the notification, if the stream is connected."""
+        with self._send_lock:
+            if not self._socket:
+                return
+            try:
+                socket_lib.send_notification(
+                        self._socket, method, request.to_json())
+            except OSError:
+                # The reader thread notices the broken stream and reconnects.
+                pass
+
+    def _connect(self):
+        sock = socket_lib.connect(self._broadcast_address)
+        request = protocol.OpenMultiplexedStreamRequest()
+        socket_lib.send_request('OpenMultiplexedStreamRequest',
+                                request.to_json(), sock=sock, keep_alive=True)
+        with self._send_lock:
+            self._socket = sock
+        # (Re)subscribe all the users we were serving. Resuming from the last
+        # message we've seen replays anything missed while disconnected.
+        for user_id, last_message_id in self._hub.subscriptions(self):
+            request = protocol.SubscribeRequest(
+                    user_id, last_message_id, events=True)
+            self.send('SubscribeRequest', request)
+        return sock
+
+    def _run_forever(self):
+        while True:
+            sock = None
+            try:
+                sock = self._connect()
+                while True:
+                    message = json.loads(socket_lib.recv_message(sock))
+                    self._hub.dispatch(message['result'])
+            except (OSError, ValueError):
+                logging.exception('Broadcast stream dropped, reconnecting.')
+                time.sleep(_RECONNECT_DELAY_SECS)
+            except socket_lib.OverloadedError as error:
+                logging.warning(f'Broadcast server overloaded: {error}')
+                time.sleep(socket_lib.retry_delay(0, error))
+            finally:
+                with self._send_lock:
+                    self._socket = None
+                if sock:
+                    sock.close()
+
+
+class StreamHub:
+    """Routes messages from a few upstream streams to per-user waiters."""
+
+    def __init__(self, broadcast_address, n_connections=1):
+        """Initializes a new StreamHub instance.
+
+        Args:
+            broadcast_address: The address of the BroadcastServer.
+            n_connections: The number of upstream stream connections to use.
+                Users are sharded across the connections by their user_id.
+        """
+        self._lock = threading.Lock()
+        self._users = {}
+        self._upstreams = [
+                _Upstream(broadcast_address, self)
+                for _ in range(n_connections)
+        ]
+
+    def start(self):
+        """Opens the upstream connections and starts serving messages."""
+        for upstream in self._upstreams:
+            upstream.start()
+        threading.Thread(target=self._unsubscribe_idle, daemon=True).start()
+
+    def _upstream(self, user_id):
+        return self._upstreams[user_id % len(self._upstreams)]
+
+    def subscriptions(self, upstream):
+        """Returns (user_id, last_message_id) of the upstream's users."""
+        with self._lock:
+            return [
+                    (user_id, state.last_message_id)
+                    for user_id, state in self._users.items()
+                    if self._upstream(user_id) is upstream
+            ]
+
+    def dispatch(self, message):
+        """Buffers the message and wakes up the receivers' waiters."""
+        with self._lock:
+            for receiver_id in message['receiver_ids']:
+                state = self._users.get(receiver_id)
+                if not state:
+                    continue
+                if 'message' in message:
+                    state.add_message(message)
+                elif 'presence' in message:
+                    state.add_events(message)
+                else:
+                    # A SubscribeFailedFrame: Forget the user, so that their
+                    # next request subscribes them again. Their current
+                    # waiters time out in the meantime, which backs off the
+                    # retries.
+                    logging.warning(
+                            f'Subscribing user {receiver_id} failed: '
+                            f'{message["reason"]}')
+                    del self._users[receiver_id]
+                    continue
+                state.condition.notify_all()
+
+    def send_typing(self, chat_id, user_id):
+        """Tells the other (online) chat members that the user is typing."""
+        request = protocol.TypingRequest(chat_id, user_id)
+        self._upstream(user_id).send('TypingRequest', request)
+
+    def current_events(self, user_id):
+        """Returns the user's latest event_seq and known presence.
+
+        The presence is returned as an event frame (or 'None' if nothing is
+        known yet) and lets new waiters catch up without replaying old events.
+        """
+        with self._lock:
+            state = self._users.get(user_id)
+            if not state:
+                return 0, None
+            if not state.presence:
+                return state.event_seq, None
+            presence = [
+                    protocol.PresenceEvent(other_user_id, online)
+                    for other_user_id, online in state.presence.items()
+            ]
+            frame = protocol.EventFrame([user_id], presence, [])
+            return state.event_seq, frame.to_json()
+
+    def receive_one_message(self, user_id, timeout=None, last_message_id=None,
+                            last_event_seq=None):
+        """Waits up to 'timeout' seconds for a single message for the user.
+
+        Has the same semantics as client.Client.receive_one_message() but does
+        not open a new connection to the BroadcastServer. If 'last_event_seq'
+        is given, also returns the first event frame after it, along with its
+        'event_seq'.
+        """
+        subscribe = False
+        with self._lock:
+            state = self._users.get(user_id)
+            if not state:
+                state = _UserState(self._lock, resume_from=last_message_id)
+                self._users[user_id] = state
+                subscribe = True
+            elif (last_message_id is not None and
+                    not state.covers(last_message_id)):
+                # Some messages after last_message_id were never (or are no
+                # longer) buffered, so replay them. The buffer is refilled by
+                # the replay, in order, instead of handing out newer messages
+                # before the replay arrives.
+                state.resume_from = last_message_id
+                state.messages.clear()
+                subscribe = True
+            if last_message_id is None:
+                last_message_id = state.last_message_id or 0
+            state.n_waiters += 1
+        if subscribe:
+            request = protocol.SubscribeRequest(
+                    user_id, state.resume_from, events=True)
+            self._upstream(user_id).send('SubscribeRequest', request)
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            try:
+                while True:
+                    message = state.first_after(last_message_id)
+                    if message:
+                        return message
+                    if last_event_seq is not None:
+                        frame = state.first_event_after(last_event_seq)
+                        if frame:
+                            return frame
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return {}
+                    state.condition.wait(remaining)
+            finally:
+                state.n_waiters -= 1
+                state.last_active = time.time()
+
+    def _unsubscribe_idle(self):
+        while True:
+            time.sleep(_IDLE_SECS)
+            self._drop_idle_users(time.time())
+
+    def _drop_idle_users(self, now):
+        with self._lock:
+            idle = [
+                    user_id for user_id, state in self._users.items()
+                    if not state.n_waiters
+                    and now - state.last_active > _IDLE_SECS
+            ]
+            for user_id in idle:
+                del self._users[user_id]
+        for user_id in idle:
+            request = protocol.UnsubscribeRequest(user_id)
+            self._upstream(user_id).send('UnsubscribeRequest', request)
+        # NOTE(eugenhotaj): Users who came back in the meantime may have sent
+        # their SubscribeRequest before our UnsubscribeRequest, so subscribe
+        # them again. Notifications aren't sent under the lock since sending
+        # blocks while the stream's buffers are full, and the stream is only
+        # read by dispatch()ing under the lock.
+        with self._lock:
+            resubscribe = [
+                    (user_id, self._users[user_id].last_message_id)
+                    for user_id in idle if user_id in self._users
+            ]
+        for user_id, last_message_id in resubscribe:
+            request = protocol.SubscribeRequest(
+                    user_id, last_message_id, events=True)
+            self._upstream(user_id).send('SubscribeRequest', request)
@@ -0,0 +1,174 @@
+"""Tests of the StreamHub's buffering and routing of broadcast messages.
+
+The hub is never start()ed, so it doesn't connect to a BroadcastServer. The
+tests dispatch messages to it directly, as its upstream streams would.
+Run from the repository root with 'python -m unittest talko.ui.webapp.hub_test'.
+"""
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from talko.ui.webapp import hub as hub_lib
+
+
+def _message(message_id, receiver_id=1):
+    return {
+            'receiver_ids': [receiver_id],
+            'message': {'message_id': message_id, 'chat_id': 1},
+    }
+
+
+def _events(receiver_id=1, presence=(), typing=()):
+    return {
+            'receiver_ids': [receiver_id],
+            'presence': [
+                {'user_id': user_id, 'online': online}
+                for user_id, online in presence
+            ],
+            'typing': [
+                {'chat_id': chat_id, 'user_id': user_id}
+                for chat_id, user_id in typing
+            ],
+    }
+
+
+def _message_ids(state):
+    return [message['message']['message_id'] for message in state.messages]
+
+
+class UserStateTest(unittest.TestCase):
+
+    def test_buffers_messages_in_order_without_duplicates(self):
+        state = hub_lib._UserState(threading.Lock(), resume_from=2)
+        for message_id in (5, 3, 4, 5, 2, 1):
+            state.add_message(_message(message_id))
+
+        self.assertEqual(_message_ids(state), [3, 4, 5])
+        self.assertEqual(state.last_message_id, 5)
+        self.assertEqual(
+                state.first_after(3)['message']['message_id'], 4)
+        self.assertIsNone(state.first_after(5))
+
+    def test_evicted_messages_are_no_longer_covered(self):
+        state = hub_lib._UserState(threading.Lock(), resume_from=0)
+        for message_id in range(1, hub_lib._BUFFER_SIZE + 11):
+            state.add_message(_message(message_id))
+
+        self.assertEqual(len(state.messages), hub_lib._BUFFER_SIZE)
+        self.assertEqual(state.resume_from, 10)
+        self.assertTrue(state.covers(10))
+        self.assertFalse(state.covers(9))
+
+    def test_events_are_numbered_and_update_the_presence(self):
+        state = hub_lib._UserState(threading.Lock(), resume_from=None)
+        state.add_events(_events(presence=[(2, True)]))
+        state.add_events(_events(presence=[(2, False), (3, True)]))
+
+        self.assertEqual(state.presence, {2: False, 3: True})
+        self.assertEqual(state.first_event_after(1)['event_seq'], 2)
+        self.assertIsNone(state.first_event_after(2))
+
+
+class StreamHubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = hub_lib.StreamHub(('localhost', 0))
+        patcher = mock.patch.object(hub_lib._Upstream, 'send')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def subscribed_from(self):
+        """Returns the last_message_ids of the SubscribeRequests sent."""
+        return [
+                request.last_message_id
+                for (method, request), _ in self.send.call_args_list
+                if method == 'SubscribeRequest'
+        ]
+
+    def test_returns_buffered_messages(self):
+        self.assertEqual(
+                self.hub.receive_one_message(1, timeout=0, last_message_id=3),
+                {})
+        self.hub.dispatch(_message(4))
+        self.hub.dispatch(_message(5))
+
+        message = self.hub.receive_one_message(1, last_message_id=4)
+        self.assertEqual(message, _message(5))
+        self.assertEqual(self.subscribed_from(), [3])
+
+    def test_wakes_up_waiters(self):
+        self.hub.receive_one_message(1, timeout=0, last_message_id=0)
+        timer = threading.Timer(.1, self.hub.dispatch, (_message(1),))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        start_secs = time.monotonic()
+        message = self.hub.receive_one_message(1, timeout=5, last_message_id=0)
+        self.assertEqual(message, _message(1))
+        self.assertLess(time.monotonic() - start_secs, 5)
+
+    def test_ignores_messages_for_other_users(self):
+        self.hub.receive_one_message(1, timeout=0, last_message_id=0)
+        self.hub.dispatch(_message(1, receiver_id=2))
+        self.assertEqual(
+                self.hub.receive_one_message(1, timeout=0, last_message_id=0),
+                {})
+
+    def test_resubscribes_requests_from_older_messages(self):
+        self.hub.receive_one_message(1, timeout=0, last_message_id=5)
+        self.hub.dispatch(_message(6))
+        # Still buffered, so no need to resubscribe.
+        self.hub.receive_one_message(1, timeout=0, last_message_id=5)
+        self.assertEqual(self.subscribed_from(), [5])
+
+        self.assertEqual(
+                self.hub.receive_one_message(1, timeout=0, last_message_id=2),
+                {})
+        self.assertEqual(self.subscribed_from(), [5, 2])
+        # The replay refills the buffer in order.
+        for message_id in (3, 4, 5, 6):
+            self.hub.dispatch(_message(message_id))
+        message = self.hub.receive_one_message(1, last_message_id=2)
+        self.assertEqual(message, _message(3))
+
+    def test_resubscribes_users_whose_subscription_failed(self):
+        self.hub.receive_one_message(1, timeout=0, last_message_id=3)
+        self.hub.dispatch({'receiver_ids': [1], 'reason': 'Overloaded'})
+
+        self.hub.receive_one_message(1, timeout=0, last_message_id=3)
+        self.assertEqual(self.subscribed_from(), [3, 3])
+
+    def test_idle_users_which_come_back_stay_subscribed(self):
+        self.hub.receive_one_message(1, timeout=0, last_message_id=3)
+        def send(method, request):
+            if method == 'UnsubscribeRequest':
+                # The user comes back while they are being unsubscribed.
+                self.hub.receive_one_message(1, timeout=0, last_message_id=5)
+        self.send.side_effect = send
+
+        self.hub._drop_idle_users(time.time() + hub_lib._IDLE_SECS + 1)
+        methods = [method for (method, _), _ in self.send.call_args_list]
+        # The last notification for the user subscribes them.
+        self.assertEqual(methods[1:], [
+                'UnsubscribeRequest', 'SubscribeRequest', 'SubscribeRequest'])
+        self.assertEqual(self.subscribed_from(), [3, 5, 5])
+
+    def test_returns_events_after_the_event_seq(self):
+        self.hub.receive_one_message(1, timeout=0, last_message_id=0)
+        self.hub.dispatch(_events(presence=[(2, True)]))
+        self.hub.dispatch(_events(typing=[(1, 2)]))
+
+        event_seq, presence = self.hub.current_events(1)
+        self.assertEqual(event_seq, 2)
+        self.assertEqual(
+                presence['presence'], [{'user_id': 2, 'online': True}])
+        frame = self.hub.receive_one_message(
+                1, timeout=0, last_message_id=0, last_event_seq=1)
+        self.assertEqual(frame['event_seq'], 2)
+        self.assertEqual(frame['typing'], [{'chat_id': 1, 'user_id': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
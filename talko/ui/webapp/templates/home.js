@@ -2,6 +2,25 @@ $(document).ready(function() {
   window.userId_ = {{ user_id }};
   window.chatId_ = undefined;
   window.chats_ = {}
+  window.lastMessageId_ = undefined;
+
+  // The number of messages fetched per page of chat history.
+  const PAGE_SIZE = 50;
+  // Estimated height of a message row which has not been rendered yet.
+  const ESTIMATED_ROW_PX = 72;
+  // How far outside the visible area rows are still rendered.
+  const OVERSCAN_PX = 500;
+  // How close to the top of the history older messages start loading.
+  const LOAD_OLDER_PX = 200;
+  // How often typing notifications are sent while the user types, and how long
+  // after the last one someone is still shown as typing.
+  const TYPING_INTERVAL_MS = {{ typing_interval_secs }} * 1000;
+  const TYPING_TIMEOUT_MS = {{ typing_timeout_secs }} * 1000;
+
+  // The user_ids of everyone online and, per chat_id, when each user who is
+  // typing in the chat was last seen typing.
+  window.onlineUserIds_ = new Set();
+  window.typing_ = {};
 
   function timestampToDateTime(timestamp, include_time = true) {
     const dateTime = new Date(timestamp);
@@ -14,7 +33,7 @@ $(document).ready(function() {
   }
 
   function getUserAvatarText(userName) {
-    text = "" 
+    text = ""
     for (split of userName.split(" ")) {
       text += split[0]
     }
@@ -32,60 +51,340 @@ $(document).ready(function() {
     }
   }
 
+  function isChatOnline(chat) {
+    return chat.users.some(user =>
+      user.user_id != window.userId_ && window.onlineUserIds_.has(user.user_id));
+  }
+
+  function getLastMessage(chat) {
+    return chat.messages[chat.messages.length - 1];
+  }
+
+  // The chat list is keyed by chat_id so that a new message only re-renders
+  // its own chat and moves it to the top, instead of rebuilding the list.
+  const chatElements = {};
+
+  function chatHtml(chat) {
+    let activeHtml =
+      chat.chat_id == window.chatId_ ? "active text-white" : "";
+    let lastMessage = getLastMessage(chat);
+    return `{% include "chat.html" %}`;
+  }
+
   function setChatsHtml(chats) {
-    let html = "";
+    let box = $(".chats-box").empty();
     for (chat of chats) {
-      let activeHtml = 
-        chat.chat_id == window.chatId_ ? "active text-white" : "";
-      console.log(chat.chat_id)
-      console.log(window.chatId_)
-      console.log(activeHtml)
-      html += `{% include "chat.html" %}`;
+      chatElements[chat.chat_id] = $(chatHtml(chat)).appendTo(box);
+    }
+  }
+
+  function moveChatToTop(chat) {
+    let element = $(chatHtml(chat));
+    if (chat.chat_id in chatElements) {
+      chatElements[chat.chat_id].remove();
+    }
+    chatElements[chat.chat_id] = element.prependTo($(".chats-box"));
+  }
+
+  function refreshChat(chat) {
+    if (chat.chat_id in chatElements) {
+      let element = $(chatHtml(chat));
+      chatElements[chat.chat_id].replaceWith(element);
+      chatElements[chat.chat_id] = element;
     }
-    $(".chats-box").html(html);
   }
 
   function fetchChats(userId) {
-    return $.get(`/chats?user_id=${userId}`, {})
+    return $.get(`/chats?user_id=${userId}&messages_limit=${PAGE_SIZE}`, {})
       .done(response => {
         for (chat of response.chats) {
+          chat.hasOlderMessages = chat.messages.length == PAGE_SIZE;
           window.chats_[chat.chat_id] = chat;
+          for (message of chat.messages) {
+            updateLastMessageId(message);
+          }
         }
       });
   }
 
-  function setMessagesHtml(messages) {
-    let html = "";
-    for (message of messages) {
-      if (message.user.user_id === window.userId_) {
-        html += `{% include "message_sent.html" %}`
-      } else {
-        html += `{% include "message_received.html" %}`
+  function fetchOlderMessages(chat) {
+    let before = chat.messages[0].message_id;
+    return $.get(`/messages?chat_id=${chat.chat_id}` +
+                 `&before_message_id=${before}&limit=${PAGE_SIZE}`, {})
+      .done(response => {
+        chat.hasOlderMessages = response.messages.length == PAGE_SIZE;
+        chat.messages = response.messages.concat(chat.messages);
+      });
+  }
+
+  function updateLastMessageId(message) {
+    if (window.lastMessageId_ === undefined ||
+        message.message_id > window.lastMessageId_) {
+      window.lastMessageId_ = message.message_id;
+    }
+  }
+
+  function messageHtml(message) {
+    let html = message.user.user_id === window.userId_
+      ? `{% include "message_sent.html" %}`
+      : `{% include "message_received.html" %}`;
+    return `<div class="message-row">${html}</div>`;
+  }
+
+  // A windowed list which only renders the messages in (or close to) the
+  // visible area of the messages box. The rest of the history is replaced by
+  // top and bottom spacers with the (measured or estimated) height of the rows
+  // they stand in for, so the DOM size stays constant as the history grows.
+  class MessageList {
+    constructor(box, list) {
+      this.box = box;
+      this.list = list;
+      this.chat = undefined;
+      this.heights = new Map();
+      this.offsets = [0];
+      this.first = 0;
+      this.last = -1;
+      this.loadingOlder = false;
+      this.box.on("scroll", () => this.onScroll());
+    }
+
+    get messages() {
+      return this.chat.messages;
+    }
+
+    rowHeight(message) {
+      return this.heights.get(message.message_id) || ESTIMATED_ROW_PX;
+    }
+
+    // offsets[i] is the top of the i-th message, offsets[n] the total height.
+    // Only the offsets after the from-th message are recomputed.
+    updateOffsets(from = 0) {
+      this.offsets.length = from + 1;
+      for (let i = from; i < this.messages.length; i++) {
+        this.offsets.push(this.offsets[i] + this.rowHeight(this.messages[i]));
       }
     }
-    $(".messages-box .list-group").html(html);
-    $(".messages-box").scrollTop($(".messages-box .list-group")[0].scrollHeight);
-  } 
 
-  function pollServer() {
-    $.ajax({
-      url: `/message-stream?user_id=${window.userId_}`,
-      success: response => {
-        message = response.message
-        if (!!message) {
-          chat = window.chats_[message.chat_id];
-          chat.messages.push(message);
-          if (chat.chat_id == window.chatId_) {
-            setMessagesHtml(chat.messages);
-            setChatsHtml(Object.values(window.chats_));
-          }
+    // Returns the index of the message at the given offset.
+    indexAt(offset) {
+      let lo = 0, hi = this.messages.length - 1;
+      while (lo < hi) {
+        let mid = (lo + hi + 1) >> 1;
+        if (this.offsets[mid] <= offset) {
+          lo = mid;
+        } else {
+          hi = mid - 1;
         }
-      },
-      complete: pollServer, 
-      timeout: 30000,
+      }
+      return lo;
+    }
+
+    isAtBottom() {
+      let box = this.box[0];
+      return box.scrollHeight - box.scrollTop - box.clientHeight <
+        ESTIMATED_ROW_PX;
+    }
+
+    scrollToBottom() {
+      this.box.scrollTop(this.box[0].scrollHeight);
+    }
+
+    setChat(chat) {
+      this.chat = chat;
+      this.updateOffsets();
+      this.first = this.last = -1;
+      this.render();
+      this.scrollToBottom();
+      this.render();
+    }
+
+    render() {
+      let n = this.messages.length;
+      let top = this.box.scrollTop() - OVERSCAN_PX;
+      let bottom = this.box.scrollTop() + this.box.innerHeight() + OVERSCAN_PX;
+      let first = n ? this.indexAt(Math.max(top, 0)) : 0;
+      let last = n ? this.indexAt(bottom) : -1;
+      if (first == this.first && last == this.last) {
+        return;
+      }
+      this.first = first;
+      this.last = last;
+
+      let html = `<div class="spacer" style="height: ${this.offsets[first]}px"></div>`;
+      for (let i = first; i <= last; i++) {
+        html += messageHtml(this.messages[i]);
+      }
+      let bottomHeight = this.offsets[n] - this.offsets[last + 1];
+      html += `<div class="spacer" style="height: ${bottomHeight}px"></div>`;
+      this.list.html(html);
+      this.measure();
+    }
+
+    // Records the real heights of the rendered rows, so the spacers converge
+    // to the real height of the history as the user scrolls through it.
+    measure() {
+      let changed = -1;
+      this.list.children(".message-row").each((i, row) => {
+        let message = this.messages[this.first + i];
+        if (this.heights.get(message.message_id) !== row.offsetHeight) {
+          this.heights.set(message.message_id, row.offsetHeight);
+          changed = changed < 0 ? this.first + i : changed;
+        }
+      });
+      if (changed >= 0) {
+        this.updateOffsets(changed);
+        let n = this.messages.length;
+        let bottomHeight = this.offsets[n] - this.offsets[this.last + 1];
+        this.list.children(".spacer").first()
+          .css("height", this.offsets[this.first]);
+        this.list.children(".spacer").last().css("height", bottomHeight);
+      }
+    }
+
+    // Appends a message which was already pushed to the chat's messages.
+    append(message) {
+      let stickToBottom = this.isAtBottom();
+      let n = this.messages.length;
+      this.offsets.push(this.offsets[n - 1] + this.rowHeight(message));
+      if (this.last == n - 2) {
+        // The end of the history is rendered, only add the new row.
+        $(messageHtml(message)).insertBefore(this.list.children().last());
+        this.last = n - 1;
+        this.measure();
+      } else {
+        let bottomHeight = this.offsets[n] - this.offsets[this.last + 1];
+        this.list.children(".spacer").last().css("height", bottomHeight);
+      }
+      if (stickToBottom) {
+        this.scrollToBottom();
+        this.render();
+      }
+    }
+
+    // Keeps the visible messages in place after older messages are loaded.
+    prepended() {
+      let scrollTop = this.box.scrollTop();
+      let nAdded = this.messages.length - (this.offsets.length - 1);
+      this.updateOffsets();
+      this.first = this.last = -1;
+      // Grow the spacers first, the browser would otherwise clamp the new
+      // scroll offset to the old height of the list.
+      this.render();
+      // Rendering measured the rows, so offsets[nAdded] is where the
+      // previously first message now starts.
+      this.box.scrollTop(scrollTop + this.offsets[nAdded]);
+      this.render();
+    }
+
+    onScroll() {
+      this.render();
+      let chat = this.chat;
+      if (this.box.scrollTop() < LOAD_OLDER_PX && chat.hasOlderMessages &&
+          !this.loadingOlder) {
+        this.loadingOlder = true;
+        fetchOlderMessages(chat)
+          .done(() => {
+            if (this.chat === chat) {
+              this.prepended();
+            }
+          })
+          .always(() => this.loadingOlder = false);
+      }
+    }
+  }
+
+  const messageList = new MessageList(
+    $(".messages-box"), $(".messages-box .list-group"));
+
+  function onNewMessage(message) {
+    chat = window.chats_[message.chat_id];
+    chat.messages.push(message);
+    if (chat.chat_id == window.chatId_) {
+      messageList.append(message);
+    }
+    moveChatToTop(chat);
+    // A new message means its sender has stopped typing.
+    delete (window.typing_[message.chat_id] || {})[message.user.user_id];
+    renderTypingIndicator();
+  }
+
+  function renderTypingIndicator() {
+    let chat = window.chats_[window.chatId_];
+    if (!chat) {
+      return;
+    }
+    let typing = window.typing_[chat.chat_id] || {};
+    let since = Date.now() - TYPING_TIMEOUT_MS;
+    let names = chat.users
+      .filter(user => typing[user.user_id] > since)
+      .map(user => user.user_name);
+    let text = "";
+    if (names.length) {
+      text = `${names.join(", ")} ${names.length == 1 ? "is" : "are"} typing...`;
+    }
+    $(".typing-indicator").text(text);
+  }
+
+  // Applies an event frame with presence and typing events.
+  function onActivity(frame) {
+    for (let event of frame.presence) {
+      if (event.online) {
+        window.onlineUserIds_.add(event.user_id);
+      } else {
+        window.onlineUserIds_.delete(event.user_id);
+      }
+    }
+    if (frame.presence.length) {
+      for (let chatId in window.chats_) {
+        refreshChat(window.chats_[chatId]);
+      }
+    }
+    let now = Date.now();
+    for (let event of frame.typing) {
+      window.typing_[event.chat_id] = window.typing_[event.chat_id] || {};
+      window.typing_[event.chat_id][event.user_id] = now;
+    }
+    renderTypingIndicator();
+  }
+
+  function openEventStream() {
+    // Resume from the last message we've seen so messages which arrive
+    // before the stream opens are not lost. On reconnects, the browser resumes
+    // the stream via the Last-Event-ID header.
+    let url = `/events?user_id=${window.userId_}`;
+    if (window.lastMessageId_ !== undefined) {
+      url += `&last_message_id=${window.lastMessageId_}`;
+    }
+    let source = new EventSource(url);
+    source.addEventListener("message", event => {
+      message = JSON.parse(event.data).message;
+      updateLastMessageId(message);
+      onNewMessage(message);
+    });
+    source.addEventListener("activity", event => {
+      onActivity(JSON.parse(event.data));
     });
   }
 
+  // When a typing notification was last sent, per chat_id. The servers rate
+  // limit them anyway, this just avoids a request on every keystroke.
+  const typingSentAt = {};
+
+  $("#send-input").on("input", () => {
+    let chatId = window.chatId_;
+    let now = Date.now();
+    if (now - (typingSentAt[chatId] || 0) < TYPING_INTERVAL_MS) {
+      return;
+    }
+    typingSentAt[chatId] = now;
+    $.ajax({
+      url: "/typing",
+      method: "POST",
+      contentType: "application/json; charset=UTF-8",
+      data: JSON.stringify({chat_id: chatId, user_id: window.userId_}),
+    });
+  });
+
   // TODO(eugenhotaj): We need to attach listners to the chats list so the
   // user can switch to other chats.
   // Attach listener.
@@ -99,31 +398,17 @@ $(document).ready(function() {
       contentType: "application/json; charset=UTF-8",
       data: JSON.stringify(data),
       dataType: "json",
-    }).done(response => { 
-        message = response.message;
-        chat = window.chats_[message.chat_id];
-        chat.messages.push(message);
-        if (chat.chat_id == window.chatId_) {
-          setMessagesHtml(chat.messages);
-          setChatsHtml(Object.values(window.chats_));
-        }
-    });
+    }).done(response => onNewMessage(response.message));
     $("#send-input").val("");
   });
 
   fetchChats(window.userId_)
     .done(response => {
       window.chatId_ = window.chatId_ || response.chats[0].chat_id;
-      for (chat of response.chats) {
-        if (chat.chat_id == window.chatId_) {
-          setMessagesHtml(chat.messages);
-          return 
-        }
-      }
-    })
-    .done(unusedResponse => {
-        setChatsHtml(Object.values(window.chats_));
+      setChatsHtml(response.chats);
+      messageList.setChat(window.chats_[window.chatId_]);
+      openEventStream();
+      // Typing indicators expire even if no new events arrive.
+      setInterval(renderTypingIndicator, 1000);
     });
-
-  pollServer();
 });